@@ -0,0 +1,246 @@
+"""
+Benchmark suite of the ETL and calcs stages on synthetic NICS data.
+
+Every stage of the exercises is timed (best of --repeat runs, without
+memory tracing) and memory-profiled (tracemalloc peak, in a separate run) on
+synthetic files with 10, 100 and 1000 times the rows of the bundled NICS
+file. Each run is appended to benchmarks/results.jsonl together with the git
+commit it measured, and compared with the latest run of another commit.
+
+Run it from the repository root:
+    python benchmarks/bench.py --scales 10 100
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gunstats.calcs import print_biggest_handguns, print_biggest_longguns, \
+    time_evolution, analyze_state_data, create_choropleth_map
+from gunstats.etl import read_csv, clean_csv, rename_col, breakdown_date, \
+    erase_month, groupby_state_and_year, stream_groupby_state_and_year, \
+    groupby_state, clean_states, merge_datasets, calculate_relative_values
+from gunstats.instrument import recording, set_quiet
+from gunstats.synthetic import write_nics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BENCH_DIR, 'data')
+RESULTS_PATH = os.path.join(BENCH_DIR, 'results.jsonl')
+POPULATION_PATH = os.path.join('data', 'us-state-populations.csv')
+GEO_JSON_PATH = os.path.join('data', 'us-states.json')
+
+
+def synthetic_file(scale: int) -> str:
+    """
+    Function to get the synthetic NICS file of a scale, generating it the
+    first time.
+    Args:
+     -scale (int): The number of rows, as a multiple of the bundled file.
+    Returns:
+     -path (str): The path to the synthetic file.
+    """
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, f'nics-x{scale}.csv')
+    if not os.path.exists(path):
+        print(f"Generating {path}...")
+        write_nics(path, scale)
+
+    return path
+
+
+def run_stages(nics_path: str, output_dir: str) -> None:
+    """
+    Function to run every stage of the exercises on a NICS file.
+    Args:
+     -nics_path (str): The path to the NICS file.
+     -output_dir (str): The directory to save the graph and map in.
+    Returns:
+     -None
+    """
+
+    # Exercises 1 to 3
+    df = rename_col(clean_csv(read_csv(nics_path)))
+    df = erase_month(breakdown_date(df))
+    grouped_df = groupby_state_and_year(df)
+    stream_groupby_state_and_year(nics_path)
+    print_biggest_handguns(grouped_df)
+    print_biggest_longguns(grouped_df)
+
+    # Exercise 4
+    time_evolution(grouped_df, [os.path.join(output_dir, 'time.png')])
+
+    # Exercises 5 and 6
+    state_df = clean_states(groupby_state(grouped_df))
+    merged_df = merge_datasets(state_df, read_csv(POPULATION_PATH))
+    relative_df = calculate_relative_values(merged_df)
+    create_choropleth_map(relative_df, 'permit_perc', GEO_JSON_PATH,
+                          'Permit Percentage', 'permit_perc_map',
+                          backend='matplotlib', html=True,
+                          output_dir=output_dir)
+    analyze_state_data(relative_df)
+
+
+def measure(scale: int, repeat: int) -> list:
+    """
+    Function to measure every stage on the synthetic file of a scale.
+    Args:
+     -scale (int): The scale of the synthetic file.
+     -repeat (int): The number of timed runs.
+    Returns:
+     -stages (list): For every stage, in order, its best 'wall_time' in
+       seconds, its 'peak_memory' in bytes, its 'rows_in' and 'rows_out'.
+       Stages run more than once are numbered, e.g. 'read_csv #2'.
+    """
+
+    nics_path = synthetic_file(scale)
+    # The results printed by the exercises are not part of the report
+    with tempfile.TemporaryDirectory() as output_dir, \
+            redirect_stdout(io.StringIO()):
+        runs = []
+        for _ in range(repeat):
+            with recording(memory=False) as recorder:
+                run_stages(nics_path, output_dir)
+            runs.append(recorder.stages)
+        with recording() as recorder:
+            run_stages(nics_path, output_dir)
+
+    names = []
+    for stage in recorder.stages:
+        count = sum(name.split(' #')[0] == stage['stage'] for name in names)
+        names.append(stage['stage'] + (f' #{count + 1}' if count else ''))
+
+    return [{
+        'stage': names[i],
+        'wall_time': min(run[i]['wall_time'] for run in runs),
+        'peak_memory': stage['peak_memory_delta'],
+        'rows_in': stage['rows_in'],
+        'rows_out': stage['rows_out'],
+    } for i, stage in enumerate(recorder.stages)]
+
+
+def git_commit() -> tuple:
+    """
+    Function to identify the measured code.
+    Returns:
+     -commit (str): The current git commit, or None outside a repository.
+     -dirty (bool): Whether the working tree has uncommitted changes.
+    """
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain',
+                                '--untracked-files=no'],
+                               capture_output=True, text=True,
+                               check=True).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+    return commit, dirty
+
+
+def previous_result(scale: int, commit: str) -> dict:
+    """
+    Function to find the latest stored result of a scale measured on
+    another commit.
+    Args:
+     -scale (int): The scale.
+     -commit (str): The current commit.
+    Returns:
+     -result (dict): The stored result, or None.
+    """
+
+    if not os.path.exists(RESULTS_PATH):
+        return None
+
+    previous = None
+    with open(RESULTS_PATH) as f:
+        for line in f:
+            result = json.loads(line)
+            if result['scale'] == scale and result['commit'] != commit:
+                previous = result
+
+    return previous
+
+
+def format_result(result: dict, previous: dict = None) -> str:
+    """
+    Function to format a result as a text table, with the change of every
+    stage against a previous result.
+    Args:
+     -result (dict): The result.
+     -previous (dict): The previous result, if any.
+    Returns:
+     -text (str): The formatted table.
+    """
+
+    before = {stage['stage']: stage for stage in previous['stages']} \
+        if previous else {}
+    against = f" vs {previous['commit']}" if previous else ""
+    lines = [f"Scale x{result['scale']} ({result['rows']} rows), "
+             f"commit {result['commit']}{against}",
+             f"{'Stage':<32}{'Time (s)':>10}{'Change':>9}"
+             f"{'Peak (MB)':>11}{'Change':>9}"]
+
+    for stage in result['stages']:
+        old = before.get(stage['stage'])
+        time_change = memory_change = ''
+        if old and old['wall_time']:
+            time_change = f"{stage['wall_time'] / old['wall_time'] - 1:+.0%}"
+        if old and old['peak_memory']:
+            memory_change = \
+                f"{stage['peak_memory'] / old['peak_memory'] - 1:+.0%}"
+        lines.append(f"{stage['stage']:<32}{stage['wall_time']:>10.4f}"
+                     f"{time_change:>9}{stage['peak_memory'] / 1e6:>11.2f}"
+                     f"{memory_change:>9}")
+
+    return '\n'.join(lines)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(prog='python benchmarks/bench.py')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 100],
+                        help="sizes of the synthetic files, as multiples "
+                             "of the bundled file (e.g. 10 100 1000)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of timed runs per scale")
+    parser.add_argument('--no-save', action='store_true',
+                        help="do not append the results to results.jsonl")
+    args = parser.parse_args(argv)
+
+    set_quiet()
+    commit, dirty = git_commit()
+    for scale in args.scales:
+        stages = measure(scale, args.repeat)
+        result = {
+            'commit': commit,
+            'dirty': dirty,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'pandas': pd.__version__,
+            'scale': scale,
+            'rows': stages[0]['rows_out'],
+            'stages': stages,
+        }
+        print(format_result(result, previous_result(scale, commit)))
+        print()
+
+        if not args.no_save:
+            with open(RESULTS_PATH, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
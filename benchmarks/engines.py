@@ -0,0 +1,116 @@
+"""
+Benchmark of the pandas and Arrow engines of the ETL functions.
+
+read_csv, groupby_state_and_year, groupby_state, merge_datasets and
+calculate_relative_values are timed (best of --repeat runs) with each engine
+on the synthetic NICS files of the given scales, and the results of the two
+engines are checked to be identical. tracemalloc does not see the buffers
+allocated by Arrow, so memory is compared by benchmarks/memory.py, which
+measures the peak resident memory of each engine.
+
+Run it from the repository root:
+    python benchmarks/engines.py --scales 10 100
+"""
+import argparse
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import synthetic_file, POPULATION_PATH
+from gunstats.engine import ENGINES
+from gunstats.etl import read_csv, clean_csv, rename_col, breakdown_date, \
+    erase_month, groupby_state_and_year, groupby_state, clean_states, \
+    merge_datasets, calculate_relative_values
+from gunstats.instrument import recording, set_quiet
+
+# Stages run by each engine, in order
+ENGINE_STAGES = ['read_csv', 'groupby_state_and_year', 'groupby_state',
+                 'read_csv #2', 'merge_datasets', 'calculate_relative_values']
+
+
+def run_engine(nics_path: str, engine: str) -> pd.DataFrame:
+    """
+    Function to compute the per-capita values from a NICS file with an
+    engine.
+    Args:
+     -nics_path (str): The path to the NICS file.
+     -engine (str): The engine of the ETL functions.
+    Returns:
+     -df (pd.DataFrame): The relative values.
+    """
+
+    df = rename_col(clean_csv(read_csv(nics_path, engine=engine)))
+    df = erase_month(breakdown_date(df))
+    grouped_df = groupby_state_and_year(df, engine=engine)
+    state_df = clean_states(groupby_state(grouped_df, engine=engine))
+    merged_df = merge_datasets(state_df,
+                               read_csv(POPULATION_PATH, engine=engine),
+                               engine=engine)
+
+    return calculate_relative_values(merged_df, engine=engine)
+
+
+def measure(nics_path: str, engine: str, repeat: int) -> tuple:
+    """
+    Function to measure the engine stages on a NICS file.
+    Args:
+     -nics_path (str): The path to the NICS file.
+     -engine (str): The engine of the ETL functions.
+     -repeat (int): The number of timed runs.
+    Returns:
+     -times (dict): The best wall time, in seconds, of each stage of
+       ENGINE_STAGES.
+     -df (pd.DataFrame): The relative values.
+    """
+
+    runs = []
+    for _ in range(repeat):
+        with recording(memory=False) as recorder:
+            df = run_engine(nics_path, engine)
+        runs.append(recorder.stages)
+
+    times, names = {}, []
+    for i, stage in enumerate(runs[0]):
+        count = sum(name.split(' #')[0] == stage['stage'] for name in names)
+        names.append(stage['stage'] + (f' #{count + 1}' if count else ''))
+        if names[-1] in ENGINE_STAGES:
+            times[names[-1]] = min(run[i]['wall_time'] for run in runs)
+
+    return times, df
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(prog='python benchmarks/engines.py')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 100],
+                        help="sizes of the synthetic files, as multiples "
+                             "of the bundled file")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of timed runs per engine")
+    args = parser.parse_args(argv)
+
+    set_quiet()
+    for scale in args.scales:
+        nics_path = synthetic_file(scale)
+        results, frames = {}, {}
+        for engine in ENGINES:
+            results[engine], frames[engine] = measure(nics_path, engine,
+                                                      args.repeat)
+        pd.testing.assert_frame_equal(frames['pandas'], frames['arrow'])
+
+        print(f"Scale x{scale}: identical results")
+        print(f"{'Stage':<28}{'pandas (s)':>12}{'arrow (s)':>11}"
+              f"{'Speedup':>9}")
+        for stage in ENGINE_STAGES:
+            pandas_time = results['pandas'][stage]
+            arrow_time = results['arrow'][stage]
+            print(f"{stage:<28}{pandas_time:>12.4f}{arrow_time:>11.4f}"
+                  f"{pandas_time / arrow_time:>8.1f}x")
+        print()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+Load test of the query service (gunstats.service).
+
+Opens --concurrency keep-alive connections to the service and sends
+--requests GET requests in total, spread over a mix of totals, per-capita
+and top-k queries. Reports the throughput and the p50/p90/p99 latencies.
+
+Without --url, a service is started in this process on a free local port.
+
+Run it from the repository root:
+    python benchmarks/loadtest.py --requests 20000 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from gunstats.instrument import set_quiet
+from gunstats.service import StatsService
+
+# Query mix: a handful of hot dashboard queries and many distinct cells
+HOT_PATHS = ['/meta', '/totals?metric=handgun&year=2016',
+             '/top?metric=handgun&k=10&by=year', '/per_capita?year=2019']
+
+
+def query_paths(meta: dict, count: int, seed: int = 0) -> list:
+    """
+    Function to build the paths of the load test: half hot queries and half
+    random (state, year, metric) lookups.
+    Args:
+     -meta (dict): The 'states', 'years' and 'metrics' of the service.
+     -count (int): The number of paths.
+     -seed (int): The seed of the random generator.
+    Returns:
+     -paths (list): The paths.
+    """
+
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(count):
+        if rng.random() < 0.5:
+            paths.append(rng.choice(HOT_PATHS))
+        else:
+            endpoint = rng.choice(['/totals', '/per_capita'])
+            query = urlencode({'state': rng.choice(meta['states']),
+                               'year': rng.choice(meta['years']),
+                               'metric': rng.choice(meta['metrics'])})
+            paths.append(f"{endpoint}?{query}")
+
+    return paths
+
+
+async def read_response(reader: asyncio.StreamReader) -> bytes:
+    """
+    Function to read an HTTP response with a Content-Length.
+    Args:
+     -reader (asyncio.StreamReader): The connection reader.
+    Returns:
+     -body (bytes): The body of the response.
+    """
+
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':')[1])
+
+    return await reader.readexactly(length)
+
+
+async def client(host: str, port: int, paths: list,
+                 latencies: list) -> None:
+    """
+    Function to send requests over one keep-alive connection, one at a
+    time, recording their latencies.
+    Args:
+     -host (str): The host of the service.
+     -port (int): The port of the service.
+     -paths (list): The paths to request.
+     -latencies (list): The list the latencies, in seconds, are added to.
+    Returns:
+     -None
+    """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    for path in paths:
+        start = time.perf_counter()
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+        await writer.drain()
+        await read_response(reader)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def load_test(url: str, requests: int, concurrency: int) -> dict:
+    """
+    Function to run the load test.
+    Args:
+     -url (str): The URL of the service, or None to start one locally.
+     -requests (int): The total number of requests.
+     -concurrency (int): The number of concurrent connections.
+    Returns:
+     -result (dict): The 'requests', 'seconds', 'throughput' (requests per
+       second) and the 'p50', 'p90' and 'p99' latencies in milliseconds,
+       and the response 'cache' statistics of a local service.
+    """
+
+    server = service = None
+    if url is None:
+        service = StatsService()
+        server = await service.start('127.0.0.1', 0)
+        host, port = server.sockets[0].getsockname()[:2]
+    else:
+        host, port = urlsplit(url).hostname, urlsplit(url).port
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET /meta HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    meta = json.loads(await read_response(reader))
+    writer.close()
+
+    paths = query_paths(meta, requests)
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, paths[i::concurrency],
+                                  latencies)
+                           for i in range(concurrency)])
+    seconds = time.perf_counter() - start
+
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+    return {'requests': len(latencies), 'seconds': seconds,
+            'throughput': len(latencies) / seconds,
+            'p50': p50, 'p90': p90, 'p99': p99,
+            'cache': service.respond.cache_info() if service else None}
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(prog='python benchmarks/loadtest.py')
+    parser.add_argument('--url', help="URL of a running service, e.g. "
+                                      "http://127.0.0.1:8080")
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args(argv)
+
+    set_quiet()
+    result = asyncio.run(load_test(args.url, args.requests,
+                                   args.concurrency))
+    print(f"{result['requests']} requests in {result['seconds']:.2f} s "
+          f"({result['throughput']:.0f} requests/s), "
+          f"{args.concurrency} connections")
+    print(f"p50 {result['p50']:.2f} ms, p90 {result['p90']:.2f} ms, "
+          f"p99 {result['p99']:.2f} ms")
+    if result['cache'] is not None:
+        print(f"Response cache: {result['cache'].hits} hits, "
+              f"{result['cache'].misses} misses")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
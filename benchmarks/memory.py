@@ -0,0 +1,117 @@
+"""
+Memory profile of the pipeline, from the raw NICS CSV to the per-capita
+values, in each of its modes.
+
+Every mode runs in a fresh interpreter, which computes the 'relative' stage
+(and everything upstream of it) on the synthetic file of the given scale and
+reports its peak resident memory, the peak memory traced by tracemalloc and
+the memory still held by the pipeline afterwards.
+
+Run it from the repository root:
+    python benchmarks/memory.py --scale 100
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import synthetic_file
+
+# Pipeline options of each profiled mode
+MODES = {
+    'default': {},
+    'lean': {'lean': True},
+    'compact': {'compact': True},
+    'compact + lean': {'compact': True, 'lean': True},
+    'arrow': {'engine': 'arrow'},
+    'arrow + lean': {'engine': 'arrow', 'lean': True},
+}
+
+# Script run in a fresh interpreter for each mode
+PROFILE_SCRIPT = """
+import json, resource, sys, tracemalloc
+from gunstats.instrument import set_quiet
+from gunstats.pipeline import Pipeline
+set_quiet()
+tracemalloc.start()
+pipeline = Pipeline(sys.argv[1], **json.loads(sys.argv[2]))
+pipeline.get('relative')
+retained, peak = tracemalloc.get_traced_memory()
+print(json.dumps({
+    'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    'peak_traced': peak,
+    'retained': retained,
+}))
+"""
+
+
+def data_dir(nics_path: str, directory: str) -> str:
+    """
+    Function to lay out a data directory with a given NICS file and the
+    bundled population and geo JSON files.
+    Args:
+     -nics_path (str): The path to the NICS file.
+     -directory (str): The directory to fill.
+    Returns:
+     -directory (str): The data directory.
+    """
+
+    os.symlink(os.path.abspath(nics_path),
+               os.path.join(directory, 'nics-firearm-background-checks.csv'))
+    for name in ('us-state-populations.csv', 'us-states.json'):
+        os.symlink(os.path.abspath(os.path.join('data', name)),
+                   os.path.join(directory, name))
+
+    return directory
+
+
+def profile(directory: str, options: dict) -> dict:
+    """
+    Function to profile the pipeline in a fresh interpreter.
+    Args:
+     -directory (str): The data directory.
+     -options (dict): The Pipeline options.
+    Returns:
+     -profile (dict): The 'peak_rss', 'peak_traced' and 'retained' memory,
+       in bytes.
+    """
+
+    result = subprocess.run([sys.executable, '-c', PROFILE_SCRIPT, directory,
+                             json.dumps(options)],
+                            capture_output=True, text=True, check=True,
+                            cwd=os.getcwd(),
+                            env=dict(os.environ, PYTHONPATH=os.getcwd()))
+
+    return json.loads(result.stdout)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(prog='python benchmarks/memory.py')
+    parser.add_argument('--scale', type=int, default=100,
+                        help="size of the synthetic file, as a multiple of "
+                             "the bundled file (1 for the bundled file)")
+    args = parser.parse_args(argv)
+
+    nics_path = os.path.join('data', 'nics-firearm-background-checks.csv') \
+        if args.scale == 1 else synthetic_file(args.scale)
+
+    print(f"Scale x{args.scale}, raw CSV to per-capita values")
+    print(f"{'Mode':<16}{'Peak RSS (MB)':>15}{'Peak traced (MB)':>18}"
+          f"{'Retained (MB)':>15}")
+    with tempfile.TemporaryDirectory() as directory:
+        data_dir(nics_path, directory)
+        for mode, options in MODES.items():
+            result = profile(directory, options)
+            print(f"{mode:<16}{result['peak_rss'] / 1e6:>15.1f}"
+                  f"{result['peak_traced'] / 1e6:>18.1f}"
+                  f"{result['retained'] / 1e6:>15.1f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
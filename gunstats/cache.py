@@ -0,0 +1,329 @@
+import hashlib
+import os
+import shutil
+import threading
+import pandas as pd
+
+# Default directory of the parsed-file cache
+CACHE_DIR = os.path.join('data', '.cache')
+
+# Default directory of the map artifact cache
+ARTIFACT_DIR = os.path.join(CACHE_DIR, 'maps')
+
+# Default maximum size, in bytes, of the map artifact cache
+ARTIFACT_MAX_BYTES = 64 << 20
+
+# Size of the blocks used to hash the source files
+_BLOCK_SIZE = 1 << 20
+
+
+def content_digest(path: str) -> str:
+    """
+    Function to hash the contents of a file, whatever its path or
+    modification time.
+    Args:
+     -path (str): The path to the file.
+    Returns:
+     -digest (str): The hexadecimal SHA-256 of the contents.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def file_token(path: str) -> tuple:
+    """
+    Function to build a cheap token identifying the current contents of a
+    file, used to decide whether a result derived from it (a pipeline stage,
+    a parsed geometry) is stale.
+    Args:
+     -path (str): The path to the file.
+    Returns:
+     -token (tuple): The absolute path, size and modification time.
+    """
+
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def fingerprint(path: str, **options) -> str:
+    """
+    Function to fingerprint a source file together with the options used to
+    parse it. The fingerprint changes whenever the file path, size,
+    modification time or contents change.
+    Args:
+     -path (str): The path to the source file.
+     -options: The parsing options that change the parsed result.
+    Returns:
+     -key (str): The hexadecimal fingerprint.
+    """
+
+    stat = os.stat(path)
+    key = hashlib.sha256()
+    key.update(repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                     content_digest(path), sorted(options.items())))
+               .encode())
+
+    return key.hexdigest()
+
+
+def _entry_prefix(path: str, **options) -> str:
+    """
+    Function to build the prefix shared by every cache entry of a source
+    file parsed with the given options, whatever its fingerprint.
+    Args:
+     -path (str): The path to the source file.
+     -options: The parsing options that change the parsed result.
+    Returns:
+     -prefix (str): The prefix of the cache entries.
+    """
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    path_hash = hashlib.sha256(
+        repr((os.path.abspath(path), sorted(options.items()))).encode())
+
+    return f"{stem}-{path_hash.hexdigest()[:12]}-"
+
+
+def cached_read(path: str, read, cache_dir: str = CACHE_DIR,
+                max_bytes: int = None, **options) -> pd.DataFrame:
+    """
+    Function to read a source file through an on-disk Arrow/Feather cache.
+    On a hit the parsed frame is memory-mapped from the cache instead of
+    parsing the source again; on a miss it is parsed with `read`, stored,
+    and every stale entry of the same source is removed.
+    If pyarrow is not installed the file is parsed without caching.
+    Args:
+     -path (str): The path to the source file.
+     -read (callable): The function parsing the file, called as
+       read(path, **options).
+     -cache_dir (str): The directory holding the cache entries.
+     -max_bytes (int): If set, the cache directory is pruned to this size
+       after a new entry is written.
+     -options: The parsing options, forwarded to `read`.
+    Returns:
+     -df (pd.DataFrame): The parsed file.
+    """
+
+    try:
+        import pyarrow
+        import pyarrow.feather as feather
+    except ImportError:
+        return read(path, **options)
+
+    prefix = _entry_prefix(path, **options)
+    entry = os.path.join(cache_dir, prefix
+                         + fingerprint(path, **options)[:16] + '.feather')
+
+    # Cache hit: mark the entry as recently used and map it
+    if os.path.exists(entry):
+        os.utime(entry)
+        return feather.read_table(entry, memory_map=True).to_pandas()
+
+    df = read(path, **options)
+
+    # Write the entry atomically, through a temporary file of this writer,
+    # then drop the stale ones (not the files other writers are writing)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_entry = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+    feather.write_feather(pyarrow.Table.from_pandas(df, preserve_index=False),
+                          tmp_entry)
+    os.replace(tmp_entry, entry)
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name != os.path.basename(entry) \
+                and not name.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    if max_bytes is not None:
+        prune_cache(cache_dir, max_bytes)
+
+    return df
+
+
+def prune_cache(cache_dir: str = CACHE_DIR, max_bytes: int = 0) -> int:
+    """
+    Function to bound the size of the cache directory, removing the least
+    recently used entries first.
+    Args:
+     -cache_dir (str): The directory holding the cache entries.
+     -max_bytes (int): The maximum total size of the entries kept.
+    Returns:
+     -removed (int): The number of entries removed.
+    """
+
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+    entries = sorted((e for e in entries if os.path.isfile(e)),
+                     key=os.path.getmtime)
+    total = sum(os.path.getsize(e) for e in entries)
+
+    removed = 0
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        total -= os.path.getsize(entry)
+        os.remove(entry)
+        removed += 1
+
+    return removed
+
+
+class ArtifactCache:
+    """
+    Class that caches the files rendered from a column of data (e.g. the
+    HTML and PNG of a choropleth map) under a hash of the column values, the
+    contents of the input files and the rendering parameters. Each entry is
+    a directory of the cache holding one file per extension; a hit copies
+    them to the requested paths instead of rendering them again.
+
+    The cache is bounded to max_bytes, evicting the least recently used
+    entries first, and counts its hits and misses.
+    """
+
+    def __init__(self, cache_dir: str = ARTIFACT_DIR,
+                 max_bytes: int = ARTIFACT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, values: pd.DataFrame, paths: list = (), **params) -> str:
+        """
+        Method to compute the key of an artifact.
+        Args:
+         -values (pd.DataFrame): The data drawn, e.g. the 'state' and value
+           columns of a map. Its index is ignored.
+         -paths (list): The input files, e.g. the geo JSON file, keyed by
+           their contents.
+         -params: The rendering parameters, e.g. the title and formats.
+        Returns:
+         -key (str): The hexadecimal key.
+        """
+
+        key = hashlib.sha256()
+        key.update(pd.util.hash_pandas_object(values, index=False)
+                   .to_numpy().tobytes())
+        key.update(repr((list(values.columns),
+                         [content_digest(path) for path in paths],
+                         sorted(params.items()))).encode())
+
+        return key.hexdigest()[:32]
+
+    def get(self, key: str, paths: list) -> bool:
+        """
+        Method to copy the files of an entry to the given paths, counting a
+        hit or a miss.
+        Args:
+         -key (str): The key of the entry.
+         -paths (list): The paths of the artifact files. The file of the
+           entry with the same extension is copied to each of them.
+        Returns:
+         -hit (bool): Whether the entry exists with every file requested.
+        """
+
+        entry = os.path.join(self.cache_dir, key)
+        sources = [os.path.join(entry, 'artifact' + os.path.splitext(path)[1])
+                   for path in paths]
+        hit = all(os.path.exists(source) for source in sources)
+        if hit:
+            # Mark the entry as recently used
+            os.utime(entry)
+            for source, path in zip(sources, paths):
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                shutil.copyfile(source, path)
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return hit
+
+    def put(self, key: str, paths: list) -> None:
+        """
+        Method to store the rendered files of an artifact, then evict the
+        least recently used entries beyond max_bytes.
+        Args:
+         -key (str): The key of the entry.
+         -paths (list): The rendered files, with distinct extensions.
+        Returns:
+         -None
+        """
+
+        # Fill a temporary directory, then move it in place atomically
+        entry = os.path.join(self.cache_dir, key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_entry = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_entry)
+        for path in paths:
+            shutil.copyfile(path, os.path.join(
+                tmp_entry, 'artifact' + os.path.splitext(path)[1]))
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # The entry exists, e.g. just published by another writer. The
+            # same key has the same contents, so the files are moved into it
+            # one at a time (each atomically) instead of replacing it
+            try:
+                for name in os.listdir(tmp_entry):
+                    os.replace(os.path.join(tmp_entry, name),
+                               os.path.join(entry, name))
+            except FileNotFoundError:
+                # The entry was evicted in the meantime
+                pass
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        self.prune(self.max_bytes)
+
+    def prune(self, max_bytes: int = 0) -> int:
+        """
+        Method to bound the size of the cache, removing the least recently
+        used entries first.
+        Args:
+         -max_bytes (int): The maximum total size of the entries kept.
+        Returns:
+         -removed (int): The number of entries removed.
+        """
+
+        if not os.path.isdir(self.cache_dir):
+            return 0
+
+        sizes = {}
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if os.path.isdir(entry) and not name.endswith('.tmp'):
+                sizes[entry] = sum(
+                    os.path.getsize(os.path.join(entry, artifact))
+                    for artifact in os.listdir(entry))
+        total = sum(sizes.values())
+
+        removed = 0
+        for entry in sorted(sizes, key=os.path.getmtime):
+            if total <= max_bytes:
+                break
+            total -= sizes[entry]
+            shutil.rmtree(entry, ignore_errors=True)
+            removed += 1
+
+        return removed
+
+    def stats(self) -> dict:
+        """
+        Method to report the use of the cache.
+        Returns:
+         -stats (dict): The 'hits' and 'misses' counts.
+        """
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
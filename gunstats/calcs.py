@@ -1,24 +1,43 @@
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import folium
-from selenium import webdriver
-import json
 import os
+from html import escape
+from .cache import ArtifactCache
+from .cube import StateYearCube
+from .geometry import load_geojson, simplify_geojson
+from .instrument import echo, stage
+from .render import BrowserPool
 
+# Directory where the maps are saved
+MAPS_DIR = os.path.join('data', 'maps')
+
+# Initial zoom level of the folium maps
+MAP_ZOOM = 4
+
+# matplotlib, folium and branca take longer to import than most exercises
+# take to run, so they are imported by the functions drawing figures and
+# maps, when first called, rather than with this module
+
+
+@stage
 def print_biggest_handguns(df: pd.DataFrame) -> None:
     """
     Function to print the state and year with the highest number of handguns.
     Args:
-     -df (pd.DataFrame): The dataframe with data grouped by year and state.
+     -df (pd.DataFrame or StateYearCube): The dataframe with data grouped by
+       year and state, or the cube built from it.
     Returns:
      -None
     """
 
     # Find the row with the maximum number of handguns
-    max_handguns_row = df.loc[df['handgun'].idxmax()]
-    state = max_handguns_row['state']
-    year = max_handguns_row['year']
-    handguns = int(max_handguns_row['handgun'])
+    if isinstance(df, StateYearCube):
+        state, year, handguns = df.argmax('handgun')
+    else:
+        max_handguns_row = df.loc[df['handgun'].idxmax()]
+        state = max_handguns_row['state']
+        year = max_handguns_row['year']
+        handguns = int(max_handguns_row['handgun'])
 
     # Print the state and year with the highest number of handguns
     print(
@@ -29,20 +48,25 @@ def print_biggest_handguns(df: pd.DataFrame) -> None:
     return state, year, handguns
 
 
+@stage
 def print_biggest_longguns(df: pd.DataFrame) -> None:
     """
     Function to print the state and year with the highest number of long guns.
     Args:
-     -df (pd.DataFrame): The dataframe with data grouped by year and state.
+     -df (pd.DataFrame or StateYearCube): The dataframe with data grouped by
+       year and state, or the cube built from it.
     Returns:
      -None
     """
 
     # Find the row with the maximum number of long guns
-    max_longguns_row = df.loc[df['long_gun'].idxmax()]
-    state = max_longguns_row['state']
-    year = max_longguns_row['year']
-    longguns = int(max_longguns_row['long_gun'])
+    if isinstance(df, StateYearCube):
+        state, year, longguns = df.argmax('long_gun')
+    else:
+        max_longguns_row = df.loc[df['long_gun'].idxmax()]
+        state = max_longguns_row['state']
+        year = max_longguns_row['year']
+        longguns = int(max_longguns_row['long_gun'])
 
     # Print the state and year with the highest number of long guns
     print(f"Exercise 3 - The state with the highest number of long guns is "
@@ -51,45 +75,72 @@ def print_biggest_longguns(df: pd.DataFrame) -> None:
     return state, year, longguns
 
 
-def time_evolution(df: pd.DataFrame) -> None:
+@stage
+def time_evolution(df: pd.DataFrame, output_files: list = None) -> None:
     """
     Function to create a time evolution graph for the number of permits,
     handguns, and long guns registered each year.
     Args:
-     -df (pd.DataFrame): The dataframe with data grouped by year and state.
+     -df (pd.DataFrame or StateYearCube): The dataframe with data grouped by
+       year and state, or the cube built from it.
+     -output_files (list): The paths to save the graph to, in the format
+       given by their extension (e.g. '.png', '.svg', '.pdf'). The graph is
+       then drawn with the Agg backend and never shown. If None, the graph
+       is shown in a pyplot window.
     Returns:
      -None
     """
 
     # Group by year and sum the values for each year
-    yearly_data = df.groupby('year').sum().reset_index()
+    if isinstance(df, StateYearCube):
+        yearly_data = df.by_year(['permit', 'handgun', 'long_gun'])
+    else:
+        yearly_data = df.groupby('year').sum(numeric_only=True).reset_index()
+
+    # Saved figures do not go through pyplot, so no GUI is ever needed
+    if output_files is None:
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=(12, 6))
+        ax = plt.gca()
+    else:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        figure = Figure(figsize=(12, 6))
+        FigureCanvasAgg(figure)
+        ax = figure.add_subplot()
 
     # Plotting the data
-    plt.figure(figsize=(12, 6))
-    plt.plot(yearly_data['year'], yearly_data['permit'], label='Permits',
-             marker='o')
-    plt.plot(yearly_data['year'], yearly_data['handgun'], label='Handguns',
-             marker='o')
-    plt.plot(yearly_data['year'], yearly_data['long_gun'], label='Long Guns',
-             marker='o')
+    ax.plot(yearly_data['year'], yearly_data['permit'], label='Permits',
+            marker='o')
+    ax.plot(yearly_data['year'], yearly_data['handgun'], label='Handguns',
+            marker='o')
+    ax.plot(yearly_data['year'], yearly_data['long_gun'], label='Long Guns',
+            marker='o')
 
     # Adding titles and labels
-    plt.title('Excersise 4 - Evolution of Permits, Handguns, and Long Guns')
-    plt.xlabel('Year')
-    plt.ylabel('Count')
-    plt.legend()
+    ax.set_title('Excersise 4 - Evolution of Permits, Handguns, and Long Guns')
+    ax.set_xlabel('Year')
+    ax.set_ylabel('Count')
+    ax.legend()
 
-    # Show the plot
-    plt.show()
+    # Show or save the plot
+    if output_files is None:
+        plt.show()
+    else:
+        for output_file in output_files:
+            figure.savefig(output_file)
 
 
+@stage
 def analyze_state_data(df: pd.DataFrame) -> None:
     """
     Function to analyze state data and print the results as specified.
     Args:
-     -df (pd.DataFrame): The dataframe with relative values calculated.
+     -df (pd.DataFrame): The dataframe with relative values calculated. It
+       is not modified: the imputation is done on a copy of 'permit_perc'.
     Returns:
-     -None
+     -old_mean_permit_perc (float): The mean before the imputation.
+     -new_mean_permit_perc (float): The mean after the imputation.
     """
 
     # Calculate and print the mean of permit_perc
@@ -98,14 +149,15 @@ def analyze_state_data(df: pd.DataFrame) -> None:
 
     # Print information about Kentucky
     kentucky_data = df[df['state'] == 'Kentucky']
-    print("Kentucky data:")
-    print(kentucky_data)
+    echo("Kentucky data:")
+    echo(kentucky_data)
 
     # Replace the permit_perc value for Kentucky with the mean
-    df.loc[df['state'] == 'Kentucky', 'permit_perc'] = old_mean_permit_perc
+    permit_perc = df['permit_perc'].mask(df['state'] == 'Kentucky',
+                                         old_mean_permit_perc)
 
     # Recalculate and print the mean of permit_perc
-    new_mean_permit_perc = df['permit_perc'].mean()
+    new_mean_permit_perc = permit_perc.mean()
     print(f"New mean permit_perc: {new_mean_permit_perc:.2f}")
 
     # Print analysis
@@ -120,26 +172,51 @@ def analyze_state_data(df: pd.DataFrame) -> None:
     return old_mean_permit_perc, new_mean_permit_perc
 
 
-def create_choropleth_map(df: pd.DataFrame, column: str, geo_json_path: str,
-                          map_title: str, output_file: str) -> None:
+def map_geometry(geo_json_path: str, tolerance: float = None) -> dict:
     """
-    Function to create a choropleth map for a specific column.
+    Function to get the (cached) geometry drawn on the maps.
+    Args:
+     -geo_json_path (str): The path to the geo JSON file.
+     -tolerance (float): The Douglas-Peucker tolerance, in degrees. If None,
+       the tolerance of the initial zoom level of the maps is used; if 0,
+       the full-resolution geometry.
+    Returns:
+     -geo_data (dict): The geo JSON, shared and read-only.
+    """
+
+    if tolerance is None:
+        return simplify_geojson(geo_json_path, zoom=MAP_ZOOM)
+    if tolerance == 0:
+        return load_geojson(geo_json_path)
+    return simplify_geojson(geo_json_path, tolerance)
+
+
+def save_choropleth_html(df: pd.DataFrame, column: str, geo_json_path: str,
+                         map_title: str, output_file: str,
+                         tolerance: float = None,
+                         output_dir: str = None) -> str:
+    """
+    Function to save a choropleth map for a specific column as an HTML file.
     Args:
      -df (pd.DataFrame): The dataframe with the data.
      -column (str): The column to visualize.
      -geo_json_path (str): The path to the geo JSON file.
      -map_title (str): The title of the map.
-     -output_file (str): The file name to save the map as an image.
+     -output_file (str): The file name to save the map as.
+     -tolerance (float): The simplification tolerance (see map_geometry).
+     -output_dir (str): The directory to save the map in. Defaults to
+       MAPS_DIR.
     Returns:
-     -None
+     -html_file_path (str): The path to the HTML file.
     """
 
+    import folium
+
     # Load GeoJSON data
-    with open(geo_json_path) as f:
-        geo_data = json.load(f)
+    geo_data = map_geometry(geo_json_path, tolerance)
 
     # Create a folium map
-    m = folium.Map(location=[37.8, -96], zoom_start=4)
+    m = folium.Map(location=[37.8, -96], zoom_start=MAP_ZOOM)
 
     # Create the choropleth map
     folium.Choropleth(
@@ -155,24 +232,495 @@ def create_choropleth_map(df: pd.DataFrame, column: str, geo_json_path: str,
     ).add_to(m)
 
     # Ensure the output directory exists
-    output_dir = os.path.join('data', 'maps')
+    output_dir = output_dir or MAPS_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    html_file_path = os.path.join(output_dir, f'{output_file}.html')
+
+    # Save the map as an HTML file
+    m.save(html_file_path)
+
+    return html_file_path
+
+
+def choropleth_bins(values: pd.Series, bins: int = 6) -> tuple:
+    """
+    Function to compute the bin edges and colors of a choropleth the same
+    way folium.Choropleth does: equal-width bins over the non-missing values
+    and a ColorBrewer 'YlGnBu' palette.
+    Args:
+     -values (pd.Series): The values to bin.
+     -bins (int): The number of bins.
+    Returns:
+     -bin_edges (np.ndarray): The bins + 1 edges.
+     -colors (list): The hex color of each bin.
+    """
+
+    from branca.utilities import color_brewer
+
+    real_values = values.dropna().to_numpy(dtype=float)
+    _, bin_edges = np.histogram(real_values, bins=bins)
+
+    return bin_edges, color_brewer('YlGnBu', n=len(bin_edges) - 1)
+
+
+def state_colors(df: pd.DataFrame, column: str) -> tuple:
+    """
+    Function to color the states of a choropleth map like folium: binned
+    with choropleth_bins, the last bin including its upper edge.
+    Args:
+     -df (pd.DataFrame): The dataframe with the data.
+     -column (str): The column to visualize.
+    Returns:
+     -bin_edges (np.ndarray): The bin edges.
+     -colors (list): The hex color of each bin.
+     -state_colors (dict): The hex color of each state with a value.
+    """
+
+    bin_edges, colors = choropleth_bins(df[column])
+    values = df[column].to_numpy(dtype=float, na_value=np.nan)
+    present = ~np.isnan(values)
+    indices = np.minimum(np.searchsorted(bin_edges, values[present],
+                                         side='right') - 1, len(colors) - 1)
+
+    return bin_edges, colors, dict(zip(df['state'][present],
+                                       np.array(colors)[indices].tolist()))
+
+
+def _draw_choropleth(figure, rect: tuple, geo_data: dict, bin_edges, colors,
+                     colored: dict, map_title: str) -> None:
+    """
+    Function to draw a choropleth map and its legend in a region of a
+    matplotlib figure.
+    Args:
+     -figure (matplotlib.figure.Figure): The figure.
+     -rect (tuple): The (left, bottom, width, height) of the region, in
+       figure coordinates.
+     -geo_data (dict): The geo JSON.
+     -bin_edges (np.ndarray): The bin edges (see state_colors).
+     -colors (list): The hex color of each bin.
+     -colored (dict): The hex color of each state with a value.
+     -map_title (str): The title of the map, used as legend caption.
+    Returns:
+     -None
+    """
+
+    from matplotlib.cm import ScalarMappable
+    from matplotlib.collections import PolyCollection
+    from matplotlib.colors import BoundaryNorm, ListedColormap, to_rgba
+
+    # One polygon per ring, colored like folium: states without data in black
+    polygons, face_colors = [], []
+    for feature in geo_data['features']:
+        color = colored.get(feature['properties']['name'], 'black')
+        geometry = feature['geometry']
+        rings = [geometry['coordinates']] if geometry['type'] == 'Polygon' \
+            else geometry['coordinates']
+        for polygon in rings:
+            polygons.append(polygon[0])
+            face_colors.append(color)
+
+    left, bottom, width, height = rect
+    ax = figure.add_axes([left, bottom + 0.12 * height, width, 0.88 * height])
+    ax.add_collection(PolyCollection(
+        polygons, facecolors=[to_rgba(color, 0.7) for color in face_colors],
+        edgecolors=(0, 0, 0, 0.2), linewidths=1))
+
+    # Same view as the folium map, centered on the contiguous states
+    ax.set_xlim(-127, -65)
+    ax.set_ylim(23, 51)
+    ax.set_aspect(1 / np.cos(np.radians(37.8)))
+    ax.set_axis_off()
+
+    # Legend: one step per bin, captioned with the map title
+    legend_ax = figure.add_axes([left + 0.3 * width, bottom + 0.06 * height,
+                                 0.4 * width, 0.03 * height])
+    figure.colorbar(
+        ScalarMappable(norm=BoundaryNorm(bin_edges, len(colors)),
+                       cmap=ListedColormap(colors)),
+        cax=legend_ax, orientation='horizontal', ticks=bin_edges,
+        format='%.1f', label=map_title)
+
+
+def save_choropleth_png(df: pd.DataFrame, column: str, geo_json_path: str,
+                        map_title: str, png_file_path: str,
+                        dpi: int = 100, tolerance: float = None) -> str:
+    """
+    Function to rasterize a choropleth map for a specific column straight
+    from the geo JSON polygons with matplotlib's Agg backend, without a
+    browser. Bins, colors and legend match the folium map.
+    Args:
+     -df (pd.DataFrame): The dataframe with the data.
+     -column (str): The column to visualize.
+     -geo_json_path (str): The path to the geo JSON file.
+     -map_title (str): The title of the map, used as legend caption.
+     -png_file_path (str): The path to save the image to, in the format
+       given by its extension (e.g. '.png', '.svg', '.pdf').
+     -dpi (int): The resolution of the image.
+     -tolerance (float): The simplification tolerance (see map_geometry).
+    Returns:
+     -png_file_path (str): The path to the image.
+    """
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(12, 7))
+    FigureCanvasAgg(figure)
+    _draw_choropleth(figure, (0, 0, 1, 1),
+                     map_geometry(geo_json_path, tolerance),
+                     *state_colors(df, column), map_title)
+    figure.savefig(png_file_path, dpi=dpi)
+
+    return png_file_path
+
+
+# Script of the layered choropleth maps: the geometry is embedded once and
+# every layer styles it from its own state colors
+_LAYERS_SCRIPT = """
+{% macro script(this, kwargs) %}
+    var {{ this.get_name() }}_geo = {{ this.geo_data|tojson }};
+    var {{ this.get_name() }}_layers = {};
+    var {{ this.get_name() }}_legends = {};
+    {% for layer in this.layers %}
+    {{ this.get_name() }}_layers[{{ layer.title|tojson }}] = L.geoJson(
+        {{ this.get_name() }}_geo, {style: function (feature) {
+            var colors = {{ layer.colors|tojson }};
+            return {fillColor: colors[feature.properties.name] || 'black',
+                    fillOpacity: 0.7, color: 'black', weight: 1,
+                    opacity: 0.2};
+        }});
+    {{ this.get_name() }}_legends[{{ layer.title|tojson }}] =
+        {{ layer.legend|tojson }};
+    {% endfor %}
+
+    var {{ this.get_name() }}_legend = L.control({position: 'topright'});
+    {{ this.get_name() }}_legend.onAdd = function (map) {
+        this._div = L.DomUtil.create('div', 'legend');
+        this._div.style.background = 'white';
+        this._div.style.padding = '6px';
+        return this._div;
+    };
+    {{ this.get_name() }}_legend.addTo({{ this._parent.get_name() }});
+    {{ this._parent.get_name() }}.on('baselayerchange', function (e) {
+        {{ this.get_name() }}_legend._div.innerHTML =
+            {{ this.get_name() }}_legends[e.name];
+    });
+
+    {{ this.get_name() }}_layers[{{ this.layers[0].title|tojson }}]
+        .addTo({{ this._parent.get_name() }});
+    {{ this.get_name() }}_legend._div.innerHTML =
+        {{ this.get_name() }}_legends[{{ this.layers[0].title|tojson }}];
+    L.control.layers({{ this.get_name() }}_layers, {}, {collapsed: false})
+        .addTo({{ this._parent.get_name() }});
+{% endmacro %}
+"""
+
+
+def _legend_html(bin_edges, colors, map_title: str) -> str:
+    """
+    Function to build the HTML legend of a layer of a layered map: one
+    colored step per bin between its edges, captioned with the map title.
+    Args:
+     -bin_edges (np.ndarray): The bin edges.
+     -colors (list): The hex color of each bin.
+     -map_title (str): The title of the map.
+    Returns:
+     -html (str): The legend.
+    """
+
+    steps = ''.join(
+        f'<span style="display:inline-block;width:60px;text-align:left">'
+        f'<i style="display:block;height:10px;background:{color};'
+        f'opacity:0.7"></i>{edge:.1f}</span>'
+        for color, edge in zip(colors, bin_edges))
+
+    return f'<b>{escape(map_title)}</b><br>{steps}{bin_edges[-1]:.1f}'
+
+
+def save_layered_choropleth_html(df: pd.DataFrame, maps: list,
+                                 geo_json_path: str, output_file: str,
+                                 tolerance: float = None,
+                                 output_dir: str = None) -> str:
+    """
+    Function to save the choropleth maps of several columns as the
+    switchable layers of a single HTML file, which embeds the geometry once
+    instead of once per map.
+    Args:
+     -df (pd.DataFrame): The dataframe with the data.
+     -maps (list): The (column, map_title) of each layer, the first one
+       shown initially.
+     -geo_json_path (str): The path to the geo JSON file.
+     -output_file (str): The file name to save the map as.
+     -tolerance (float): The simplification tolerance (see map_geometry).
+     -output_dir (str): The directory to save the map in. Defaults to
+       MAPS_DIR.
+    Returns:
+     -html_file_path (str): The path to the HTML file.
+    """
+
+    import folium
+    from branca.element import MacroElement
+    from jinja2 import Template
+
+    layers = []
+    for column, map_title in maps:
+        bin_edges, colors, colored = state_colors(df, column)
+        # Leaflet shows the layer names as HTML too
+        layers.append({'title': escape(map_title), 'colors': colored,
+                       'legend': _legend_html(bin_edges, colors, map_title)})
+
+    m = folium.Map(location=[37.8, -96], zoom_start=MAP_ZOOM)
+    element = MacroElement()
+    element._name = 'ChoroplethLayers'
+    element._template = Template(_LAYERS_SCRIPT)
+    element.geo_data = map_geometry(geo_json_path, tolerance)
+    element.layers = layers
+    m.add_child(element)
+
+    # Ensure the output directory exists
+    output_dir = output_dir or MAPS_DIR
     os.makedirs(output_dir, exist_ok=True)
     html_file_path = os.path.join(output_dir, f'{output_file}.html')
 
     # Save the map as an HTML file
     m.save(html_file_path)
 
-    # Use Selenium to open the HTML file and save as PNG
-    options = webdriver.ChromeOptions()
-    options.add_argument('--headless')
-    driver = webdriver.Chrome(options=options)
-    driver.get(f'file://{os.path.abspath(html_file_path)}')
+    return html_file_path
+
+
+def save_layered_choropleth_png(df: pd.DataFrame, maps: list,
+                                geo_json_path: str, png_file_path: str,
+                                dpi: int = 100,
+                                tolerance: float = None) -> str:
+    """
+    Function to rasterize the choropleth maps of several columns side by
+    side in a single image, with matplotlib's Agg backend.
+    Args:
+     -df (pd.DataFrame): The dataframe with the data.
+     -maps (list): The (column, map_title) of each map.
+     -geo_json_path (str): The path to the geo JSON file.
+     -png_file_path (str): The path to save the image to, in the format
+       given by its extension (e.g. '.png', '.svg', '.pdf').
+     -dpi (int): The resolution of the image.
+     -tolerance (float): The simplification tolerance (see map_geometry).
+    Returns:
+     -png_file_path (str): The path to the image.
+    """
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    geo_data = map_geometry(geo_json_path, tolerance)
+
+    # At most three maps per row, each panel the size of a single map
+    columns = min(len(maps), 3)
+    rows = -(-len(maps) // columns)
+    figure = Figure(figsize=(12 * columns, 7 * rows))
+    FigureCanvasAgg(figure)
+    for i, (column, map_title) in enumerate(maps):
+        row, position = divmod(i, columns)
+        _draw_choropleth(figure, (position / columns, 1 - (row + 1) / rows,
+                                  1 / columns, 1 / rows),
+                         geo_data, *state_colors(df, column), map_title)
+    figure.savefig(png_file_path, dpi=dpi)
+
+    return png_file_path
+
 
-    # Give the map some time to render
-    driver.implicitly_wait(5)
-    print("Rendering image... may take a few seconds...")
+def create_choropleth_map(df: pd.DataFrame, column: str, geo_json_path: str,
+                          map_title: str, output_file: str,
+                          pool: BrowserPool = None,
+                          backend: str = 'browser',
+                          html: bool = True,
+                          tolerance: float = None,
+                          output_dir: str = None,
+                          image_formats: tuple = ('png',),
+                          cache: ArtifactCache = None) -> None:
+    """
+    Function to create a choropleth map for a specific column.
+    Args:
+     -df (pd.DataFrame): The dataframe with the data.
+     -column (str): The column to visualize.
+     -geo_json_path (str): The path to the geo JSON file.
+     -map_title (str): The title of the map.
+     -output_file (str): The file name to save the map as an image.
+     -pool (BrowserPool): The pool of browsers used to save the image. If
+       None, a browser is started for this map only.
+     -backend (str): 'browser' to screenshot the folium map, or
+       'matplotlib' to rasterize the image without a browser.
+     -html (bool): With the 'matplotlib' backend, whether to also save the
+       folium HTML map. The 'browser' backend always saves it.
+     -tolerance (float): The simplification tolerance (see map_geometry).
+     -output_dir (str): The directory to save the map in. Defaults to
+       MAPS_DIR.
+     -image_formats (tuple): The image formats to save. The 'browser'
+       backend only saves 'png'; the 'matplotlib' backend any format
+       supported by matplotlib (e.g. 'png', 'svg', 'pdf').
+     -cache (ArtifactCache): If given, the map is only rendered when no
+       map of the same values, geometry and styling is cached; otherwise
+       the cached files are copied to the output directory.
+    Returns:
+     -None
+    """
+
+    create_choropleth_maps(df, [(column, map_title, output_file)],
+                           geo_json_path, pool, backend, html, tolerance,
+                           output_dir, image_formats, cache)
+
+
+@stage
+def create_choropleth_maps(df: pd.DataFrame, maps: list, geo_json_path: str,
+                           pool: BrowserPool = None,
+                           backend: str = 'browser',
+                           html: bool = True,
+                           tolerance: float = None,
+                           output_dir: str = None,
+                           image_formats: tuple = ('png',),
+                           cache: ArtifactCache = None) -> None:
+    """
+    Function to create several choropleth maps. With the 'browser' backend,
+    every HTML file is saved first and then all the images are rendered
+    concurrently in a pool of browsers.
+    Args:
+     -df (pd.DataFrame): The dataframe with the data.
+     -maps (list): The (column, map_title, output_file) of each map.
+     -geo_json_path (str): The path to the geo JSON file.
+     -pool (BrowserPool): The pool of browsers used to save the images. If
+       None, a pool with one browser per map is used for these maps only.
+     -backend (str): 'browser' or 'matplotlib' (see create_choropleth_map).
+     -html (bool): With the 'matplotlib' backend, whether to also save the
+       folium HTML maps.
+     -tolerance (float): The simplification tolerance (see map_geometry).
+     -output_dir (str): The directory to save the maps in. Defaults to
+       MAPS_DIR.
+     -image_formats (tuple): The image formats to save (see
+       create_choropleth_map).
+     -cache (ArtifactCache): The cache of the rendered maps (see
+       create_choropleth_map).
+    Returns:
+     -None
+    """
+
+    if backend not in ('browser', 'matplotlib'):
+        raise ValueError(f"Unknown map backend: {backend}")
+    if backend == 'browser' and set(image_formats) - {'png'}:
+        raise ValueError("The browser backend only saves 'png' images")
+
+    output_dir = output_dir or MAPS_DIR
+    jobs = []
+    rendered = []
+    for column, map_title, output_file in maps:
+        png_file_path = os.path.join(output_dir, f'{output_file}.png')
+
+        # Unchanged maps are copied from the cache instead of rendered
+        if cache is not None:
+            extensions = (['html'] if backend == 'browser' or html else []) \
+                + list(image_formats)
+            paths = [os.path.join(output_dir, f'{output_file}.{extension}')
+                     for extension in extensions]
+            key = cache.key(df[['state', column]], [geo_json_path],
+                            map_title=map_title, backend=backend,
+                            tolerance=tolerance, zoom=MAP_ZOOM)
+            if cache.get(key, paths):
+                continue
+            rendered.append((key, paths))
+
+        if backend == 'browser' or html:
+            html_file_path = save_choropleth_html(df, column, geo_json_path,
+                                                  map_title, output_file,
+                                                  tolerance, output_dir)
+            if image_formats:
+                jobs.append((html_file_path, png_file_path))
+        if backend == 'matplotlib':
+            os.makedirs(output_dir, exist_ok=True)
+            for image_format in image_formats:
+                save_choropleth_png(
+                    df, column, geo_json_path, map_title,
+                    os.path.join(output_dir, f'{output_file}.{image_format}'),
+                    tolerance=tolerance)
+
+    if backend == 'browser' and jobs:
+        if pool is None:
+            with BrowserPool(size=len(jobs)) as pool:
+                pool.render_many(jobs)
+        else:
+            pool.render_many(jobs)
+
+    for key, paths in rendered:
+        cache.put(key, paths)
+
+
+@stage
+def create_layered_choropleth_map(df: pd.DataFrame, maps: list,
+                                  geo_json_path: str, output_file: str,
+                                  pool: BrowserPool = None,
+                                  backend: str = 'browser',
+                                  html: bool = True,
+                                  tolerance: float = None,
+                                  output_dir: str = None,
+                                  image_formats: tuple = ('png',),
+                                  cache: ArtifactCache = None) -> None:
+    """
+    Function to create the choropleth maps of several columns as a single
+    map with one switchable layer per column, sharing the geometry.
+    Args:
+     -df (pd.DataFrame): The dataframe with the data.
+     -maps (list): The (column, map_title) of each layer.
+     -geo_json_path (str): The path to the geo JSON file.
+     -output_file (str): The file name to save the map as.
+     -pool (BrowserPool): The pool of browsers used to save the image (see
+       create_choropleth_map).
+     -backend (str): 'browser' to screenshot the HTML map, which shows its
+       first layer, or 'matplotlib' to draw every layer side by side.
+     -html (bool): With the 'matplotlib' backend, whether to also save the
+       HTML map. The 'browser' backend always saves it.
+     -tolerance (float): The simplification tolerance (see map_geometry).
+     -output_dir (str): The directory to save the map in. Defaults to
+       MAPS_DIR.
+     -image_formats (tuple): The image formats to save (see
+       create_choropleth_map).
+     -cache (ArtifactCache): The cache of the rendered maps (see
+       create_choropleth_map).
+    Returns:
+     -None
+    """
 
-    # Save the screenshot
-    png_file_path = os.path.join(output_dir, f'{output_file}.png')
-    driver.save_screenshot(png_file_path)
-    driver.quit()
+    if backend not in ('browser', 'matplotlib'):
+        raise ValueError(f"Unknown map backend: {backend}")
+    if backend == 'browser' and set(image_formats) - {'png'}:
+        raise ValueError("The browser backend only saves 'png' images")
+
+    output_dir = output_dir or MAPS_DIR
+    save_html = backend == 'browser' or html
+    extensions = (['html'] if save_html else []) + list(image_formats)
+    paths = [os.path.join(output_dir, f'{output_file}.{extension}')
+             for extension in extensions]
+
+    # An unchanged map is copied from the cache instead of rendered
+    if cache is not None:
+        key = cache.key(df[['state'] + [column for column, _ in maps]],
+                        [geo_json_path], titles=[title for _, title in maps],
+                        backend=backend, tolerance=tolerance, zoom=MAP_ZOOM)
+        if cache.get(key, paths):
+            return
+
+    if save_html:
+        html_file_path = save_layered_choropleth_html(
+            df, maps, geo_json_path, output_file, tolerance, output_dir)
+    if backend == 'matplotlib':
+        os.makedirs(output_dir, exist_ok=True)
+        for image_format in image_formats:
+            save_layered_choropleth_png(
+                df, maps, geo_json_path,
+                os.path.join(output_dir, f'{output_file}.{image_format}'),
+                tolerance=tolerance)
+    elif image_formats:
+        png_file_path = os.path.join(output_dir, f'{output_file}.png')
+        if pool is None:
+            with BrowserPool(size=1) as pool:
+                pool.render_many([(html_file_path, png_file_path)])
+        else:
+            pool.render_many([(html_file_path, png_file_path)])
+
+    if cache is not None:
+        cache.put(key, paths)
@@ -0,0 +1,288 @@
+import numpy as np
+import pandas as pd
+
+
+def align_population(table: pd.DataFrame, states: list,
+                     years: list) -> np.ndarray:
+    """
+    Function to align a population table (see etl.population_table) with
+    lists of states and years. Years missing from the table take the
+    population of the closest year in it (the earlier one on a tie), so a
+    single-year table applies to every year.
+    Args:
+     -table (pd.DataFrame): The populations, indexed by state, with one
+       column per year.
+     -states (list): The states.
+     -years (list): The years.
+    Returns:
+     -population (np.ndarray): The population of every (state, year), NaN
+       for states missing from the table.
+    """
+
+    table_years = np.asarray(table.columns, dtype=float)
+    years = np.asarray(years, dtype=float)
+
+    # Closest table year of every year
+    after = np.clip(np.searchsorted(table_years, years), 0,
+                    len(table_years) - 1)
+    before = np.clip(after - 1, 0, len(table_years) - 1)
+    closest = np.where(np.abs(table_years[before] - years)
+                       <= np.abs(table_years[after] - years), before, after)
+
+    return table.reindex(states).to_numpy(dtype=float)[:, closest]
+
+
+class StateYearCube:
+    """
+    Class that materializes the (year, state) totals as a dense integer
+    ndarray indexed by state, year and metric, with a label map for each
+    axis. Lookups are O(1) and slices or reductions are numpy axis
+    operations, instead of pandas scans and groupbys.
+    """
+
+    def __init__(self, values: np.ndarray, states: list, years: list,
+                 metrics: list, present: np.ndarray = None):
+        self.values = values
+        self.states = list(states)
+        self.years = list(years)
+        self.metrics = list(metrics)
+        self.present = present if present is not None \
+            else np.ones(values.shape[:2], dtype=bool)
+
+        # Label maps of the axes
+        self.state_index = {state: i for i, state in enumerate(self.states)}
+        self.year_index = {year: i for i, year in enumerate(self.years)}
+        self.metric_index = {metric: i for i, metric in enumerate(self.metrics)}
+
+    @classmethod
+    def from_grouped(cls, df: pd.DataFrame, metrics: list = None):
+        """
+        Method to build the cube from the (year, state) totals.
+        Args:
+         -df (pd.DataFrame): The dataframe with data grouped by year and
+           state.
+         -metrics (list): The metric columns. Defaults to every numeric
+           column but 'year'.
+        Returns:
+         -cube (StateYearCube): The cube. Missing (state, year) cells and
+           missing counts are 0.
+        """
+
+        if metrics is None:
+            metrics = [column for column in df.columns
+                       if column not in ('year', 'state', 'month')
+                       and pd.api.types.is_numeric_dtype(df[column])]
+
+        state_codes, states = pd.factorize(df['state'], sort=True)
+        year_codes, years = pd.factorize(df['year'], sort=True)
+
+        values = np.zeros((len(states), len(years), len(metrics)),
+                          dtype=np.int64)
+        values[state_codes, year_codes] = \
+            df[metrics].fillna(0).to_numpy(dtype=np.int64)
+        present = np.zeros((len(states), len(years)), dtype=bool)
+        present[state_codes, year_codes] = True
+
+        return cls(values, list(states), [int(year) for year in years],
+                   metrics, present)
+
+    def value(self, state: str, year: int, metric: str) -> int:
+        """
+        Method to look up a single total.
+        Args:
+         -state (str): The state.
+         -year (int): The year.
+         -metric (str): The metric.
+        Returns:
+         -value (int): The total of the metric in the state and year.
+        """
+
+        return self.values[self.state_index[state], self.year_index[year],
+                           self.metric_index[metric]].item()
+
+    def metric(self, metric: str) -> np.ndarray:
+        """
+        Method to slice the (state, year) matrix of a metric.
+        Args:
+         -metric (str): The metric.
+        Returns:
+         -matrix (np.ndarray): A view of the totals, indexed by state and
+           year.
+        """
+
+        return self.values[:, :, self.metric_index[metric]]
+
+    def argmax(self, metric: str) -> tuple:
+        """
+        Method to find the state and year with the highest total of a metric.
+        Ties are broken in (year, state) order, as idxmax on the grouped
+        dataframe does.
+        Args:
+         -metric (str): The metric.
+        Returns:
+         -state (str): The state.
+         -year (int): The year.
+         -value (int): The total.
+        """
+
+        year, state = np.unravel_index(self.metric(metric).T.argmax(),
+                                       (len(self.years), len(self.states)))
+
+        return (self.states[state], self.years[year],
+                self.values[state, year, self.metric_index[metric]].item())
+
+    def per_capita(self, table: pd.DataFrame, per: float = 100):
+        """
+        Method to compute the per-capita rates of every metric in every
+        state and year in a single broadcast division.
+        Args:
+         -table (pd.DataFrame): The populations, indexed by state, with one
+           column per year (see align_population).
+         -per (float): The rates are counts per `per` inhabitants; 100
+           gives percentages, as calculate_relative_values.
+        Returns:
+         -cube (StateYearCube): A cube with the same axes and float rates,
+           NaN for the states without population.
+        """
+
+        population = align_population(table, self.states, self.years)
+        rates = self.values * per / population[:, :, None]
+
+        return StateYearCube(rates, self.states, self.years, self.metrics,
+                             self.present)
+
+    def top_k(self, k: int = 1, by: str = None,
+              metrics: list = None) -> pd.DataFrame:
+        """
+        Method to find the k (state, year) cells with the highest totals of
+        every metric in a single vectorized pass, using partial selection
+        (np.argpartition) and sorting only the k selected cells.
+        Args:
+         -k (int): The number of cells kept per metric (and group).
+         -by (str): None for the overall top-k, 'year' for the top-k states
+           of every year, or 'state' for the top-k years of every state.
+         -metrics (list): The metrics. Defaults to every metric.
+        Returns:
+         -df (pd.DataFrame): One row per selected cell, with the 'metric',
+           the 'rank' (1 = highest) within the metric and group, the
+           'state', the 'year' and the 'value'. Ties are ranked in
+           (year, state) order. Cells without data (absent from the totals,
+           or without a rate) are never selected, so a group may have fewer
+           than k rows.
+        Raises:
+         -ValueError: If k is lower than 1 or `by` is unknown.
+        """
+
+        if k < 1:
+            raise ValueError(f"top_k needs k >= 1, got {k}")
+        if by not in (None, 'year', 'state'):
+            raise ValueError(f"Unknown top_k breakdown: {by}")
+
+        metrics = metrics or self.metrics
+        values = self.values[:, :, [self.metric_index[m] for m in metrics]]
+
+        # Cells without data rank below every other cell, and are dropped
+        missing = np.broadcast_to(~self.present[:, :, None], values.shape)
+        if values.dtype.kind == 'f':
+            missing = missing | np.isnan(values)
+        keys = np.where(missing, -np.inf, values) if missing.any() \
+            else values
+
+        # Arrange the totals as (group, candidate, metric)
+        def arrange(array):
+            if by is None:
+                return array.transpose(1, 0, 2).reshape(1, -1, len(metrics))
+            if by == 'year':
+                return array.transpose(1, 0, 2)
+            return array
+
+        values, keys, missing = arrange(values), arrange(keys), \
+            arrange(missing)
+        k = min(k, values.shape[1])
+
+        # Partial selection of the k largest candidates, then a sort of
+        # those k only (by value, then by position to break ties)
+        if k < values.shape[1]:
+            selected = np.argpartition(-keys, k - 1, axis=1)[:, :k]
+        else:
+            selected = np.broadcast_to(
+                np.arange(k)[None, :, None], values.shape).copy()
+        selected_keys = np.take_along_axis(keys, selected, axis=1)
+        order = np.lexsort((selected, -selected_keys), axis=1)
+        selected = np.take_along_axis(selected, order, axis=1)
+        selected_values = np.take_along_axis(values, selected, axis=1)
+        selected_missing = np.take_along_axis(missing, selected, axis=1)
+
+        # Map (group, candidate) back to (state, year)
+        group = np.broadcast_to(
+            np.arange(values.shape[0])[:, None, None], selected.shape)
+        if by is None:
+            year, state = np.divmod(selected, len(self.states))
+        elif by == 'year':
+            year, state = group, selected
+        else:
+            state, year = group, selected
+
+        # One block per metric, then group, then rank
+        def flat(array):
+            return np.broadcast_to(array, selected.shape) \
+                .transpose(2, 0, 1).ravel()
+
+        df = pd.DataFrame({
+            'metric': flat(np.asarray(metrics, dtype=object)),
+            'rank': flat(np.arange(1, k + 1)[None, :, None]),
+            'state': flat(np.asarray(self.states, dtype=object)[state]),
+            'year': flat(np.asarray(self.years)[year]),
+            'value': flat(selected_values),
+        })
+
+        return df[~flat(selected_missing)].reset_index(drop=True)
+
+    def by_year(self, metrics: list = None) -> pd.DataFrame:
+        """
+        Method to sum the totals of every state by year.
+        Args:
+         -metrics (list): The metrics. Defaults to every metric.
+        Returns:
+         -df (pd.DataFrame): The yearly totals, with a 'year' column.
+        """
+
+        metrics = metrics or self.metrics
+        indices = [self.metric_index[metric] for metric in metrics]
+        df = pd.DataFrame(self.values[:, :, indices].sum(axis=0),
+                          columns=metrics)
+        df.insert(0, 'year', self.years)
+
+        return df
+
+    def by_state(self, metrics: list = None) -> pd.DataFrame:
+        """
+        Method to sum the totals of every year by state.
+        Args:
+         -metrics (list): The metrics. Defaults to every metric.
+        Returns:
+         -df (pd.DataFrame): The state totals, with a 'state' column.
+        """
+
+        metrics = metrics or self.metrics
+        indices = [self.metric_index[metric] for metric in metrics]
+        df = pd.DataFrame(self.values[:, :, indices].sum(axis=1),
+                          columns=metrics)
+        df.insert(0, 'state', self.states)
+
+        return df
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Method to convert the cube back to (year, state) totals.
+        Returns:
+         -df (pd.DataFrame): The totals of the present (state, year) cells,
+           sorted by year and state.
+        """
+
+        state, year = np.nonzero(self.present.T)[::-1]
+        df = pd.DataFrame(self.values[state, year], columns=self.metrics)
+        df.insert(0, 'state', np.asarray(self.states, dtype=object)[state])
+        df.insert(0, 'year', np.asarray(self.years)[year])
+
+        return df
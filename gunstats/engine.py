@@ -0,0 +1,234 @@
+import csv
+import os
+import pandas as pd
+
+# Columnar engines the ETL functions can run on. Both take and return pandas
+# DataFrames; the 'arrow' engine computes with pyarrow in between.
+ENGINES = ('pandas', 'arrow')
+
+# Engine used when none is given. It can be set from the environment.
+_engine = os.environ.get('GUNSTATS_ENGINE', 'pandas')
+
+
+def set_engine(engine: str = 'pandas') -> None:
+    """
+    Function to set the engine used by the ETL functions when none is given.
+    Args:
+     -engine (str): 'pandas' or 'arrow'.
+    Returns:
+     -None
+    """
+
+    global _engine
+    _engine = resolve_engine(engine)
+
+
+def resolve_engine(engine: str = None) -> str:
+    """
+    Function to resolve the engine of a call.
+    Args:
+     -engine (str): The engine, or None for the one set with set_engine.
+    Returns:
+     -engine (str): 'pandas' or 'arrow'.
+    Raises:
+     -ValueError: If the engine is unknown.
+     -ImportError: If the 'arrow' engine is selected without pyarrow.
+    """
+
+    engine = engine or _engine
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine: {engine}")
+    if engine == 'arrow':
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("The 'arrow' engine needs pyarrow "
+                              "(pip install -e .[cache])")
+
+    return engine
+
+
+def arrow_read_csv(url: str, columns: tuple = None,
+                   dictionary: tuple = ()) -> pd.DataFrame:
+    """
+    Function to parse a csv file with pyarrow's multithreaded reader, with
+    the dtypes pandas.read_csv would infer: integer columns with blanks
+    become float64 and blank strings are missing.
+    Args:
+     -url (str): The path to the file.
+     -columns (tuple): If set, only these columns are parsed.
+     -dictionary (tuple): The columns parsed as categoricals.
+    Returns:
+     -df (pd.DataFrame): The parsed file.
+    """
+
+    import pyarrow
+    import pyarrow.csv as pcsv
+
+    with open(url, newline='') as f:
+        header = next(csv.reader(f))
+    if columns is not None:
+        header = [column for column in header if column in columns]
+
+    table = pcsv.read_csv(url, convert_options=pcsv.ConvertOptions(
+        include_columns=header, strings_can_be_null=True,
+        column_types={column: pyarrow.dictionary(pyarrow.int32(),
+                                                 pyarrow.string())
+                      for column in dictionary if column in header}))
+    schema = table.schema
+    df = table.to_pandas()
+    del table
+    pyarrow.default_memory_pool().release_unused()
+
+    # Columns without any value are parsed as floats by pandas
+    blank = [field.name for field in schema
+             if pyarrow.types.is_null(field.type)]
+    if blank:
+        df = df.astype({column: 'float64' for column in blank})
+
+    return df
+
+
+def _to_table(df: pd.DataFrame, keys: list = ()):
+    """
+    Function to convert a DataFrame to an Arrow table, dictionary-encoding
+    its string and categorical key columns so they are grouped and joined
+    by integer codes.
+    Args:
+     -df (pd.DataFrame): The dataframe.
+     -keys (list): The key columns.
+    Returns:
+     -table (pyarrow.Table): The table.
+    """
+
+    import pyarrow
+    import pyarrow.compute as pc
+
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    for key in keys:
+        column = table[key]
+        if pyarrow.types.is_string(column.type) \
+                or pyarrow.types.is_large_string(column.type):
+            table = table.set_column(table.schema.get_field_index(key), key,
+                                     pc.dictionary_encode(column))
+
+    return table
+
+
+def arrow_groupby_sum(df: pd.DataFrame, keys: list) -> pd.DataFrame:
+    """
+    Function to sum every other column by the key columns with
+    pyarrow.Table.group_by, as df.groupby(keys, observed=True).sum()
+    .reset_index() does.
+    Args:
+     -df (pd.DataFrame): The dataframe. Its other columns are numeric.
+     -keys (list): The key columns.
+    Returns:
+     -df (pd.DataFrame): One row per group, sorted by the keys, with the
+       dtypes of the pandas engine.
+    """
+
+    import pyarrow.compute as pc
+
+    values = [column for column in df.columns if column not in keys]
+    table = _to_table(df, keys).group_by(keys, use_threads=False).aggregate(
+        [(column, 'sum', pc.ScalarAggregateOptions(min_count=0))
+         for column in values])
+    grouped_df = table.rename_columns(
+        [name[:-len('_sum')] if name.endswith('_sum') else name
+         for name in table.column_names]).to_pandas()
+
+    # Keys and nullable counts come back with their original dtypes
+    grouped_df = grouped_df[keys + values].astype(
+        {column: df[column].dtype for column in keys + values
+         if column in keys
+         or isinstance(df[column].dtype, pd.api.extensions.ExtensionDtype)})
+
+    return grouped_df.sort_values(keys, ignore_index=True)
+
+
+def _plain_key(table, key: str):
+    """
+    Function to decode a dictionary-encoded key column of an Arrow table.
+    Args:
+     -table (pyarrow.Table): The table.
+     -key (str): The key column.
+    Returns:
+     -table (pyarrow.Table): The table, with the key as plain values.
+    """
+
+    import pyarrow
+
+    if pyarrow.types.is_dictionary(table[key].type):
+        table = table.set_column(table.schema.get_field_index(key), key,
+                                 table[key].cast(table[key].type.value_type))
+
+    return table
+
+
+def arrow_merge(df: pd.DataFrame, other: pd.DataFrame,
+                on: str) -> pd.DataFrame:
+    """
+    Function to inner-join two dataframes on a key column with
+    pyarrow.Table.join, in the row order of pandas.merge: the order of the
+    left rows, then of the right rows.
+    Args:
+     -df (pd.DataFrame): The left dataframe.
+     -other (pd.DataFrame): The right dataframe.
+     -on (str): The key column.
+    Returns:
+     -df (pd.DataFrame): The merged dataframe.
+    """
+
+    import numpy as np
+    import pyarrow
+
+    # Join on plain strings, whichever side is categorical
+    left, right = (
+        _plain_key(_to_table(frame), on).append_column(
+            row, pyarrow.array(np.arange(len(frame))))
+        for frame, row in ((df, '__left'), (other, '__right')))
+
+    joined = left.join(right, on, join_type='inner', left_suffix='_x',
+                       right_suffix='_y', use_threads=False) \
+        .sort_by([('__left', 'ascending'), ('__right', 'ascending')])
+
+    merged_df = joined.drop_columns(['__left', '__right']).to_pandas()
+
+    # Nullable counts come back with their original dtypes
+    dtypes = {**other.dtypes.to_dict(), **df.dtypes.to_dict()}
+    return merged_df.astype(
+        {column: dtypes[column] for column in merged_df.columns
+         if column != on and column in dtypes
+         and isinstance(dtypes[column], pd.api.extensions.ExtensionDtype)})
+
+
+def arrow_relative_values(df: pd.DataFrame, columns: dict,
+                          population: str) -> pd.DataFrame:
+    """
+    Function to compute per-100-inhabitants values with pyarrow.compute.
+    Args:
+     -df (pd.DataFrame): The dataframe with the counts and population.
+     -columns (dict): The relative column to compute for each count column.
+     -population (str): The population column.
+    Returns:
+     -df (pd.DataFrame): A new dataframe with the relative columns added.
+    """
+
+    import pyarrow
+    import pyarrow.compute as pc
+
+    table = pyarrow.Table.from_pandas(
+        df[list(columns) + [population]], preserve_index=False)
+    table = table.cast(pyarrow.schema(
+        [(name, pyarrow.float64()) for name in table.column_names]))
+
+    # Nullable counts give nullable floats, as in pandas
+    return df.assign(**{
+        relative: pd.array(
+            pc.divide(pc.multiply(table[count], 100),
+                      table[population]).to_numpy(),
+            dtype='Float64' if isinstance(
+                df[count].dtype, pd.api.extensions.ExtensionDtype)
+            else 'float64')
+        for count, relative in columns.items()})
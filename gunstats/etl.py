@@ -1,26 +1,157 @@
+import numpy as np
 import pandas as pd
+from .cache import cached_read
+from .cube import StateYearCube
+from .engine import resolve_engine, arrow_read_csv, arrow_groupby_sum, \
+    arrow_merge, arrow_relative_values
+from .instrument import echo, stage
+
+# Columns of the NICS file that are not counts
+KEY_COLUMNS = ('month', 'year', 'state')
+
+# Columns of the NICS file used by the pipeline ('longgun' is the older
+# spelling of 'long_gun', fixed by rename_col)
+NICS_COLUMNS = ['month', 'state', 'permit', 'handgun', 'long_gun', 'longgun']
+
+# Compact dtypes for the NICS columns: counts are blank for some early months,
+# so they are stored as nullable integers instead of float64 (see
+# compact_counts), and 'month' is stored as a monthly period
+NICS_DTYPES = {
+    'month': 'period[M]',
+    'state': 'category',
+    'permit': 'Int32',
+    'handgun': 'Int32',
+    'long_gun': 'Int32',
+    'longgun': 'Int32',
+}
+
+# NICS territories, in neither the population nor the geo JSON file. Their
+# rows are valid, and only removed from the per-capita stages by clean_states
+TERRITORIES = ['Guam', 'Mariana Islands', 'Puerto Rico', 'Virgin Islands']
+
+# Number of counts checked at once by validate_rows: 512 KB of float64, so
+# the checks of a chunk read it from the CPU cache
+VALIDATION_CHUNK = 1 << 16
+
+# Reasons a row is quarantined by validate_rows, in the order they are listed
+QUARANTINE_REASONS = ('missing state', 'unknown state', 'invalid month',
+                      'negative count', 'non-integer count')
+
+
+def _parse_csv(url: str, compact: bool = False, columns: tuple = None,
+               engine: str = 'pandas') -> pd.DataFrame:
+    """
+    Function to parse a csv file into a pandas DataFrame.
+    Args:
+     -url (str): The path to the file.
+     -compact (bool): If True, parse the file as a NICS extract (see
+       read_csv).
+     -columns (tuple): If set, only these columns are parsed.
+     -engine (str): The engine parsing the file, 'pandas' or 'arrow'.
+    Returns:
+     -df (pd.DataFrame): The csv file converted to a DataFrame.
+    """
 
+    if not compact:
+        if engine == 'arrow':
+            return arrow_read_csv(url, columns)
+        if columns is None:
+            return pd.read_csv(url)
+        return pd.read_csv(url, usecols=lambda c: c in columns)
+
+    # Parsing straight into nullable integers and periods is several times
+    # slower than the default parsers, so the counts are parsed as floats
+    # and cast afterwards, and 'month' is parsed as a categorical so that
+    # each distinct month is converted to a period only once
+    columns = NICS_COLUMNS if columns is None else columns
+    if engine == 'arrow':
+        df = arrow_read_csv(url, columns, dictionary=('month', 'state'))
+    else:
+        df = pd.read_csv(url, usecols=lambda c: c in columns,
+                         dtype={'month': 'category', 'state': 'category'})
+    df = compact_counts(df)
+    if 'month' in df.columns:
+        # Malformed months become NaT, to be quarantined by validate_rows
+        months = df['month'].cat
+        valid = _year_month(months.categories.to_series())[2]
+        periods = pd.PeriodIndex(months.categories.where(valid), freq='M')
+        df['month'] = periods.array.take(months.codes.to_numpy(),
+                                         allow_fill=True)
+
+    return df
+
+
+def compact_counts(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Function to store the numeric count columns of a dataframe (parsed as
+    float64 by pandas when they have blanks) as nullable integers: Int32, or
+    Int64 for counts beyond its range. The arrays are built from the values
+    and their missing mask directly. Columns with fractional values are
+    left as floats, to be quarantined by validate_rows.
+    Args:
+     -df (pd.DataFrame): The dataframe.
+    Returns:
+     -df (pd.DataFrame): A new dataframe with the compact counts.
+    """
 
-def read_csv(url: str) -> pd.DataFrame:
+    compact = {}
+    for column, dtype in df.dtypes.items():
+        if column in KEY_COLUMNS or dtype.kind not in 'fiu' \
+                or isinstance(dtype, pd.api.extensions.ExtensionDtype):
+            continue
+        values = df[column].to_numpy()
+        missing = np.isnan(values) if dtype.kind == 'f' \
+            else np.zeros(len(values), dtype=bool)
+        for int_type in (np.int32, np.int64):
+            with np.errstate(invalid='ignore'):
+                ints = values.astype(int_type)
+            if ((ints == values) | missing).all():
+                ints[missing] = 0
+                compact[column] = pd.arrays.IntegerArray(ints, missing)
+                break
+    return df.assign(**compact) if compact else df
+
+
+@stage
+def read_csv(url: str, compact: bool = False, cache_dir: str = None,
+             columns: tuple = None, engine: str = None) -> pd.DataFrame:
     """
     Function to read a csv file and return it as a pandas DataFrame, printing
     the first 5 rows for validation.
     Args:
      -url (str): The path to the file.
+     -compact (bool): If True, read the file as a NICS extract: only the
+       columns in `columns` (by default NICS_COLUMNS) are parsed, with
+       'state' as a categorical, 'month' as a monthly period and the counts
+       as nullable integers (see compact_counts).
+     -cache_dir (str): If set, the parsed file is cached in this directory
+       (see cache.cached_read), so that later reads of the unchanged file
+       skip parsing.
+     -columns (tuple): If set, only these columns are parsed (e.g.
+       NICS_COLUMNS).
+     -engine (str): 'pandas', 'arrow' to parse the file with pyarrow's
+       reader into the same DataFrame, or None for the engine set with
+       engine.set_engine.
     Returns:
      -df (pd.DataFrame): The csv file converted to a DataFrame.
     """
 
-    # Use pandas to read the csv file and load into a df
-    df = pd.read_csv(url)
+    # Use pandas (or pyarrow) to read the csv file and load into a df
+    engine = resolve_engine(engine)
+    if cache_dir is None:
+        df = _parse_csv(url, compact=compact, columns=columns, engine=engine)
+    else:
+        df = cached_read(url, _parse_csv, cache_dir, compact=compact,
+                         columns=columns, engine=engine)
 
     # Print first 5 rows
-    print("Exercise 1 - First 5 rows from read_csv:")
-    print(df.head())
+    echo("Exercise 1 - First 5 rows from read_csv:")
+    echo(df.head())
 
     return df
 
 
+@stage
 def clean_csv(df: pd.DataFrame) -> pd.DataFrame:
     """
     Function to clean the dataframe by retaining only specific columns.
@@ -36,12 +167,13 @@ def clean_csv(df: pd.DataFrame) -> pd.DataFrame:
     df = df[columns_to_keep]
 
     # Print the column names for verification
-    print("Exercise 1 - Columns after clean_csv:")
-    print(df.columns)
+    echo("Exercise 1 - Columns after clean_csv:")
+    echo(df.columns)
 
     return df
 
 
+@stage
 def rename_col(df: pd.DataFrame) -> pd.DataFrame:
     """
     Function to rename the column 'longgun' to 'long_gun'.
@@ -56,36 +188,265 @@ def rename_col(df: pd.DataFrame) -> pd.DataFrame:
         df = df.rename(columns={'longgun': 'long_gun'})
 
     # Print the column names to verify
-    print("Exercise 1 - Columns after rename_col:")
-    print(df.columns)
+    echo("Exercise 1 - Columns after rename_col:")
+    echo(df.columns)
 
     return df
 
 
-def breakdown_date(df: pd.DataFrame) -> pd.DataFrame:
+def _month_bytes(month: pd.Series) -> tuple:
+    """
+    Function to expose the bytes of a column of 'YYYY-MM' strings as a 2-D
+    array, without creating a Python object per row. Arrow-backed strings
+    are read straight from the Arrow buffers; other columns are converted to
+    a fixed-width byte array.
+    Args:
+     -month (pd.Series): The column of 'YYYY-MM' strings.
+    Returns:
+     -codes (np.ndarray): The (rows, 7) uint8 array of the first 7 bytes of
+       each value.
+     -sized (np.ndarray): The boolean mask of the values that are exactly 7
+       bytes long and not null.
+    """
+
+    if getattr(month.dtype, 'storage', None) == 'pyarrow' \
+            or isinstance(month.dtype, getattr(pd, 'ArrowDtype', ())):
+        import pyarrow
+
+        parts = []
+        for chunk in month.array.__arrow_array__().chunks:
+            _, offsets, data = chunk.buffers()
+            offset_type = np.int64 if pyarrow.types.is_large_string(
+                chunk.type) else np.int32
+            offsets = np.frombuffer(offsets, dtype=offset_type)[
+                chunk.offset:chunk.offset + len(chunk) + 1]
+            data = np.frombuffer(data, dtype=np.uint8) if data is not None \
+                else np.zeros(1, dtype=np.uint8)
+            sized = np.diff(offsets) == 7
+            if chunk.null_count:
+                sized &= chunk.is_valid().to_numpy(zero_copy_only=False)
+
+            if sized.all():
+                # Every value is 7 bytes long: view the buffer as a matrix
+                codes = data[offsets[0]:offsets[-1]].reshape(-1, 7)
+            else:
+                index = offsets[:-1, None] + np.arange(7)
+                codes = data[np.minimum(index, len(data) - 1)]
+            parts.append((codes, sized))
+
+        if not parts:
+            return np.zeros((0, 7), dtype=np.uint8), np.zeros(0, dtype=bool)
+        if len(parts) == 1:
+            return parts[0]
+        return (np.concatenate([codes for codes, _ in parts]),
+                np.concatenate([sized for _, sized in parts]))
+
+    # One spare byte tells values of exactly 7 bytes from longer ones
+    try:
+        raw = np.asarray(month.to_numpy(dtype=object), dtype='S8')
+    except UnicodeEncodeError:
+        raise ValueError("Malformed 'month' values: non-ASCII characters")
+    codes = raw.view(np.uint8).reshape(-1, 8)
+    sized = (codes[:, 6] != 0) & (codes[:, 7] == 0)
+
+    return codes[:, :7], sized
+
+
+def _year_month(month: pd.Series) -> tuple:
+    """
+    Function to parse a column of fixed-width 'YYYY-MM' strings into year and
+    month arrays, working on the raw bytes of the column in bulk.
+    Args:
+     -month (pd.Series): The column of 'YYYY-MM' strings.
+    Returns:
+     -year (np.ndarray): The int16 array of years.
+     -month (np.ndarray): The int8 array of months.
+     -valid (np.ndarray): The boolean mask of the valid 'YYYY-MM' values.
+    """
+
+    codes, sized = _month_bytes(month)
+
+    # Digits wrap around to values above 9 when they are not ASCII digits
+    digits = codes[:, [0, 1, 2, 3, 5, 6]] - np.uint8(ord('0'))
+    valid = sized & (digits < 10).all(axis=1) & (codes[:, 4] == ord('-'))
+
+    digits = digits.astype(np.int16)
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 \
+        + digits[:, 3]
+    month_number = digits[:, 4] * 10 + digits[:, 5]
+    valid &= (month_number >= 1) & (month_number <= 12)
+
+    return year, month_number.astype(np.int8), valid
+
+
+def parse_year_month(month: pd.Series) -> tuple:
+    """
+    Function to parse a column of fixed-width 'YYYY-MM' strings into year and
+    month arrays, working on the raw bytes of the column in bulk.
+    Args:
+     -month (pd.Series): The column of 'YYYY-MM' strings.
+    Returns:
+     -year (np.ndarray): The int16 array of years.
+     -month (np.ndarray): The int8 array of months.
+    Raises:
+     -ValueError: If any value is not a valid 'YYYY-MM' string.
+    """
+
+    year, month_number, valid = _year_month(month)
+    if not valid.all():
+        invalid = month[~valid]
+        raise ValueError(f"Malformed 'month' values ({len(invalid)} rows), "
+                         f"e.g. {invalid.head().tolist()}")
+
+    return year, month_number
+
+
+def _whole_counts(values: np.ndarray) -> bool:
+    """
+    Function to check that float counts are whole and non-negative, missing
+    values aside. The values are read in chunks of VALIDATION_CHUNK, so each
+    chunk stays in the CPU cache across the checks.
+    Args:
+     -values (np.ndarray): The float64 counts.
+    Returns:
+     -whole (bool): False if any count is negative or fractional.
+    """
+
+    fractions = np.empty(min(len(values), VALIDATION_CHUNK))
+    for start in range(0, len(values), VALIDATION_CHUNK):
+        chunk = values[start:start + VALIDATION_CHUNK]
+        part = fractions[:len(chunk)]
+        np.subtract(chunk, np.trunc(chunk, out=part), out=part)
+        # fmin and fmax skip missing values
+        if np.fmin.reduce(chunk) < 0 or np.fmax.reduce(part) > 0:
+            return False
+
+    return True
+
+
+def state_keys(pop_df: pd.DataFrame, geo_json_path: str = None) -> frozenset:
+    """
+    Function to gather the valid state names: the states of the population
+    data and of the geo JSON file, and the NICS TERRITORIES.
+    Args:
+     -pop_df (pd.DataFrame): The population data, with a 'state' column.
+     -geo_json_path (str): The path to the geo JSON file, if any.
+    Returns:
+     -states (frozenset): The valid state names.
+    """
+
+    states = set(pop_df['state'].dropna()) | set(TERRITORIES)
+    if geo_json_path is not None:
+        from .geometry import load_geojson
+        states.update(feature['properties']['name'] for feature
+                      in load_geojson(geo_json_path)['features'])
+
+    return frozenset(states)
+
+
+@stage
+def validate_rows(df: pd.DataFrame, states: frozenset) -> tuple:
+    """
+    Function to set aside, in bulk, the NICS rows that would be silently
+    dropped or miscounted downstream: rows with a missing or unknown state,
+    a malformed month, or a negative or fractional count.
+    Args:
+     -df (pd.DataFrame): The NICS data, as returned by read_csv.
+     -states (frozenset): The valid state names (see state_keys).
+    Returns:
+     -df (pd.DataFrame): The valid rows; the input itself if all are valid.
+     -quarantine (pd.DataFrame): The invalid rows, with their index in the
+       input and a 'reason' column listing their QUARANTINE_REASONS.
+    """
+
+    # States are checked once per distinct name, then mapped to the rows
+    if isinstance(df['state'].dtype, pd.CategoricalDtype):
+        codes = df['state'].cat.codes.to_numpy()
+        names = df['state'].cat.categories
+    else:
+        codes, names = pd.factorize(df['state'])
+    known = np.append(names.isin(list(states)), True)
+
+    checks = {'missing state': codes == -1, 'unknown state': ~known[codes]}
+    if isinstance(df['month'].dtype, pd.PeriodDtype):
+        checks['invalid month'] = df['month'].isna().to_numpy()
+    else:
+        checks['invalid month'] = ~_year_month(df['month'])[2]
+
+    # Counts are checked a column at a time in bulk, and the rows are only
+    # looked up in the columns that fail
+    negative = np.zeros(len(df), dtype=bool)
+    fractional = np.zeros(len(df), dtype=bool)
+    for column, dtype in df.dtypes.items():
+        if column in KEY_COLUMNS or not pd.api.types.is_numeric_dtype(dtype):
+            continue
+        if dtype.kind != 'f':
+            # The minimum of a blank nullable column is NA
+            minimum = df[column].min()
+            if pd.notna(minimum) and minimum < 0:
+                negative |= (df[column] < 0).to_numpy(dtype=bool,
+                                                      na_value=False)
+        elif not _whole_counts(df[column].to_numpy()):
+            values = df[column].to_numpy()
+            negative |= values < 0
+            fractional |= (values != np.trunc(values)) & ~np.isnan(values)
+    checks['negative count'] = negative
+    checks['non-integer count'] = fractional
+
+    invalid = np.logical_or.reduce(list(checks.values()))
+    rows = np.flatnonzero(invalid)
+    reasons = np.full(len(rows), '', dtype=object)
+    for reason in QUARANTINE_REASONS:
+        flagged = checks[reason][rows]
+        reasons[flagged] = np.where(reasons[flagged] == '', reason,
+                                    reasons[flagged] + '; ' + reason)
+    quarantine = df.iloc[rows].assign(reason=pd.array(reasons, dtype='str'))
+
+    if len(rows):
+        echo(f"Quarantined {len(rows)} rows:")
+        echo(quarantine['reason'].value_counts())
+        df = df.iloc[np.flatnonzero(~invalid)]
+
+    return df, quarantine
+
+
+@stage
+def breakdown_date(df: pd.DataFrame, drop_month: bool = False) -> pd.DataFrame:
     """
     Function to split the 'month' column into 'year' and 'month' columns.
     Args:
      -df (pd.DataFrame): The dataframe containing the 'month' column.
+     -drop_month (bool): If True, only the 'year' column is kept, doing the
+       job of erase_month in the same pass.
     Returns:
      -df (pd.DataFrame): The dataframe with 'year' and 'month' columns.
     """
 
     # Split the 'month' column into 'year' and 'month'
-    year_month = df['month'].str.split('-', expand=True)
-    df = df.assign(year=year_month[0].astype(int), month=year_month[1].astype(int))
+    if isinstance(df['month'].dtype, pd.PeriodDtype):
+        year = df['month'].dt.year.to_numpy(dtype=np.int16)
+        month = df['month'].dt.month.to_numpy(dtype=np.int8)
+    else:
+        year, month = parse_year_month(df['month'])
+
+    if drop_month:
+        df = df.drop(columns=['month']).assign(year=year)
+    else:
+        df = df.assign(year=year, month=month)
 
     # Debugging: Verify the types
-    print(f"Year dtype: {df['year'].dtype}")
-    print(f"Month dtype: {df['month'].dtype}")
+    echo(f"Year dtype: {df['year'].dtype}")
+    if not drop_month:
+        echo(f"Month dtype: {df['month'].dtype}")
 
     # Print the first 5 rows to verify
-    print("Exercise 2 - First 5 rows after breakdown_date:")
-    print(df.head())
+    echo("Exercise 2 - First 5 rows after breakdown_date:")
+    echo(df.head())
 
     return df
 
 
+@stage
 def erase_month(df: pd.DataFrame) -> pd.DataFrame:
     """
     Function to remove the 'month' column from the dataframe.
@@ -99,46 +460,147 @@ def erase_month(df: pd.DataFrame) -> pd.DataFrame:
     df = df.drop(columns=['month'])
 
     # Print the first 5 rows and column names to verify
-    print("Exercise 2 - First 5 rows and columns after erase_month:")
-    print(df.head())
-    print(df.columns)
+    echo("Exercise 2 - First 5 rows and columns after erase_month:")
+    echo(df.head())
+    echo(df.columns)
+
+    return df
+
+
+def widen_counts(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Function to cast the compact nullable integer columns loaded by
+    read_csv(compact=True) to Int64 before they are accumulated.
+    Args:
+     -df (pd.DataFrame): The dataframe with the counts.
+    Returns:
+     -df (pd.DataFrame): The dataframe with the counts as Int64.
+    """
+
+    compact = [column for column, dtype in df.dtypes.items()
+               if isinstance(dtype, pd.api.extensions.ExtensionDtype)
+               and dtype.kind in 'iu' and dtype != 'Int64']
+    if compact:
+        df = df.astype({column: 'Int64' for column in compact})
 
     return df
 
 
-def groupby_state_and_year(df: pd.DataFrame) -> pd.DataFrame:
+@stage
+def groupby_state_and_year(df: pd.DataFrame,
+                           engine: str = None) -> pd.DataFrame:
     """
     Function to calculate total accumulated values by grouping data by year
     and state.
     Args:
      -df (pd.DataFrame): The dataframe obtained from the previous exercises.
+     -engine (str): 'pandas', 'arrow', or None for the engine set with
+       engine.set_engine.
     Returns:
      -df (pd.DataFrame): The dataframe with data grouped by year and state.
     """
 
+    # Widen compact integer counts so that the sums cannot overflow
+    df = widen_counts(df)
+
     # Group by 'year' and 'state' and sum the values
-    grouped_df = df.groupby(['year', 'state']).sum().reset_index()
+    if resolve_engine(engine) == 'arrow':
+        grouped_df = arrow_groupby_sum(df, ['year', 'state'])
+    else:
+        grouped_df = df.groupby(['year', 'state'], observed=True).sum() \
+            .reset_index()
 
     return grouped_df
 
 
-def groupby_state(df: pd.DataFrame) -> pd.DataFrame:
+@stage
+def stream_groupby_state_and_year(url: str,
+                                  chunksize: int = 100000) -> pd.DataFrame:
+    """
+    Function to calculate the same totals as groupby_state_and_year straight
+    from a NICS csv file, reading it in chunks. Each chunk is cleaned, its
+    dates split and its totals folded into the running (year, state) sums,
+    so peak memory depends on the number of groups and on `chunksize`, not
+    on the number of rows of the file.
+    Args:
+     -url (str): The path to the file.
+     -chunksize (int): The number of rows read at a time.
+    Returns:
+     -df (pd.DataFrame): The dataframe with data grouped by year and state,
+       identical to the one obtained with the in-memory functions.
+    """
+
+    # Start from an empty result, so that a file without rows (or without a
+    # header) gives an empty dataframe with the output columns
+    grouped_df = pd.DataFrame(
+        {'year': pd.Series(dtype='int16'), 'state': pd.Series(dtype='str'),
+         'permit': pd.Series(dtype='int64'),
+         'handgun': pd.Series(dtype='int64'),
+         'long_gun': pd.Series(dtype='int64')}).set_index(['year', 'state'])
+    float_columns = set()
+
+    try:
+        chunks = pd.read_csv(url, usecols=lambda c: c in NICS_COLUMNS,
+                             chunksize=chunksize)
+    except pd.errors.EmptyDataError:
+        chunks = []
+
+    for chunk in chunks:
+        chunk = chunk.rename(columns={'longgun': 'long_gun'})
+
+        # Split the dates and keep only the year, as in breakdown_date and
+        # erase_month
+        year, _ = parse_year_month(chunk['month'])
+        chunk = chunk.drop(columns=['month']).assign(year=year)
+
+        # A column parsed as float in any chunk (blank counts) is float in
+        # the in-memory path too
+        float_columns.update(column for column, dtype in chunk.dtypes.items()
+                             if dtype.kind == 'f')
+
+        if chunk.empty:
+            continue
+
+        partial_df = chunk.groupby(['year', 'state']).sum()
+        if not grouped_df.empty:
+            partial_df = pd.concat([grouped_df, partial_df]) \
+                .groupby(level=['year', 'state']).sum()
+        grouped_df = partial_df
+
+    grouped_df = grouped_df.astype(
+        {column: 'float64' if column in float_columns else 'int64'
+         for column in grouped_df.columns})
+
+    return grouped_df.sort_index().reset_index()
+
+
+@stage
+def groupby_state(df: pd.DataFrame, engine: str = None) -> pd.DataFrame:
     """
     Function to calculate total accumulated values by grouping data by state.
     Args:
-     -df (pd.DataFrame): The dataframe with data grouped by year and state.
+     -df (pd.DataFrame or StateYearCube): The dataframe with data grouped by
+       year and state, or the cube built from it.
+     -engine (str): 'pandas', 'arrow', or None for the engine set with
+       engine.set_engine. Ignored for a cube.
     Returns:
      -df (pd.DataFrame): The dataframe with data grouped by state.
     """
 
-    grouped_df = df.groupby('state').sum().reset_index()
+    if isinstance(df, StateYearCube):
+        grouped_df = df.by_state()
+    elif resolve_engine(engine) == 'arrow':
+        grouped_df = arrow_groupby_sum(df, ['state'])
+    else:
+        grouped_df = df.groupby('state', observed=True).sum().reset_index()
 
     # Print the first 5 rows to verify
-    print("Exercise 5 - First 5 rows after groupby_state:")
-    print(grouped_df.head())
+    echo("Exercise 5 - First 5 rows after groupby_state:")
+    echo(grouped_df.head())
 
     return grouped_df
 
+@stage
 def clean_states(df: pd.DataFrame) -> pd.DataFrame:
     """
     Function to remove specific states from the dataframe.
@@ -148,46 +610,93 @@ def clean_states(df: pd.DataFrame) -> pd.DataFrame:
      -df (pd.DataFrame): The dataframe without the specified states.
     """
 
-    states_to_remove = ['Guam', 'Mariana Islands', 'Puerto Rico', 'Virgin Islands']
-    cleaned_df = df[~df['state'].isin(states_to_remove)]
+    cleaned_df = df[~df['state'].isin(TERRITORIES)]
 
     # Print the number of unique states
-    print("Exercise 5 - Number of unique states:")
-    print(cleaned_df['state'].nunique())
+    echo("Exercise 5 - Number of unique states:")
+    echo(cleaned_df['state'].nunique())
 
     return cleaned_df
 
 
-def merge_datasets(df: pd.DataFrame, pop_df: pd.DataFrame) -> pd.DataFrame:
+@stage
+def merge_datasets(df: pd.DataFrame, pop_df: pd.DataFrame,
+                   engine: str = None) -> pd.DataFrame:
     """
     Function to merge the firearm data with the population data.
     Args:
      -df (pd.DataFrame): The dataframe with firearm data grouped by state.
      -pop_df (pd.DataFrame): The dataframe with population data.
+     -engine (str): 'pandas', 'arrow', or None for the engine set with
+       engine.set_engine.
     Returns:
      -df (pd.DataFrame): The merged dataframe.
     """
 
-    merged_df = pd.merge(df, pop_df, how='inner', on='state')
+    if resolve_engine(engine) == 'arrow':
+        merged_df = arrow_merge(df, pop_df, 'state')
+    else:
+        merged_df = pd.merge(df, pop_df, how='inner', on='state')
 
     # Print the first 5 rows to verify
-    print("Exercise 5 - First 5 rows after merge_datasets:")
-    print(merged_df.head())
+    echo("Exercise 5 - First 5 rows after merge_datasets:")
+    echo(merged_df.head())
 
     return merged_df
 
 
-def calculate_relative_values(df: pd.DataFrame) -> pd.DataFrame:
+@stage
+def population_table(pop_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Function to arrange population data as a state x year table. Wide data
+    has a 'pop_YYYY' column per year, as the bundled file; long data has one
+    row per state and year, with 'year' and 'population' columns.
+    Args:
+     -pop_df (pd.DataFrame): The population data, with a 'state' column.
+    Returns:
+     -df (pd.DataFrame): The populations, indexed by state, with one column
+       per year (as int), sorted.
+    """
+
+    if 'population' in pop_df.columns:
+        table = pop_df.pivot(index='state', columns='year',
+                             values='population')
+    else:
+        columns = [column for column in pop_df.columns
+                   if column.startswith('pop_') and column[4:].isdigit()]
+        table = pop_df.set_index('state')[columns]
+        table.columns = [int(column[4:]) for column in columns]
+
+    table = table.astype('float64').sort_index().sort_index(axis=1)
+    table.columns.name = 'year'
+
+    return table
+
+
+@stage
+def calculate_relative_values(df: pd.DataFrame,
+                              engine: str = None) -> pd.DataFrame:
     """
     Function to calculate relative values for permits, handguns, and long guns.
     Args:
-     -df (pd.DataFrame): The merged dataframe with population data.
+     -df (pd.DataFrame): The merged dataframe with population data. It is
+       not modified.
+     -engine (str): 'pandas', 'arrow', or None for the engine set with
+       engine.set_engine.
     Returns:
-     -df (pd.DataFrame): The dataframe with relative values calculated.
+     -df (pd.DataFrame): A new dataframe with the relative values added,
+       sharing the columns of the input.
     """
 
-    df['permit_perc'] = (df['permit'] * 100) / df['pop_2014']
-    df['handgun_perc'] = (df['handgun'] * 100) / df['pop_2014']
-    df['longgun_perc'] = (df['long_gun'] * 100) / df['pop_2014']
+    if resolve_engine(engine) == 'arrow':
+        return arrow_relative_values(
+            df, {'permit': 'permit_perc', 'handgun': 'handgun_perc',
+                 'long_gun': 'longgun_perc'}, 'pop_2014')
+
+    df = df.assign(
+        permit_perc=(df['permit'] * 100) / df['pop_2014'],
+        handgun_perc=(df['handgun'] * 100) / df['pop_2014'],
+        longgun_perc=(df['long_gun'] * 100) / df['pop_2014'],
+    )
 
     return df
@@ -0,0 +1,147 @@
+import json
+import threading
+import numpy as np
+from .cache import file_token
+
+# Douglas-Peucker tolerance, in degrees, used for each folium zoom level:
+# about a quarter of a pixel at that zoom, so the simplification is not
+# visible
+ZOOM_TOLERANCES = {
+    3: 0.05,
+    4: 0.02,
+    5: 0.01,
+    6: 0.005,
+}
+
+# Process-wide caches of the parsed and simplified geometries, keyed by the
+# file token of the geo JSON file (and the tolerance)
+_parsed = {}
+_simplified = {}
+_lock = threading.Lock()
+
+
+def load_geojson(geo_json_path: str) -> dict:
+    """
+    Function to load a geo JSON file, parsing it only once per process for
+    as long as the file does not change. The returned dictionary is shared
+    and must not be modified.
+    Args:
+     -geo_json_path (str): The path to the geo JSON file.
+    Returns:
+     -geo_data (dict): The parsed geo JSON.
+    """
+
+    token = file_token(geo_json_path)
+    with _lock:
+        geo_data = _parsed.get(token)
+    if geo_data is None:
+        with open(geo_json_path) as f:
+            geo_data = json.load(f)
+        with _lock:
+            geo_data = _parsed.setdefault(token, geo_data)
+
+    return geo_data
+
+
+def simplify_ring(ring: list, tolerance: float) -> list:
+    """
+    Function to simplify a closed ring of [longitude, latitude] points with
+    the Douglas-Peucker algorithm.
+    Args:
+     -ring (list): The points of the ring, the first one repeated last.
+     -tolerance (float): The maximum distance, in degrees, between the ring
+       and its simplification.
+    Returns:
+     -ring (list): The simplified ring, with its coordinates rounded to a
+       tenth of the tolerance, or the original one if simplifying it would
+       leave less than 4 points.
+    """
+
+    points = np.asarray(ring, dtype=float)
+    if len(points) < 5:
+        return ring
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    # Split the ring at its farthest point from the start, so that no
+    # segment has identical endpoints
+    farthest = int(np.argmax(((points - points[0]) ** 2).sum(axis=1)))
+    keep[farthest] = True
+    stack = [(0, farthest), (farthest, len(points) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        segment = end - start
+        length = np.hypot(*segment)
+        inner = points[first + 1:last] - start
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(segment[0] * inner[:, 1]
+                               - segment[1] * inner[:, 0]) / length
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    if keep.sum() < 4:
+        return ring
+
+    # Digits finer than a tenth of the tolerance are not visible either
+    decimals = max(int(np.ceil(-np.log10(tolerance))) + 1, 0)
+
+    return np.round(points[keep], decimals).tolist()
+
+
+def simplify_geojson(geo_json_path: str, tolerance: float = None,
+                     zoom: int = None) -> dict:
+    """
+    Function to load a geo JSON file with its polygons simplified. Each
+    (file, tolerance) pair is simplified only once per process. The returned
+    dictionary is shared and must not be modified.
+    Args:
+     -geo_json_path (str): The path to the geo JSON file.
+     -tolerance (float): The Douglas-Peucker tolerance, in degrees.
+     -zoom (int): The folium zoom level, used to pick the tolerance from
+       ZOOM_TOLERANCES when `tolerance` is None.
+    Returns:
+     -geo_data (dict): The geo JSON with simplified polygons. If neither a
+       tolerance nor a zoom level is given, the full-resolution geo JSON.
+    """
+
+    if tolerance is None:
+        if zoom is None:
+            return load_geojson(geo_json_path)
+        tolerance = ZOOM_TOLERANCES[min(max(zoom, min(ZOOM_TOLERANCES)),
+                                        max(ZOOM_TOLERANCES))]
+
+    key = (file_token(geo_json_path), tolerance)
+    with _lock:
+        geo_data = _simplified.get(key)
+    if geo_data is not None:
+        return geo_data
+
+    geo_data = load_geojson(geo_json_path)
+    features = []
+    for feature in geo_data['features']:
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            coordinates = [simplify_ring(ring, tolerance)
+                           for ring in geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            coordinates = [[simplify_ring(ring, tolerance) for ring in polygon]
+                           for polygon in geometry['coordinates']]
+        else:
+            coordinates = geometry['coordinates']
+        features.append(dict(feature, geometry=dict(geometry,
+                                                    coordinates=coordinates)))
+    geo_data = dict(geo_data, features=features)
+
+    with _lock:
+        return _simplified.setdefault(key, geo_data)
@@ -0,0 +1,244 @@
+import cProfile
+import functools
+import json
+import os
+import platform
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+# Quiet mode turns off the validation prints of the ETL and calcs functions.
+# It can be switched on from the environment for batch runs.
+_quiet = os.environ.get('GUNSTATS_QUIET', '') not in ('', '0')
+
+# Recorder collecting the stage measurements, if a recording is running
+_recorder = None
+
+
+def set_quiet(quiet: bool = True) -> None:
+    """
+    Function to turn the validation prints on or off.
+    Args:
+     -quiet (bool): If True, echo does not print anything.
+    Returns:
+     -None
+    """
+
+    global _quiet
+    _quiet = quiet
+
+
+def echo(*values) -> None:
+    """
+    Function to print validation output unless quiet mode is on. Values are
+    only formatted when they are printed, so quiet mode also skips the cost
+    of formatting dataframes.
+    Args:
+     -values: The values to print.
+    Returns:
+     -None
+    """
+
+    if not _quiet:
+        print(*values)
+
+
+def _rows(value):
+    """
+    Function to return the number of rows of a dataframe or series.
+    Args:
+     -value: Any value.
+    Returns:
+     -rows (int): The number of rows, or None if value is not tabular.
+    """
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    return None
+
+
+class Recorder:
+    """
+    Class that collects, for each stage run while it is active, the wall
+    time, the rows in and out and the peak memory delta traced by
+    tracemalloc, optionally profiling the whole run with cProfile. Tracing
+    memory slows allocations down, so it can be turned off to measure
+    wall times only.
+
+    tracemalloc keeps a single, process-wide peak. It is folded into every
+    running stage whenever a stage starts or ends, before being reset, so
+    a stage that nests (or overlaps with) other stages reports the highest
+    of its own peak and theirs.
+    """
+
+    def __init__(self, profile: bool = False, memory: bool = True):
+        self.stages = []
+        self.started = time.time()
+        self.memory = memory
+        self.profiler = cProfile.Profile() if profile else None
+        self._stopped = None
+        self._started_tracing = False
+        self._running = []
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Method to start tracing memory and, if requested, profiling.
+        """
+
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def stop(self) -> None:
+        """
+        Method to stop tracing memory and profiling.
+        """
+
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self._started_tracing:
+            tracemalloc.stop()
+        self._stopped = time.time()
+
+    def _fold_peak(self) -> None:
+        """
+        Method to fold the memory peak traced since the last fold into every
+        running stage, and reset it. Called with the lock held.
+        """
+
+        peak = tracemalloc.get_traced_memory()[1]
+        for running in self._running:
+            running['peak'] = max(running['peak'], peak)
+        tracemalloc.reset_peak()
+
+    def run(self, name: str, func, args: tuple, kwargs: dict):
+        """
+        Method to run a stage and record its measurements.
+        Args:
+         -name (str): The name of the stage.
+         -func (callable): The stage function.
+         -args (tuple): The positional arguments of the stage.
+         -kwargs (dict): The keyword arguments of the stage.
+        Returns:
+         -result: The result of the stage.
+        """
+
+        rows_in = next((rows for rows in map(_rows, args)
+                        if rows is not None), None)
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            with self._lock:
+                self._fold_peak()
+                running = {'before': tracemalloc.get_traced_memory()[0],
+                           'peak': 0}
+                self._running.append(running)
+        start = time.perf_counter()
+
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            wall_time = time.perf_counter() - start
+            if tracing:
+                with self._lock:
+                    self._fold_peak()
+                    self._running = [other for other in self._running
+                                     if other is not running]
+
+        self.stages.append({
+            'stage': name,
+            'wall_time': round(wall_time, 6),
+            'rows_in': rows_in,
+            'rows_out': _rows(result),
+            'peak_memory_delta': running['peak'] - running['before']
+            if tracing else None,
+        })
+
+        return result
+
+    def report(self) -> dict:
+        """
+        Method to build the run report.
+        Returns:
+         -report (dict): The run report, serializable as JSON.
+        """
+
+        stopped = self._stopped or time.time()
+        return {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'started': self.started,
+            'wall_time': round(stopped - self.started, 6),
+            'stages': self.stages,
+        }
+
+    def write_report(self, path: str) -> None:
+        """
+        Method to save the run report as a JSON file.
+        Args:
+         -path (str): The path to the JSON file.
+        """
+
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_profile(self, path: str) -> None:
+        """
+        Method to save the cProfile statistics, readable with pstats.
+        Args:
+         -path (str): The path to the statistics file.
+        """
+
+        self.profiler.dump_stats(path)
+
+
+def stage(func):
+    """
+    Decorator to instrument an ETL or calcs function as a pipeline stage.
+    While no recording is running the function is called directly.
+    Args:
+     -func (callable): The stage function.
+    Returns:
+     -wrapper (callable): The instrumented function.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _recorder is None:
+            return func(*args, **kwargs)
+        return _recorder.run(func.__name__, func, args, kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def recording(report_path: str = None, profile_path: str = None,
+              memory: bool = True):
+    """
+    Context manager recording every stage run inside it.
+    Args:
+     -report_path (str): If set, the JSON run report is saved here.
+     -profile_path (str): If set, the run is profiled with cProfile and the
+       statistics are saved here.
+     -memory (bool): Whether to trace the peak memory of the stages.
+    Yields:
+     -recorder (Recorder): The recorder collecting the measurements.
+    """
+
+    global _recorder
+    recorder = Recorder(profile=profile_path is not None, memory=memory)
+    previous, _recorder = _recorder, recorder
+    recorder.start()
+    try:
+        yield recorder
+    finally:
+        recorder.stop()
+        _recorder = previous
+        if report_path is not None:
+            recorder.write_report(report_path)
+        if profile_path is not None:
+            recorder.write_profile(profile_path)
@@ -1,9 +1,61 @@
 from .etl import *
 from .calcs import *
+from .pipeline import Pipeline
+from .cache import ArtifactCache
+from .engine import ENGINES
+from .instrument import set_quiet
+from .scheduler import Task, format_timeline, run_tasks, subgraph
+import argparse
+import os
 import sys
 
+# Shared pipeline, so every exercise reuses the stages already computed by
+# the previous ones instead of re-reading and re-processing the CSV files
+_pipeline = Pipeline()
 
-def main_menu():
+# Shared cache of the rendered maps, so unchanged maps are not rendered again
+_map_cache = ArtifactCache()
+
+# Output formats of the batch mode: tables, maps and figures
+TABLE_FORMATS = ('csv',)
+MAP_FORMATS = ('html',)
+FIGURE_FORMATS = ('png', 'svg', 'pdf')
+OUTPUT_FORMATS = TABLE_FORMATS + MAP_FORMATS + FIGURE_FORMATS
+
+# The maps of exercise 6: (column, map_title, output_file)
+EXERCISE_6_MAPS = [
+    ('permit_perc', 'Permit Percentage', 'permit_perc_map'),
+    ('handgun_perc', 'Handgun Percentage', 'handgun_perc_map'),
+    ('longgun_perc', 'Long Gun Percentage', 'longgun_perc_map'),
+]
+
+# The file name of the maps of exercise 6 as the layers of a single map
+EXERCISE_6_LAYERED_MAP = 'perc_maps'
+
+
+def main_menu(jobs: int = 1, pipeline: Pipeline = None,
+              maps_dir: str = None, formats: tuple = ('html', 'png'),
+              map_backend: str = 'browser',
+              map_cache: ArtifactCache = _map_cache,
+              layered_maps: bool = False):
+    """
+    Function to run the interactive menu.
+    Args:
+     -jobs (int): The number of exercises run at the same time by option 0.
+     -pipeline (Pipeline): The pipeline shared by the exercises.
+     -maps_dir (str): The directory to save the maps in. Defaults to
+       MAPS_DIR.
+     -formats (tuple): The formats of the maps (see exercise_6).
+     -map_backend (str): The backend of the maps (see create_choropleth_map).
+     -map_cache (ArtifactCache): The cache of the rendered maps, or None to
+       render every map.
+     -layered_maps (bool): Whether the maps of exercise 6 are the layers of
+       a single map.
+    Returns:
+     -None
+    """
+
+    pipeline = pipeline or _pipeline
     while True:
         print("Select an option:")
         print("0. Execute all exercises")
@@ -20,19 +72,21 @@ def main_menu():
         print("---------------------------------------------------------------")
 
         if choice == '0':
-            execute_all()
+            execute_all(pipeline, jobs, maps_dir, formats, map_backend,
+                        map_cache, layered_maps)
         elif choice == '1':
-            exercise_1()
+            exercise_1(pipeline)
         elif choice == '2':
-            exercise_2()
+            exercise_2(pipeline)
         elif choice == '3':
-            exercise_3()
+            exercise_3(pipeline)
         elif choice == '4':
-            exercise_4()
+            exercise_4(pipeline)
         elif choice == '5':
-            exercise_5()
+            exercise_5(pipeline)
         elif choice == '6':
-            exercise_6()
+            exercise_6(pipeline, map_backend, maps_dir, formats, map_cache,
+                       layered_maps)
         elif choice == '7':
             print("Exiting program...")
             sys.exit()
@@ -42,100 +96,292 @@ def main_menu():
         print("---------------------------------------------------------------")
 
 
-def exercise_1():
+def exercise_1(pipeline: Pipeline = None):
+    pipeline = pipeline or _pipeline
     print("Exercise 1: Read and clean data...")
-    df = read_csv("./data/nics-firearm-background-checks.csv")
-    df = clean_csv(df)
-    df = rename_col(df)
+    df = pipeline.get('renamed')
     print("Exercise 1 completed.")
     return df
 
 
-def exercise_2():
+def exercise_2(pipeline: Pipeline = None):
+    pipeline = pipeline or _pipeline
     print("Exercise 2: Data processing...")
-    df = read_csv("./data/nics-firearm-background-checks.csv")
-    df = clean_csv(df)
-    df = rename_col(df)
-    df = breakdown_date(df)
-    df = erase_month(df)
+    df = pipeline.get('undated')
     print("Exercise 2 completed.")
     return df
 
 
-def exercise_3():
+def exercise_3(pipeline: Pipeline = None):
+    pipeline = pipeline or _pipeline
     print("Exercise 3: Data grouping...")
-    df = read_csv("./data/nics-firearm-background-checks.csv")
-    df = clean_csv(df)
-    df = rename_col(df)
-    df = breakdown_date(df)
-    df = erase_month(df)
-    grouped_df = groupby_state_and_year(df)
-    _, _, _ = print_biggest_handguns(grouped_df)
-    _, _, _ = print_biggest_longguns(grouped_df)
+    grouped_df = pipeline.get('grouped')
+    cube = pipeline.get('cube')
+    _, _, _ = print_biggest_handguns(cube)
+    _, _, _ = print_biggest_longguns(cube)
     print("Exercise 3 completed.")
     return grouped_df
 
 
-def exercise_4():
+def exercise_4(pipeline: Pipeline = None, output_files: list = None):
+    pipeline = pipeline or _pipeline
     print("Exercise 4: Time analysis...")
-    df = read_csv("./data/nics-firearm-background-checks.csv")
-    df = clean_csv(df)
-    df = rename_col(df)
-    df = breakdown_date(df)
-    df = erase_month(df)
-    grouped_df = groupby_state_and_year(df)
-    time_evolution(grouped_df)
+    time_evolution(pipeline.get('cube'), output_files)
     print("Exercise 4 completed.")
 
 
-def exercise_5():
+def exercise_5(pipeline: Pipeline = None):
+    pipeline = pipeline or _pipeline
     print("Exercise 5: State analysis...")
-    df = read_csv("./data/nics-firearm-background-checks.csv")
-    df = clean_csv(df)
-    df = rename_col(df)
-    df = breakdown_date(df)
-    df = erase_month(df)
-    grouped_df = groupby_state_and_year(df)
-    state_grouped_df = groupby_state(grouped_df)
-    cleaned_states_df = clean_states(state_grouped_df)
-    pop_df = read_csv("./data/us-state-populations.csv")
-    merged_df = merge_datasets(cleaned_states_df, pop_df)
-    relative_values_df = calculate_relative_values(merged_df)
+    relative_values_df = pipeline.get('relative')
     _, _ = analyze_state_data(relative_values_df)
     print("Exercise 5 completed.")
     return relative_values_df
 
 
-def exercise_6():
+def exercise_6(pipeline: Pipeline = None, backend: str = 'browser',
+               output_dir: str = None, formats: tuple = ('html', 'png'),
+               cache: ArtifactCache = _map_cache, layered: bool = False):
+    pipeline = pipeline or _pipeline
+    output_dir = output_dir or MAPS_DIR
     print("Exercise 6: Choropleth maps...")
-    df = read_csv("./data/nics-firearm-background-checks.csv")
-    df = clean_csv(df)
-    df = rename_col(df)
-    df = breakdown_date(df)
-    df = erase_month(df)
-    grouped_df = groupby_state_and_year(df)
-    state_grouped_df = groupby_state(grouped_df)
-    cleaned_states_df = clean_states(state_grouped_df)
-    pop_df = read_csv("./data/us-state-populations.csv")
-    merged_df = merge_datasets(cleaned_states_df, pop_df)
-    relative_values_df = calculate_relative_values(merged_df)
-    geo_json_path = "./data/us-states.json"
-    create_choropleth_map(relative_values_df, 'permit_perc', geo_json_path, 'Permit Percentage', 'permit_perc_map')
-    create_choropleth_map(relative_values_df, 'handgun_perc', geo_json_path, 'Handgun Percentage', 'handgun_perc_map')
-    create_choropleth_map(relative_values_df, 'longgun_perc', geo_json_path, 'Long Gun Percentage', 'longgun_perc_map')
-    print("Exercise 6 completed. Generated maps saved under data/maps/.")
-
-
-def execute_all():
+    relative_values_df = pipeline.get('relative')
+    geo_json_path = pipeline.geo_json_path
+    image_formats = [image_format for image_format in formats
+                     if image_format in FIGURE_FORMATS]
+    if layered:
+        # One map with a layer per column, sharing the geometry
+        create_layered_choropleth_map(
+            relative_values_df,
+            [(column, map_title) for column, map_title, _ in EXERCISE_6_MAPS],
+            geo_json_path, EXERCISE_6_LAYERED_MAP, backend=backend,
+            html='html' in formats, output_dir=output_dir,
+            image_formats=image_formats, cache=cache)
+    else:
+        # The three images are rendered concurrently in a pool of warm
+        # browsers
+        create_choropleth_maps(relative_values_df, EXERCISE_6_MAPS,
+                               geo_json_path, backend=backend,
+                               html='html' in formats, output_dir=output_dir,
+                               image_formats=image_formats, cache=cache)
+    if cache is not None:
+        print(f"Map cache: {cache.hits} hits, {cache.misses} misses.")
+    print(f"Exercise 6 completed. Generated maps saved under {output_dir}.")
+
+
+def save_table(df, output_dir: str, name: str, formats: tuple) -> None:
+    """
+    Function to save the table produced by an exercise in the batch mode.
+    Args:
+     -df (pd.DataFrame): The table.
+     -output_dir (str): The directory to save the table in.
+     -name (str): The file name, without extension.
+     -formats (tuple): The output formats; the table is only saved as
+       'csv'.
+    Returns:
+     -None
+    """
+
+    if 'csv' in formats:
+        os.makedirs(output_dir, exist_ok=True)
+        df.to_csv(os.path.join(output_dir, f'{name}.csv'), index=False)
+
+
+def exercise_tasks(pipeline: Pipeline = None, output_dir: str = None,
+                   formats: tuple = ('html', 'png'),
+                   map_backend: str = 'browser',
+                   map_cache: ArtifactCache = _map_cache,
+                   layered_maps: bool = False, maps_dir: str = None) -> dict:
+    """
+    Function to express the exercises as a dependency graph of tasks. The
+    shared aggregates and per-capita values are computed once by their own
+    tasks; the exercises consuming them read them from the pipeline.
+    Exercises 1 and 2 only read the cleaned data, so they depend on no task.
+    Args:
+     -pipeline (Pipeline): The pipeline shared by the exercises.
+     -output_dir (str): If given, the exercises run in batch mode: their
+       tables, figure and maps are saved in this directory, in the given
+       formats, and no window is ever shown.
+     -formats (tuple): The batch output formats (see OUTPUT_FORMATS).
+     -map_backend (str): The backend of the maps (see create_choropleth_map).
+     -map_cache (ArtifactCache): The cache of the rendered maps, or None to
+       render every map.
+     -layered_maps (bool): Whether the maps of exercise 6 are the layers of
+       a single map.
+     -maps_dir (str): Without output_dir, the directory to save the maps
+       in. Defaults to MAPS_DIR.
+    Returns:
+     -tasks (dict): The scheduler tasks, by name.
+    """
+
+    pipeline = pipeline or _pipeline
+    if output_dir is None:
+        return {
+            'aggregates': Task(lambda: pipeline.get('cube')),
+            'per_capita': Task(lambda: pipeline.get('relative'),
+                               ['aggregates']),
+            'exercise_1': Task(lambda: exercise_1(pipeline)),
+            'exercise_2': Task(lambda: exercise_2(pipeline)),
+            'exercise_3': Task(lambda: exercise_3(pipeline), ['aggregates']),
+            # pyplot windows must be shown from the main thread
+            'exercise_4': Task(lambda: exercise_4(pipeline), ['aggregates'],
+                               main_thread=True),
+            'exercise_5': Task(lambda: exercise_5(pipeline), ['per_capita']),
+            'exercise_6': Task(lambda: exercise_6(pipeline, map_backend,
+                                                  maps_dir, formats,
+                                                  map_cache, layered_maps),
+                               ['per_capita']),
+        }
+
+    def table_task(exercise, name):
+        return lambda: save_table(exercise(pipeline), output_dir, name,
+                                  formats)
+
+    def figure_task():
+        figure_files = [os.path.join(output_dir, f'time_evolution.{fmt}')
+                        for fmt in formats if fmt in FIGURE_FORMATS]
+        os.makedirs(output_dir, exist_ok=True)
+        exercise_4(pipeline, figure_files)
+
+    return {
+        'aggregates': Task(lambda: pipeline.get('cube')),
+        'per_capita': Task(lambda: pipeline.get('relative'), ['aggregates']),
+        'exercise_1': Task(table_task(exercise_1, 'cleaned')),
+        'exercise_2': Task(table_task(exercise_2, 'processed')),
+        'exercise_3': Task(table_task(exercise_3, 'grouped'),
+                           ['aggregates']),
+        'exercise_4': Task(figure_task, ['aggregates']),
+        'exercise_5': Task(table_task(exercise_5, 'relative'),
+                           ['per_capita']),
+        'exercise_6': Task(lambda: exercise_6(pipeline, map_backend,
+                                              output_dir, formats, map_cache,
+                                              layered_maps),
+                           ['per_capita']),
+    }
+
+
+def execute_all(pipeline: Pipeline = None, jobs: int = 1,
+                maps_dir: str = None, formats: tuple = ('html', 'png'),
+                map_backend: str = 'browser',
+                map_cache: ArtifactCache = _map_cache,
+                layered_maps: bool = False):
+    pipeline = pipeline or _pipeline
     print("Executing all exercises...")
-    exercise_1()
-    exercise_2()
-    exercise_3()
-    exercise_4()
-    exercise_5()
-    exercise_6()
-    print("All exercises completed. Generated maps saved under data/maps/.")
+    timeline = run_tasks(exercise_tasks(pipeline, None, formats, map_backend,
+                                        map_cache, layered_maps, maps_dir),
+                         jobs)
+    print(f"All exercises completed. Generated maps saved under "
+          f"{maps_dir or MAPS_DIR}.")
+    print(format_timeline(timeline))
+    return timeline
+
+
+def run_batch(exercises: list, pipeline: Pipeline = None,
+              output_dir: str = MAPS_DIR, formats: tuple = ('html', 'png'),
+              map_backend: str = 'matplotlib', jobs: int = 1,
+              map_cache: ArtifactCache = _map_cache,
+              layered_maps: bool = False) -> list:
+    """
+    Function to run some exercises without any interaction: nothing is read
+    from the standard input, and figures are saved with matplotlib's Agg
+    backend instead of being shown.
+    Args:
+     -exercises (list): The numbers of the exercises to run.
+     -pipeline (Pipeline): The pipeline shared by the exercises.
+     -output_dir (str): The directory to save the outputs in.
+     -formats (tuple): The output formats (see OUTPUT_FORMATS).
+     -map_backend (str): The backend of the maps (see create_choropleth_map).
+     -jobs (int): The number of exercises run at the same time.
+     -map_cache (ArtifactCache): The cache of the rendered maps, or None to
+       render every map.
+     -layered_maps (bool): Whether the maps of exercise 6 are the layers of
+       a single map.
+    Returns:
+     -timeline (list): The timeline of the run (see run_tasks).
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    tasks = exercise_tasks(pipeline, output_dir, formats, map_backend,
+                           map_cache, layered_maps)
+    tasks = subgraph(tasks, [f'exercise_{exercise}'
+                             for exercise in sorted(exercises)])
+
+    return run_tasks(tasks, jobs)
+
+
+def main(argv: list = None) -> int:
+    """
+    Function to run the command line interface: the interactive menu, or
+    the batch mode when exercises are given.
+    Args:
+     -argv (list): The command line arguments. Defaults to sys.argv.
+    Returns:
+     -status (int): The exit status: 0 on success, 1 if an exercise
+       failed. Invalid arguments exit with status 2.
+    """
+
+    parser = argparse.ArgumentParser(prog='python -m gunstats.main')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="number of exercises run at the same time")
+    parser.add_argument('--exercises', type=int, nargs='+',
+                        choices=range(1, 7), metavar='N',
+                        help="run these exercises (1-6) without the menu")
+    parser.add_argument('--all', action='store_true',
+                        help="run every exercise without the menu")
+    parser.add_argument('--data-dir', default='./data',
+                        help="directory with the input files")
+    parser.add_argument('--output-dir', default=MAPS_DIR,
+                        help="directory to save the outputs in")
+    parser.add_argument('--formats', nargs='+', default=['html', 'png'],
+                        choices=OUTPUT_FORMATS, metavar='FORMAT',
+                        help="output formats: " + ", ".join(OUTPUT_FORMATS))
+    parser.add_argument('--map-backend', default=None,
+                        choices=['matplotlib', 'browser'],
+                        help="how the map images are rendered (default: "
+                             "matplotlib in batch mode, browser in the "
+                             "menu)")
+    parser.add_argument('--layered-maps', action='store_true',
+                        help="save the maps of exercise 6 as the layers of "
+                             "a single map")
+    parser.add_argument('--no-map-cache', action='store_true',
+                        help="render every map, even when an identical map "
+                             "is cached")
+    parser.add_argument('--engine', choices=ENGINES, default=None,
+                        help="engine of the ETL stages (default: pandas, "
+                             "or $GUNSTATS_ENGINE)")
+    parser.add_argument('--quiet', action='store_true',
+                        help="do not print intermediate results")
+    parser.add_argument('--lean', action='store_true',
+                        help="parse only the used columns and release "
+                             "intermediate results (see Pipeline)")
+    args = parser.parse_args(argv)
+
+    if args.quiet:
+        set_quiet()
+
+    # The menu and the batch mode share the same options
+    pipeline = Pipeline(args.data_dir, lean=args.lean, engine=args.engine)
+    map_cache = None if args.no_map_cache else _map_cache
+
+    if not args.all and not args.exercises:
+        main_menu(args.jobs, pipeline, args.output_dir, tuple(args.formats),
+                  args.map_backend or 'browser', map_cache, args.layered_maps)
+        return 0
+
+    exercises = range(1, 7) if args.all else args.exercises
+    try:
+        timeline = run_batch(exercises, pipeline, args.output_dir,
+                             tuple(args.formats),
+                             args.map_backend or 'matplotlib', args.jobs,
+                             map_cache, args.layered_maps)
+    except Exception as exc:
+        print(f"gunstats: {type(exc).__name__}: {exc}", file=sys.stderr)
+        return 1
+
+    print(format_timeline(timeline))
+    return 0
 
 
 if __name__ == "__main__":
-    main_menu()
+    sys.exit(main())
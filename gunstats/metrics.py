@@ -0,0 +1,288 @@
+import numpy as np
+import pandas as pd
+from .etl import parse_year_month, KEY_COLUMNS
+
+# The count columns of the NICS file, by kind of check. On every row they
+# add up to the 'totals' column
+NICS_FAMILIES = {
+    'permit': ['permit', 'permit_recheck'],
+    'sale': ['handgun', 'long_gun', 'other', 'multiple', 'admin'],
+    'prepawn': ['prepawn_handgun', 'prepawn_long_gun', 'prepawn_other'],
+    'redemption': ['redemption_handgun', 'redemption_long_gun',
+                   'redemption_other'],
+    'returned': ['returned_handgun', 'returned_long_gun', 'returned_other'],
+    'rentals': ['rentals_handgun', 'rentals_long_gun'],
+    'private_sale': ['private_sale_handgun', 'private_sale_long_gun',
+                     'private_sale_other'],
+    'return_to_seller': ['return_to_seller_handgun',
+                         'return_to_seller_long_gun',
+                         'return_to_seller_other'],
+}
+
+# The column the counts of a row add up to
+TOTAL_COLUMN = 'totals'
+
+
+def count_block(df: pd.DataFrame, columns: list,
+                extra: int = 0) -> np.ndarray:
+    """
+    Function to copy count columns into one contiguous int64 block, missing
+    counts as 0, each column stored contiguously.
+    Args:
+     -df (pd.DataFrame): The dataframe with the counts.
+     -columns (list): The count columns.
+     -extra (int): The number of zeroed columns added after them.
+    Returns:
+     -block (np.ndarray): The (rows, columns + extra) block, in Fortran
+       order.
+    """
+
+    block = np.empty((len(columns) + extra, len(df)), dtype=np.int64)
+    block[len(columns):] = 0
+    for row, column in zip(block, columns):
+        values = df[column]
+        if isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+            row[:] = values.to_numpy(dtype=np.int64, na_value=0)
+        elif values.dtype.kind == 'f':
+            values = values.to_numpy()
+            np.copyto(row, np.where(np.isnan(values), 0, values),
+                      casting='unsafe')
+        else:
+            row[:] = values.to_numpy()
+
+    return block.T
+
+
+def _years(month: pd.Series) -> np.ndarray:
+    """
+    Function to get the years of a 'month' column ('YYYY-MM' strings or
+    monthly periods).
+    Args:
+     -month (pd.Series): The 'month' column.
+    Returns:
+     -year (np.ndarray): The years.
+    """
+
+    if isinstance(month.dtype, pd.PeriodDtype):
+        return month.dt.year.to_numpy(dtype=np.int16)
+    return parse_year_month(month)[0]
+
+
+class MetricRegistry:
+    """
+    Class that registers the count columns aggregated together (the
+    metrics), each in a family, and the total column they add up to.
+
+    counts copies the metrics, the total and a flag of the rows whose
+    metrics do not add up to the total into a single contiguous int64
+    block. Every category is then aggregated by one grouped reduction over
+    the block, and the rows are reconciled with the total by one row sum,
+    instead of a pass per column set or a Python loop over the rows.
+    """
+
+    def __init__(self, families: dict = None, total: str = TOTAL_COLUMN):
+        self.total = total
+        self.metrics = []
+        self.family = {}
+        for family, metrics in (families or {}).items():
+            for metric in metrics:
+                self.register(metric, family)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, total: str = TOTAL_COLUMN):
+        """
+        Method to register every numeric column of a dataframe but the keys
+        and the total: the NICS columns in their NICS_FAMILIES, and any
+        other column in a family of its own.
+        Args:
+         -df (pd.DataFrame): The dataframe, e.g. the raw NICS file.
+         -total (str): The total column.
+        Returns:
+         -registry (MetricRegistry): The registry, in NICS_FAMILIES order.
+        """
+
+        registry = cls({family: [metric for metric in metrics
+                                 if metric in df.columns]
+                        for family, metrics in NICS_FAMILIES.items()},
+                       total)
+        for column in df.columns:
+            if column not in KEY_COLUMNS + (total, 'unreconciled') \
+                    and pd.api.types.is_numeric_dtype(df[column]):
+                registry.register(column)
+
+        return registry
+
+    def register(self, metric: str, family: str = None) -> None:
+        """
+        Method to register a metric, once.
+        Args:
+         -metric (str): The count column.
+         -family (str): The family of the metric. Defaults to the metric.
+        Returns:
+         -None
+        """
+
+        if metric not in self.family:
+            self.metrics.append(metric)
+            self.family[metric] = family or metric
+
+    def families(self) -> dict:
+        """
+        Method to list the metrics of every family.
+        Returns:
+         -families (dict): The metrics of each family, in registry order.
+        """
+
+        families = {}
+        for metric in self.metrics:
+            families.setdefault(self.family[metric], []).append(metric)
+
+        return families
+
+    def counts(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Method to copy the metrics of a dataframe, and its total if any, into
+        one contiguous int64 block, missing counts as 0. With a total, the
+        block ends with an 'unreconciled' column, 1 for the rows whose
+        metrics do not add up to the total.
+        Args:
+         -df (pd.DataFrame): The dataframe with the counts, e.g. the raw
+           NICS file.
+        Returns:
+         -df (pd.DataFrame): The 'month', 'year' (from 'month' if missing)
+           and 'state' columns of the input, if any, then the block.
+        Raises:
+         -ValueError: If a metric column is missing.
+        """
+
+        missing = [metric for metric in self.metrics
+                   if metric not in df.columns]
+        if missing:
+            raise ValueError(f"Missing metric columns: {missing}")
+
+        columns = self.metrics
+        if self.total in df.columns:
+            columns = columns + [self.total, 'unreconciled']
+            block = count_block(df, columns[:-1], extra=1)
+            metrics = len(self.metrics)
+            block[:, -1] = block[:, metrics] \
+                != block[:, :metrics].sum(axis=1)
+        else:
+            block = count_block(df, columns)
+
+        keys = df[[column for column in KEY_COLUMNS if column in df]] \
+            .reset_index(drop=True)
+        if 'year' not in keys and 'month' in keys:
+            keys.insert(1, 'year', _years(keys['month']))
+
+        return pd.concat([keys, pd.DataFrame(block, columns=columns,
+                                             copy=False)], axis=1)
+
+    def _counts(self, df: pd.DataFrame) -> tuple:
+        """
+        Method to get the count block of a dataframe, without a copy if it
+        was built by counts.
+        Args:
+         -df (pd.DataFrame): The dataframe with the counts, or its counts.
+        Returns:
+         -df (pd.DataFrame): The counts.
+         -block (np.ndarray): The block of the counts.
+         -columns (list): The columns of the block.
+        """
+
+        columns = self.metrics + ([self.total, 'unreconciled']
+                                  if self.total in df.columns else [])
+        if not all(column in df.columns and df[column].dtype == np.int64
+                   for column in columns):
+            df = self.counts(df)
+
+        return df, df[columns].to_numpy(), columns
+
+    def reconcile(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Method to find the rows whose metrics do not add up to the total.
+        Args:
+         -df (pd.DataFrame): The dataframe with the counts and the total, or
+           its counts.
+        Returns:
+         -df (pd.DataFrame): The rows that do not reconcile, with their
+           'month', 'year' and 'state' (if any), their 'components' sum,
+           their total and the 'difference' between the two. Indexed by the
+           position of the rows in the input.
+        Raises:
+         -ValueError: If the total or a metric column is missing.
+        """
+
+        if self.total not in df.columns:
+            raise ValueError(f"No '{self.total}' column to reconcile with")
+        df, block, _ = self._counts(df)
+
+        flagged = np.flatnonzero(block[:, -1])
+        components = block[flagged, :len(self.metrics)].sum(axis=1)
+        totals = block[flagged, len(self.metrics)]
+
+        keys = [column for column in KEY_COLUMNS if column in df.columns]
+        return df[keys].iloc[flagged].assign(
+            components=components, **{self.total: totals},
+            difference=totals - components)
+
+    def aggregate(self, df: pd.DataFrame,
+                  keys: list = ('year', 'state')) -> pd.DataFrame:
+        """
+        Method to sum every metric, and the total, by group in a single
+        grouped reduction over the count block.
+        Args:
+         -df (pd.DataFrame): The dataframe with the counts, or its counts.
+         -keys (list): The key columns of the groups.
+        Returns:
+         -df (pd.DataFrame): One row per group, sorted by the keys, with the
+           int64 sum of every metric and of the total. With a total, the
+           'unreconciled' column counts the rows of the group whose metrics
+           do not add up to it. Rows with a missing key are left out, as in
+           a pandas groupby.
+        """
+
+        df, block, columns = self._counts(df)
+
+        codes = [pd.factorize(df[key], sort=True) for key in keys]
+        sizes = [len(uniques) for _, uniques in codes]
+
+        # Missing keys are factorized as -1, which is not a valid group
+        valid = np.logical_and.reduce([key_codes >= 0
+                                       for key_codes, _ in codes])
+        if not valid.all():
+            block = block[valid]
+            codes = [(key_codes[valid], uniques)
+                     for key_codes, uniques in codes]
+
+        group_codes = np.ravel_multi_index(
+            [key_codes for key_codes, _ in codes], sizes)
+        sums = pd.DataFrame(block, copy=False).groupby(group_codes).sum()
+
+        group_keys = np.unravel_index(sums.index.to_numpy(), sizes)
+        grouped_df = pd.DataFrame({
+            key: uniques.take(key_codes)
+            for key, (_, uniques), key_codes in zip(keys, codes, group_keys)})
+        grouped_df[columns] = sums.to_numpy()
+
+        return grouped_df
+
+    def by_family(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Method to add up the metrics of every family, e.g. on aggregated
+        counts.
+        Args:
+         -df (pd.DataFrame): The dataframe with the metrics.
+        Returns:
+         -df (pd.DataFrame): The other columns of the input and one int64
+           column per family, after them.
+        """
+
+        families = self.families()
+        membership = np.array([[self.family[metric] == family
+                                for family in families]
+                               for metric in self.metrics], dtype=np.int64)
+        sums = count_block(df, self.metrics) @ membership
+
+        return df.drop(columns=self.metrics).assign(
+            **{family: sums[:, i] for i, family in enumerate(families)})
@@ -0,0 +1,236 @@
+import os
+import threading
+from .cache import file_token
+from .cube import StateYearCube
+from .metrics import MetricRegistry, NICS_FAMILIES
+from .timeseries import MonthlySeries
+from .etl import read_csv, clean_csv, rename_col, breakdown_date, \
+    erase_month, groupby_state_and_year, groupby_state, clean_states, \
+    merge_datasets, calculate_relative_values, population_table, \
+    state_keys, validate_rows, NICS_COLUMNS
+
+# Stages only consumed by the next stage, whose results the lean mode
+# releases as soon as that stage has been computed. 'ingested' and 'raw' have
+# several consumers, and share their columns with 'renamed', which is kept,
+# so they are kept too
+TRANSIENT_STAGES = ['cleaned', 'dated', 'state_grouped', 'states_cleaned',
+                    'merged']
+
+
+class Pipeline:
+    """
+    Class that owns every ETL stage as a named, memoized step. Each stage is
+    computed once and reused by the stages and exercises downstream of it,
+    and is only recomputed when one of its inputs (a source file or an
+    upstream stage) changes.
+
+    Results are owned by the pipeline and shared between callers, so they
+    are read-only. No stage modifies its inputs: each returns a new frame,
+    which shares the unchanged columns of its input under pandas'
+    Copy-on-Write (the default since pandas 3.0), so results are neither
+    copied defensively nor corrupted by their consumers.
+
+    The NICS rows are validated as they are read: rows with an unknown
+    state (one in neither the population nor the geo JSON file), a malformed
+    month or an invalid count are set aside in the 'quarantine' stage. The
+    valid state names are memoized by value, so a new population file only
+    re-runs the ETL if it changes them.
+
+    In lean mode, only the NICS columns used by the stages are parsed, and
+    the results of TRANSIENT_STAGES are released once consumed, so only the
+    results read by the exercises stay in memory.
+
+    The 'counts', 'categories' and 'unreconciled' stages cover every NICS
+    category (see metrics.py), so they need the full raw file: in compact and
+    lean modes only NICS_COLUMNS are parsed and they raise a ValueError.
+
+    The engine ('pandas' or 'arrow', see engine.py) runs the parsing,
+    grouping, merging and per-capita stages; None uses the engine set with
+    engine.set_engine.
+    """
+
+    def __init__(self, data_dir: str = "./data", compact: bool = False,
+                 cache_dir: str = None, lean: bool = False,
+                 engine: str = None):
+        self.data_dir = data_dir
+        self.compact = compact
+        self.cache_dir = cache_dir
+        self.lean = lean
+        self.engine = engine
+        self.nics_path = os.path.join(
+            data_dir, "nics-firearm-background-checks.csv")
+        self.population_path = os.path.join(
+            data_dir, "us-state-populations.csv")
+        self.geo_json_path = os.path.join(data_dir, "us-states.json")
+
+        self.registry = MetricRegistry(NICS_FAMILIES)
+        self._stages = {}
+        self._by_value = set()
+        self._results = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+        # Exercise 1, with the invalid rows set aside. The geo JSON file
+        # is only needed by exercise 6, so it is optional here
+        geo_sources = [path for path in [self.geo_json_path]
+                       if os.path.exists(path)]
+        self.add_stage('state_keys',
+                       lambda pop_df: state_keys(pop_df, *geo_sources),
+                       deps=['population'], sources=geo_sources,
+                       by_value=True)
+        self.add_stage('ingested',
+                       lambda states: validate_rows(
+                           read_csv(self.nics_path, self.compact,
+                                    self.cache_dir,
+                                    tuple(NICS_COLUMNS) if self.lean
+                                    else None, self.engine), states),
+                       deps=['state_keys'], sources=[self.nics_path])
+        self.add_stage('raw', lambda ingested: ingested[0],
+                       deps=['ingested'])
+        self.add_stage('quarantine', lambda ingested: ingested[1],
+                       deps=['ingested'])
+        self.add_stage('cleaned', clean_csv, deps=['raw'])
+        self.add_stage('renamed', rename_col, deps=['cleaned'])
+
+        # Every NICS category, aggregated by state and year in one pass,
+        # and the rows whose categories do not add up to their totals
+        self.add_stage('counts', self.registry.counts, deps=['raw'])
+        self.add_stage('categories', self.registry.aggregate,
+                       deps=['counts'])
+        self.add_stage('unreconciled', self.registry.reconcile,
+                       deps=['counts'])
+
+        # Monthly time series, built before the months are dropped
+        self.add_stage('monthly', MonthlySeries.from_frame,
+                       deps=['renamed'])
+
+        # Exercise 2
+        self.add_stage('dated', breakdown_date, deps=['renamed'])
+        self.add_stage('undated', erase_month, deps=['dated'])
+
+        # Exercise 3
+        self.add_stage('grouped',
+                       lambda df: groupby_state_and_year(df, self.engine),
+                       deps=['undated'])
+        self.add_stage('cube', StateYearCube.from_grouped, deps=['grouped'])
+
+        # Exercise 5
+        self.add_stage('state_grouped',
+                       lambda df: groupby_state(df, self.engine),
+                       deps=['grouped'])
+        self.add_stage('states_cleaned', clean_states,
+                       deps=['state_grouped'])
+        self.add_stage('population',
+                       lambda: read_csv(self.population_path,
+                                        cache_dir=self.cache_dir,
+                                        engine=self.engine),
+                       sources=[self.population_path])
+        self.add_stage('merged',
+                       lambda df, pop_df: merge_datasets(df, pop_df,
+                                                         self.engine),
+                       deps=['states_cleaned', 'population'])
+        self.add_stage('relative',
+                       lambda df: calculate_relative_values(df, self.engine),
+                       deps=['merged'])
+
+        # Per-capita rates of every metric by state and year. Only the
+        # population stages feed them besides the cube, so a new population
+        # file recomputes the rates without re-running the ETL
+        self.add_stage('population_table', population_table,
+                       deps=['population'])
+        self.add_stage('rates',
+                       lambda cube, table: cube.per_capita(table),
+                       deps=['cube', 'population_table'])
+
+    def add_stage(self, name: str, func, deps: list = None,
+                  sources: list = None, by_value: bool = False) -> None:
+        """
+        Method to register (or replace) a named stage.
+        Args:
+         -name (str): The name of the stage.
+         -func (callable): The function computing the stage. It receives the
+           results of `deps` as positional arguments, in order.
+         -deps (list): The names of the stages this stage consumes.
+         -sources (list): The paths of the files this stage reads.
+         -by_value (bool): If True, the stages downstream are keyed by the
+           result of this stage instead of its inputs, so they are not
+           recomputed when it is recomputed to an equal result. The result
+           must be hashable and cheap to compare, e.g. a frozenset.
+        Returns:
+         -None
+        """
+
+        self._stages[name] = (func, list(deps or []), list(sources or []))
+        if by_value:
+            self._by_value.add(name)
+        else:
+            self._by_value.discard(name)
+        self.invalidate(name)
+
+    def token(self, name: str) -> tuple:
+        """
+        Method to compute the input token of a stage. The token changes
+        whenever a source file of the stage, or of any stage upstream of it,
+        changes, or the result of a stage added with by_value.
+        Args:
+         -name (str): The name of the stage.
+        Returns:
+         -token (tuple): The input token of the stage.
+        """
+
+        _, deps, sources = self._stages[name]
+        return (name,
+                tuple(file_token(path) for path in sources),
+                tuple((dep, self.get(dep)) if dep in self._by_value
+                      else self.token(dep) for dep in deps))
+
+    def get(self, name: str):
+        """
+        Method to return the result of a stage, computing it (and any stale
+        upstream stage) only if its inputs changed since the last call.
+        Args:
+         -name (str): The name of the stage.
+        Returns:
+         -result: The result of the stage.
+        """
+
+        # One lock per stage, so that concurrent callers (see scheduler)
+        # compute each stage once while independent stages run in parallel
+        with self._locks_lock:
+            lock = self._locks.setdefault(name, threading.RLock())
+
+        with lock:
+            token = self.token(name)
+            cached = self._results.get(name)
+            if cached is not None and cached[0] == token:
+                return cached[1]
+
+            func, deps, _ = self._stages[name]
+            result = func(*[self.get(dep) for dep in deps])
+            self._results[name] = (token, result)
+
+            if self.lean:
+                for dep in deps:
+                    if dep in TRANSIENT_STAGES:
+                        self._results.pop(dep, None)
+
+        return result
+
+    def invalidate(self, name: str = None) -> None:
+        """
+        Method to drop memoized results, forcing them to be recomputed.
+        Args:
+         -name (str): The stage to drop, together with every stage
+           downstream of it. All stages are dropped if None.
+        Returns:
+         -None
+        """
+
+        if name is None:
+            self._results.clear()
+            return
+
+        self._results.pop(name, None)
+        for other, (_, deps, _) in self._stages.items():
+            if name in deps:
+                self.invalidate(other)
@@ -0,0 +1,137 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .instrument import echo
+
+# JavaScript condition that holds once a folium map has finished rendering:
+# the page is loaded, the GeoJSON layer has been drawn and every map tile
+# has either loaded or failed (e.g. when rendering offline)
+MAP_RENDERED_JS = """
+return document.readyState === 'complete'
+    && document.querySelectorAll('path.leaflet-interactive').length > 0
+    && Array.from(document.querySelectorAll('img.leaflet-tile'))
+        .every(function (tile) { return tile.complete; });
+"""
+
+
+def headless_chrome():
+    """
+    Function to start a headless Chrome driver.
+    Returns:
+     -driver (webdriver.Chrome): The started driver.
+    """
+
+    # selenium is only imported when a browser is actually needed
+    from selenium import webdriver
+
+    options = webdriver.ChromeOptions()
+    options.add_argument('--headless')
+    return webdriver.Chrome(options=options)
+
+
+class BrowserPool:
+    """
+    Class that keeps a pool of warm headless browsers to export HTML maps as
+    PNG images. Browsers are started on first use, up to `size` of them, and
+    reused for every later render until the pool is closed, so exporting
+    several maps costs one browser start per pool slot plus the render time
+    of each map.
+    """
+
+    def __init__(self, size: int = 2, timeout: float = 30,
+                 driver_factory=headless_chrome):
+        self.size = size
+        self.timeout = timeout
+        self.driver_factory = driver_factory
+        self._idle = queue.Queue()
+        self._drivers = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _acquire(self):
+        """
+        Method to take an idle driver, starting a new one while the pool is
+        not full.
+        Returns:
+         -driver: The acquired driver.
+        """
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            start = len(self._drivers) < self.size
+            if start:
+                # Reserve the slot before the (slow) browser start
+                self._drivers.append(None)
+        if not start:
+            return self._idle.get()
+
+        try:
+            driver = self.driver_factory()
+        except Exception:
+            with self._lock:
+                self._drivers.remove(None)
+            raise
+        with self._lock:
+            self._drivers[self._drivers.index(None)] = driver
+
+        return driver
+
+    def screenshot(self, html_file_path: str, png_file_path: str) -> str:
+        """
+        Method to render an HTML map in a pooled browser and save it as PNG,
+        waiting until the map has actually finished rendering.
+        Args:
+         -html_file_path (str): The path to the HTML map.
+         -png_file_path (str): The path to save the PNG image to.
+        Returns:
+         -png_file_path (str): The path to the PNG image.
+        """
+
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        driver = self._acquire()
+        try:
+            driver.get(f'file://{os.path.abspath(html_file_path)}')
+            echo("Rendering image... may take a few seconds...")
+            WebDriverWait(driver, self.timeout).until(
+                lambda d: d.execute_script(MAP_RENDERED_JS))
+            driver.save_screenshot(png_file_path)
+        finally:
+            self._idle.put(driver)
+
+        return png_file_path
+
+    def render_many(self, jobs: list) -> list:
+        """
+        Method to render several HTML maps concurrently, one per browser.
+        Args:
+         -jobs (list): The (html_file_path, png_file_path) pairs to render.
+        Returns:
+         -png_file_paths (list): The paths to the PNG images, in order.
+        """
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(lambda job: self.screenshot(*job),
+                                     jobs))
+
+    def close(self) -> None:
+        """
+        Method to quit every browser of the pool.
+        """
+
+        with self._lock:
+            drivers, self._drivers = self._drivers, []
+        self._idle = queue.Queue()
+        for driver in drivers:
+            if driver is not None:
+                driver.quit()
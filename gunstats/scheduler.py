@@ -0,0 +1,179 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class Task:
+    """
+    Class describing a task of a dependency graph.
+    Args:
+     -func (callable): The function run by the task, without arguments.
+     -deps (list): The names of the tasks that must finish first.
+     -main_thread (bool): Whether the task must run in the calling thread,
+       e.g. because it shows a matplotlib window.
+    """
+
+    def __init__(self, func, deps: list = None, main_thread: bool = False):
+        self.func = func
+        self.deps = list(deps or [])
+        self.main_thread = main_thread
+
+
+def _ordered(tasks: dict) -> list:
+    """
+    Function to sort the tasks so that every task comes after its
+    dependencies, keeping the given order otherwise.
+    Args:
+     -tasks (dict): The tasks, by name.
+    Returns:
+     -names (list): The names of the tasks in dependency order.
+    Raises:
+     -ValueError: If a dependency is unknown or the graph has a cycle.
+    """
+
+    for name, task in tasks.items():
+        for dep in task.deps:
+            if dep not in tasks:
+                raise ValueError(f"Task {name} depends on unknown task {dep}")
+
+    ordered, done = [], set()
+    while len(ordered) < len(tasks):
+        ready = [name for name, task in tasks.items() if name not in done
+                 and all(dep in done for dep in task.deps)]
+        if not ready:
+            raise ValueError("The task graph has a cycle")
+        ordered.extend(ready)
+        done.update(ready)
+
+    return ordered
+
+
+def subgraph(tasks: dict, names: list) -> dict:
+    """
+    Function to select some tasks of a graph together with every task they
+    depend on, directly or not.
+    Args:
+     -tasks (dict): The tasks, by name.
+     -names (list): The names of the selected tasks.
+    Returns:
+     -tasks (dict): The selected tasks and their dependencies, in the order
+       of the original graph.
+    Raises:
+     -ValueError: If a task is unknown.
+    """
+
+    selected = set()
+    stack = list(names)
+    while stack:
+        name = stack.pop()
+        if name not in tasks:
+            raise ValueError(f"Unknown task {name}")
+        if name not in selected:
+            selected.add(name)
+            stack.extend(tasks[name].deps)
+
+    return {name: task for name, task in tasks.items() if name in selected}
+
+
+def run_tasks(tasks: dict, jobs: int = 1) -> list:
+    """
+    Function to run a dependency graph of tasks on a pool of threads, each
+    task starting as soon as all its dependencies have finished. Tasks share
+    the memory of the process, so intermediate results (e.g. the stages of
+    a Pipeline) are handed from one task to another without re-parsing.
+    Args:
+     -tasks (dict): The Task objects, by name.
+     -jobs (int): The number of tasks run at the same time. With 1, tasks
+       run one after another in the calling thread, in dependency order.
+    Returns:
+     -timeline (list): For every task, in completion order, its 'task'
+       name, its 'start' and 'end' times in seconds from the start of the
+       run and the 'thread' it ran in.
+    Raises:
+     -ValueError: If the graph is invalid. The first exception raised by a
+       task is re-raised once the running tasks have finished; the tasks
+       that were not started yet are skipped.
+    """
+
+    order = _ordered(tasks)
+    timeline = []
+    started = time.perf_counter()
+
+    def run(name):
+        start = time.perf_counter() - started
+        tasks[name].func()
+        timeline.append({
+            'task': name,
+            'start': round(start, 6),
+            'end': round(time.perf_counter() - started, 6),
+            'thread': threading.current_thread().name,
+        })
+
+    if jobs <= 1:
+        for name in order:
+            run(name)
+        return timeline
+
+    pending = list(order)
+    done = set()
+    running = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=jobs,
+                            thread_name_prefix='gunstats') as executor:
+        while running or (pending and error is None):
+            ready = [name for name in pending
+                     if all(dep in done for dep in tasks[name].deps)]
+            if error is None:
+                for name in ready:
+                    if not tasks[name].main_thread:
+                        pending.remove(name)
+                        running[executor.submit(run, name)] = name
+
+                # Tasks bound to the calling thread run here, one at a time,
+                # while the pool keeps running the others
+                main_ready = [name for name in ready
+                              if tasks[name].main_thread]
+                if main_ready:
+                    name = main_ready[0]
+                    pending.remove(name)
+                    try:
+                        run(name)
+                        done.add(name)
+                    except Exception as exc:
+                        error = exc
+                    continue
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is None:
+                    done.add(name)
+                elif error is None:
+                    error = future.exception()
+
+    if error is not None:
+        raise error
+
+    return timeline
+
+
+def format_timeline(timeline: list) -> str:
+    """
+    Function to format a timeline as a text table, one task per line
+    sorted by start time.
+    Args:
+     -timeline (list): The timeline returned by run_tasks.
+    Returns:
+     -text (str): The formatted timeline.
+    """
+
+    lines = [f"{'Task':<16}{'Start (s)':>10}{'End (s)':>10}  Thread"]
+    for entry in sorted(timeline, key=lambda entry: entry['start']):
+        lines.append(f"{entry['task']:<16}{entry['start']:>10.3f}"
+                     f"{entry['end']:>10.3f}  {entry['thread']}")
+
+    return '\n'.join(lines)
@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import functools
+import json
+import math
+from urllib.parse import parse_qsl, urlsplit
+from .instrument import set_quiet
+from .pipeline import Pipeline
+
+# Number of responses kept by the LRU response cache
+CACHE_SIZE = 4096
+
+# Reason phrases of the status codes used by the service
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+# Seconds spent discarding the rest of a rejected request before closing its
+# connection, so that the client reads the error instead of a reset
+LINGER_TIMEOUT = 1.0
+
+
+class QueryError(ValueError):
+    """
+    Class of the errors caused by an invalid query, answered with a 400.
+    """
+
+
+class StatsService:
+    """
+    Class that answers state, year, metric and per-capita queries from the
+    aggregates, loaded once from the pipeline: the (year, state) totals cube
+    and the yearly per-capita rates. Responses are cached in an LRU cache
+    keyed by the path and the sorted query parameters.
+
+    Endpoints (GET, JSON):
+     -/meta: the states, years and metrics.
+     -/totals?state=&year=&metric=: the totals, every filter optional.
+     -/per_capita?state=&year=&metric=: the yearly rates per 100
+       inhabitants, every filter optional.
+     -/top?metric=&k=&by=: the k highest totals (see StateYearCube.top_k).
+    """
+
+    def __init__(self, pipeline: Pipeline = None,
+                 cache_size: int = CACHE_SIZE):
+        pipeline = pipeline or Pipeline()
+        self.cube = pipeline.get('cube')
+        self.rates = pipeline.get('rates')
+        self.respond = functools.lru_cache(maxsize=cache_size)(self._respond)
+
+    def _select(self, cube, query: dict) -> list:
+        """
+        Method to select the cells of a cube matching the query filters.
+        Args:
+         -cube (StateYearCube): The cube.
+         -query (dict): The 'state', 'year' and 'metric' filters.
+        Returns:
+         -records (list): One dict per selected cell, with its 'state',
+           'year', 'metric' and 'value'.
+        """
+
+        try:
+            states = [cube.state_index[query['state']]] \
+                if 'state' in query else range(len(cube.states))
+            years = [cube.year_index[int(query['year'])]] \
+                if 'year' in query else range(len(cube.years))
+            metrics = [cube.metric_index[query['metric']]] \
+                if 'metric' in query else range(len(cube.metrics))
+        except (KeyError, ValueError) as exc:
+            raise QueryError(f"Unknown value {exc}")
+
+        records = []
+        for state in states:
+            for year in years:
+                if not cube.present[state, year]:
+                    continue
+                for metric in metrics:
+                    value = cube.values[state, year, metric].item()
+                    records.append({
+                        'state': cube.states[state],
+                        'year': cube.years[year],
+                        'metric': cube.metrics[metric],
+                        'value': None if isinstance(value, float)
+                        and math.isnan(value) else value,
+                    })
+
+        return records
+
+    def _respond(self, path: str, query: tuple) -> tuple:
+        """
+        Method to answer a query. Wrapped in the LRU cache as `respond`.
+        Args:
+         -path (str): The path of the request.
+         -query (tuple): The sorted (name, value) query parameters.
+        Returns:
+         -status (int): The HTTP status.
+         -body (bytes): The JSON body.
+        """
+
+        query = dict(query)
+        try:
+            if path == '/meta':
+                result = {'states': self.cube.states,
+                          'years': self.cube.years,
+                          'metrics': self.cube.metrics}
+            elif path == '/totals':
+                result = self._select(self.cube, query)
+            elif path == '/per_capita':
+                result = self._select(self.rates, query)
+            elif path == '/top':
+                if query.get('metric', self.cube.metrics[0]) \
+                        not in self.cube.metric_index:
+                    raise QueryError(f"Unknown metric {query['metric']}")
+                if query.get('by') not in (None, 'year', 'state'):
+                    raise QueryError(f"Unknown breakdown {query['by']}")
+                try:
+                    k = int(query.get('k', 1))
+                except ValueError:
+                    raise QueryError(f"Invalid k {query['k']}")
+                if k < 1:
+                    raise QueryError(f"Invalid k {k}, it must be at least 1")
+                result = self.cube.top_k(
+                    k, query.get('by'),
+                    [query['metric']] if 'metric' in query else None) \
+                    .to_dict(orient='records')
+            else:
+                return 404, json.dumps({'error': f"Unknown path {path}"}) \
+                    .encode()
+        except QueryError as exc:
+            return 400, json.dumps({'error': str(exc)}).encode()
+
+        return 200, json.dumps(result, default=int).encode()
+
+    def _write(self, writer: asyncio.StreamWriter, status: int, body: bytes,
+               close: bool) -> None:
+        """
+        Method to write a JSON response.
+        Args:
+         -writer (asyncio.StreamWriter): The connection writer.
+         -status (int): The status code.
+         -body (bytes): The JSON body.
+         -close (bool): Whether the connection is closed after the response.
+        Returns:
+         -None
+        """
+
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n"
+            f"\r\n".encode() + body)
+
+    async def _discard(self, reader: asyncio.StreamReader) -> None:
+        """
+        Method to read and drop the rest of a connection input.
+        Args:
+         -reader (asyncio.StreamReader): The connection reader.
+        Returns:
+         -None
+        """
+
+        while await reader.read(2 ** 16):
+            pass
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        """
+        Method to serve the HTTP/1.1 requests of a connection, keeping it
+        alive until the client closes it or asks to.
+        Args:
+         -reader (asyncio.StreamReader): The connection reader.
+         -writer (asyncio.StreamWriter): The connection writer.
+        Returns:
+         -None
+        """
+
+        try:
+            while True:
+                # A line longer than the reader limit cannot be parsed, and
+                # the rest of the stream cannot be trusted: answer and close
+                try:
+                    request_line = await reader.readline()
+                    if not request_line:
+                        break
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        name, _, value = line.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                except (ValueError, asyncio.LimitOverrunError):
+                    self._write(writer, 413,
+                                b'{"error": "Request line too long"}', True)
+                    await writer.drain()
+                    writer.write_eof()
+                    try:
+                        await asyncio.wait_for(self._discard(reader),
+                                               LINGER_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        pass
+                    break
+
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    break
+                method, target, version = parts
+                if method != 'GET':
+                    status, body = 405, b'{"error": "Only GET is allowed"}'
+                else:
+                    url = urlsplit(target)
+                    status, body = self.respond(
+                        url.path, tuple(sorted(parse_qsl(url.query))))
+
+                close = headers.get('connection', '').lower() == 'close' \
+                    or version == 'HTTP/1.0'
+                self._write(writer, status, body, close)
+                await writer.drain()
+                if close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = '127.0.0.1',
+                    port: int = 8080) -> asyncio.AbstractServer:
+        """
+        Method to start serving.
+        Args:
+         -host (str): The host to listen on.
+         -port (int): The port to listen on; 0 picks a free port.
+        Returns:
+         -server (asyncio.AbstractServer): The started server.
+        """
+
+        return await asyncio.start_server(self.handle, host, port)
+
+
+async def serve(service: StatsService, host: str = '127.0.0.1',
+                port: int = 8080) -> None:
+    """
+    Function to run the service until it is interrupted.
+    Args:
+     -service (StatsService): The service.
+     -host (str): The host to listen on.
+     -port (int): The port to listen on.
+    Returns:
+     -None
+    """
+
+    server = await service.start(host, port)
+    address = server.sockets[0].getsockname()
+    print(f"Serving on http://{address[0]}:{address[1]}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m gunstats.service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--data-dir', default='./data',
+                        help="directory with the input files")
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help="number of responses kept in the LRU cache")
+    args = parser.parse_args()
+
+    set_quiet()
+    service = StatsService(Pipeline(args.data_dir), args.cache_size)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,350 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+from .cube import align_population
+from .etl import parse_year_month, population_table
+
+# Metrics aggregated by default, as kept by clean_csv
+AGGREGATE_METRICS = ['permit', 'handgun', 'long_gun']
+
+# Version of the on-disk layout of the store, checked when it is opened
+STORE_VERSION = 1
+
+# Name of the manifest listing the files of the saved store
+MANIFEST = 'store.json'
+
+
+def _upsert(df: pd.DataFrame, rows: pd.DataFrame,
+            add: bool = False) -> pd.DataFrame:
+    """
+    Function to write rows into a dataframe with the same columns, by index:
+    the rows already in it are updated in place, and the others appended.
+    Args:
+     -df (pd.DataFrame): The dataframe, with a unique index.
+     -rows (pd.DataFrame): The rows, with a unique index.
+     -add (bool): If True, the rows are added to the existing ones instead
+       of replacing them.
+    Returns:
+     -df (pd.DataFrame): The dataframe with the rows; the input itself if
+       no row was appended.
+    """
+
+    positions = df.index.get_indexer(rows.index)
+    known = positions >= 0
+    values = rows[df.columns].to_numpy(dtype='float64', copy=True)
+    if known.any():
+        positions = positions[known]
+        if add:
+            values[known] += df.iloc[positions].to_numpy(dtype='float64')
+        df.iloc[positions, :] = values[known]
+    if not known.all():
+        df = pd.concat([df, pd.DataFrame(values[~known], index=rows.index[
+            ~known], columns=df.columns)])
+
+    return df
+
+
+def perc_column(metric: str) -> str:
+    """
+    Function to name the per-capita column of a metric the way
+    calculate_relative_values does ('long_gun' -> 'longgun_perc').
+    Args:
+     -metric (str): The metric.
+    Returns:
+     -column (str): The name of the per-capita column.
+    """
+
+    return metric.replace('_', '') + '_perc'
+
+
+class AggregateStore:
+    """
+    Class that persists the (year, state) and state totals of the NICS
+    counts, together with the per-capita values, and updates them
+    incrementally. Every ingested (month, state) row is kept in a ledger,
+    indexed by its key, so re-ingesting a month is detected: unchanged rows
+    are skipped and revised rows are applied as deltas. A batch is diffed
+    against the ledger by index lookups and only the rows of the groups it
+    touches are updated, so ingesting costs O(new rows) plus appending the
+    new keys, instead of re-aggregating the whole history.
+
+    The store is saved as a directory of Feather files (it needs pyarrow),
+    listed with the format version in a MANIFEST that is replaced last, so
+    an interrupted save keeps the previous store.
+    """
+
+    def __init__(self, path: str = None, metrics: list = None):
+        self.path = path
+        self.metrics = list(metrics or AGGREGATE_METRICS)
+        self._ledger = pd.DataFrame(
+            columns=self.metrics, dtype='float64',
+            index=pd.MultiIndex.from_arrays([[], []],
+                                            names=['month', 'state']))
+        self.by_year = pd.DataFrame(
+            columns=self.metrics, dtype='float64',
+            index=pd.MultiIndex.from_arrays([[], []],
+                                            names=['year', 'state']))
+        self.by_state = pd.DataFrame(columns=self.metrics, dtype='float64',
+                                     index=pd.Index([], name='state'))
+        self.population = None
+        self.per_capita = pd.DataFrame(
+            columns=[perc_column(metric) for metric in self.metrics],
+            dtype='float64', index=pd.Index([], name='state'))
+        self.population_table = None
+        self.yearly_rates = pd.DataFrame(
+            columns=[perc_column(metric) for metric in self.metrics],
+            dtype='float64', index=self.by_year.index[:0])
+
+        if path is not None and os.path.exists(os.path.join(path, MANIFEST)):
+            self._load(path)
+
+    def _load(self, path: str) -> None:
+        """
+        Method to read a saved store, then recompute its per-capita values.
+        Args:
+         -path (str): The directory of the store.
+        Returns:
+         -None
+        Raises:
+         -ValueError: If the store was saved in another format version.
+        """
+
+        import pyarrow.feather as feather
+
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != STORE_VERSION:
+            raise ValueError(f"Unsupported store format version "
+                             f"{manifest.get('version')} in {path} "
+                             f"(expected {STORE_VERSION})")
+
+        tables = {name: feather.read_feather(os.path.join(path, file_name))
+                  for name, file_name in manifest['tables'].items()}
+        self.metrics = manifest['metrics']
+        self._ledger = tables['ledger'].set_index(['month', 'state'])
+        self.by_year = tables['by_year'].set_index(['year', 'state'])
+        self.by_state = tables['by_state'].set_index('state')
+        if 'population' in tables:
+            self.population = tables['population'] \
+                .set_index('state')['population']
+            self.population_table = tables['population_table'] \
+                .pivot(index='state', columns='year', values='population')
+            self._update_per_capita(self.by_state.index)
+            self._update_yearly_rates(self.by_year.index)
+
+    def save(self, path: str = None) -> None:
+        """
+        Method to persist the store.
+        Args:
+         -path (str): The directory to save the store to. Defaults to the
+           path the store was opened with.
+        Returns:
+         -None
+        Raises:
+         -ImportError: If pyarrow is not installed.
+        """
+
+        try:
+            import pyarrow.feather as feather
+        except ImportError:
+            raise ImportError("Saving the store needs pyarrow "
+                              "(pip install -e .[cache])")
+
+        path = path or self.path
+        os.makedirs(path, exist_ok=True)
+        tables = {
+            'ledger': self._ledger.reset_index(),
+            'by_year': self.by_year.reset_index(),
+            'by_state': self.by_state.reset_index(),
+        }
+        if self.population is not None:
+            tables['population'] = self.population.rename('population') \
+                .rename_axis('state').reset_index()
+            tables['population_table'] = self.population_table \
+                .stack().rename('population').reset_index()
+
+        # Every save writes new files, then commits them by replacing the
+        # manifest, and only then removes the files of the previous save
+        generation = f"{os.getpid()}-{threading.get_ident()}-" \
+            f"{time.time_ns()}"
+        manifest = {'version': STORE_VERSION, 'metrics': self.metrics,
+                    'tables': {name: f"{name}-{generation}.feather"
+                               for name in tables}}
+        for name, df in tables.items():
+            feather.write_feather(df, os.path.join(
+                path, manifest['tables'][name]))
+        manifest_path = os.path.join(path, MANIFEST)
+        with open(f"{manifest_path}.{generation}.tmp", 'w') as f:
+            json.dump(manifest, f)
+        os.replace(f"{manifest_path}.{generation}.tmp", manifest_path)
+
+        for name in os.listdir(path):
+            if name.endswith('.feather') \
+                    and name not in manifest['tables'].values():
+                os.remove(os.path.join(path, name))
+
+    def ingest(self, df: pd.DataFrame) -> dict:
+        """
+        Method to apply a batch of monthly NICS rows to the aggregates.
+        Args:
+         -df (pd.DataFrame): The rows, with the 'month' ('YYYY-MM'), 'state'
+           and metric columns of the NICS file. A (month, state) repeated in
+           the batch counts once, with its last values.
+        Returns:
+         -summary (dict): The number of 'new', 'revised' and 'unchanged'
+           rows of the batch.
+        """
+
+        df = df.rename(columns={'longgun': 'long_gun'})
+        batch = pd.DataFrame(
+            df[self.metrics].astype('float64').fillna(0).to_numpy(),
+            columns=self.metrics,
+            index=pd.MultiIndex.from_arrays(
+                [df['month'].astype(str).to_numpy(),
+                 df['state'].astype(str).to_numpy()],
+                names=['month', 'state']))
+        batch = batch[~batch.index.duplicated(keep='last')]
+
+        # Diff the batch against the ledger: new rows add their counts, and
+        # revised rows add the difference with the counts ingested before
+        positions = self._ledger.index.get_indexer(batch.index)
+        known = positions >= 0
+        deltas = batch.to_numpy(copy=True)
+        deltas[known] -= self._ledger.iloc[positions[known]].to_numpy()
+        changed = ~known | deltas.any(axis=1)
+        summary = {'new': int((~known).sum()),
+                   'revised': int((known & changed).sum()),
+                   'unchanged': int((known & ~changed).sum())}
+        if not changed.any():
+            return summary
+        self._ledger = _upsert(self._ledger, batch[changed])
+
+        months = batch.index.get_level_values('month')[changed]
+        states = batch.index.get_level_values('state')[changed]
+        year, _ = parse_year_month(months.to_series())
+        delta_df = pd.DataFrame(deltas[changed], columns=self.metrics)
+        delta_df['year'] = year
+        delta_df['state'] = states
+
+        # Only the affected groups are updated
+        by_year = delta_df.groupby(['year', 'state'])[self.metrics].sum()
+        self.by_year = _upsert(self.by_year, by_year, add=True)
+        by_state = delta_df.groupby('state')[self.metrics].sum()
+        self.by_state = _upsert(self.by_state, by_state, add=True)
+        self._update_per_capita(by_state.index)
+        self._update_yearly_rates(by_year.index)
+
+        return summary
+
+    def set_population(self, pop_df: pd.DataFrame,
+                       column: str = 'pop_2014') -> None:
+        """
+        Method to set the population used for the per-capita values, which
+        are recomputed without touching the counts.
+        Args:
+         -pop_df (pd.DataFrame): The population data, with a 'state' column
+           and either a 'pop_YYYY' column per year or 'year' and
+           'population' columns (see etl.population_table). Every year is
+           used for the yearly rates.
+         -column (str): The population column of the state totals, e.g.
+           'pop_2014' for the 2014 population.
+        Returns:
+         -None
+        """
+
+        self.population_table = population_table(pop_df)
+        if column in pop_df.columns:
+            self.population = pop_df.set_index('state')[column] \
+                .astype('float64')
+        else:
+            self.population = self.population_table[int(column[4:])]
+        self.per_capita = self.per_capita.iloc[0:0]
+        self._update_per_capita(self.by_state.index)
+        self.yearly_rates = self.yearly_rates.iloc[0:0]
+        self._update_yearly_rates(self.by_year.index)
+
+    def _update_per_capita(self, states) -> None:
+        """
+        Method to recompute the per-capita values of some states.
+        Args:
+         -states: The states to recompute.
+        Returns:
+         -None
+        """
+
+        if self.population is None:
+            return
+
+        states = pd.Index(states).intersection(self.population.index)
+        counts = self.by_state.loc[states, self.metrics]
+        rates = counts.mul(100).div(self.population.loc[states], axis=0)
+        rates.columns = [perc_column(metric) for metric in self.metrics]
+
+        self.per_capita = _upsert(self.per_capita, rates)
+
+    def _update_yearly_rates(self, keys: pd.MultiIndex) -> None:
+        """
+        Method to recompute the yearly per-capita rates of some (year,
+        state) groups, dividing their totals by the population of the state
+        in that year in one aligned operation.
+        Args:
+         -keys (pd.MultiIndex): The (year, state) groups to recompute.
+        Returns:
+         -None
+        """
+
+        if self.population_table is None or len(keys) == 0:
+            return
+
+        years, states = keys.get_level_values(0), keys.get_level_values(1)
+        year_codes, unique_years = pd.factorize(years)
+        state_codes, unique_states = pd.factorize(states)
+        population = align_population(self.population_table, unique_states,
+                                      unique_years)[state_codes, year_codes]
+
+        counts = self.by_year.iloc[self.by_year.index.get_indexer(keys)] \
+            .to_numpy(dtype=float)
+        rates = pd.DataFrame(counts * 100 / population[:, None], index=keys,
+                             columns=[perc_column(metric)
+                                      for metric in self.metrics])
+
+        self.yearly_rates = _upsert(self.yearly_rates, rates)
+
+    def grouped(self) -> pd.DataFrame:
+        """
+        Method to return the (year, state) totals.
+        Returns:
+         -df (pd.DataFrame): The totals, shaped like groupby_state_and_year.
+        """
+
+        return self.by_year.sort_index().reset_index()
+
+    def relative(self) -> pd.DataFrame:
+        """
+        Method to return the state totals with their per-capita values.
+        Returns:
+         -df (pd.DataFrame): The state totals, population and per-capita
+           values of the states with population data, shaped like
+           calculate_relative_values.
+        """
+
+        df = self.by_state.join(self.population, how='inner') \
+            .join(self.per_capita, how='inner')
+
+        return df.sort_index().reset_index()
+
+    def relative_by_year(self) -> pd.DataFrame:
+        """
+        Method to return the (year, state) totals with their yearly
+        per-capita values.
+        Returns:
+         -df (pd.DataFrame): The totals and per-capita values of the states
+           with population data, by year and state.
+        """
+
+        df = self.by_year.join(self.yearly_rates.dropna(), how='inner')
+
+        return df.sort_index().reset_index()
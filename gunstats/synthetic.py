@@ -0,0 +1,110 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+# The bundled NICS file, used as the model of the synthetic data
+NICS_PATH = os.path.join('data', 'nics-firearm-background-checks.csv')
+
+# Standard deviation of the multiplicative (log-normal) noise applied to the
+# counts of every replica
+NOISE = 0.15
+
+
+def _replicas(base: pd.DataFrame, count: int,
+              rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Function to build noisy replicas of a NICS dataframe.
+    Args:
+     -base (pd.DataFrame): The NICS data the replicas are modeled on.
+     -count (int): The number of replicas.
+     -rng (np.random.Generator): The random generator.
+    Returns:
+     -df (pd.DataFrame): The replicas, one after another.
+    """
+
+    columns = [column for column in base.columns
+               if column not in ('month', 'state', 'totals')]
+    counts = base[columns].to_numpy(dtype=float)
+
+    # Every replica keeps the (month, state) rows and the blank cells of the
+    # base data, and scales each count by an independent random factor
+    values = np.tile(counts, (count, 1))
+    values *= rng.lognormal(0, NOISE, size=values.shape)
+    values = np.round(values)
+
+    df = pd.DataFrame({
+        'month': np.tile(base['month'].to_numpy(dtype=object), count),
+        'state': np.tile(base['state'].to_numpy(dtype=object), count),
+    })
+    for i, column in enumerate(columns):
+        df[column] = pd.array(values[:, i], dtype='Int64')
+    # The components add up to the totals, as in the NICS file
+    df['totals'] = pd.array(np.nansum(values, axis=1), dtype='Int64')
+
+    return df
+
+
+def generate_nics(scale: int, base_path: str = NICS_PATH,
+                  seed: int = 0) -> pd.DataFrame:
+    """
+    Function to generate synthetic NICS data with `scale` times as many rows
+    as the base file. The states, months and missing counts follow the
+    base file exactly (every (month, state) row appears `scale` times), and
+    the counts are the base counts with log-normal noise, so the data has
+    the same distributions and groups as the real one.
+    Args:
+     -scale (int): The number of rows, as a multiple of the base file.
+     -base_path (str): The NICS file the data is modeled on.
+     -seed (int): The seed of the random generator.
+    Returns:
+     -df (pd.DataFrame): The synthetic data, with the columns of the base
+       file.
+    """
+
+    base = pd.read_csv(base_path)
+    return _replicas(base, scale, np.random.default_rng(seed))[base.columns]
+
+
+def write_nics(path: str, scale: int, base_path: str = NICS_PATH,
+               seed: int = 0, chunk_rows: int = 1000000) -> str:
+    """
+    Function to write synthetic NICS data (see generate_nics) as a CSV file,
+    generating it in chunks so that large scales fit in memory.
+    Args:
+     -path (str): The path to the CSV file.
+     -scale (int): The number of rows, as a multiple of the base file.
+     -base_path (str): The NICS file the data is modeled on.
+     -seed (int): The seed of the random generator.
+     -chunk_rows (int): The approximate number of rows generated at a time.
+    Returns:
+     -path (str): The path to the CSV file.
+    """
+
+    base = pd.read_csv(base_path)
+    rng = np.random.default_rng(seed)
+    per_chunk = max(chunk_rows // len(base), 1)
+
+    # Write to a temporary file, so an interrupted run leaves no partial file
+    with open(path + '.tmp', 'w', newline='') as f:
+        for start in range(0, scale, per_chunk):
+            count = min(per_chunk, scale - start)
+            _replicas(base, count, rng)[base.columns] \
+                .to_csv(f, header=start == 0, index=False)
+    os.replace(path + '.tmp', path)
+
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='python -m gunstats.synthetic',
+        description="Write synthetic NICS data modeled on the bundled file.")
+    parser.add_argument('path', help="path to the CSV file to write")
+    parser.add_argument('--scale', type=int, default=10,
+                        help="number of rows, as a multiple of the base file")
+    parser.add_argument('--base', default=NICS_PATH,
+                        help="NICS file the data is modeled on")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_nics(args.path, args.scale, args.base, args.seed)
@@ -0,0 +1,277 @@
+import numpy as np
+import pandas as pd
+from .etl import parse_year_month
+
+# Rolling windows, in months, maintained by default
+WINDOWS = (3, 12)
+
+
+def _month_numbers(month: pd.Series) -> np.ndarray:
+    """
+    Function to number the months of a 'month' column ('YYYY-MM' strings or
+    monthly periods) consecutively, as year * 12 + month - 1.
+    Args:
+     -month (pd.Series): The 'month' column.
+    Returns:
+     -numbers (np.ndarray): The month numbers.
+    """
+
+    if isinstance(month.dtype, pd.PeriodDtype):
+        year = month.dt.year.to_numpy(dtype=np.int64)
+        month_number = month.dt.month.to_numpy(dtype=np.int64)
+    else:
+        year, month_number = parse_year_month(month)
+
+    return year.astype(np.int64) * 12 + month_number.astype(np.int64) - 1
+
+
+class MonthlySeries:
+    """
+    Class that holds the monthly NICS counts as a dense float ndarray indexed
+    by state, month and metric (NaN where a count is missing), and computes
+    rolling means, year-over-year deltas and seasonal indices for every
+    state and metric at once with numpy axis operations.
+
+    The statistics of the latest month are also kept as running sums, so
+    appending a month (see append) updates them in O(states x metrics),
+    whatever the length of the history.
+    """
+
+    def __init__(self, values: np.ndarray, states: list, start: int,
+                 metrics: list, windows: tuple = WINDOWS):
+        self.states = list(states)
+        self.metrics = list(metrics)
+        self.start = start
+        self.windows = tuple(windows)
+        self.length = values.shape[1]
+        self._values = values
+
+        # Label maps of the axes
+        self.state_index = {state: i for i, state in enumerate(self.states)}
+        self.metric_index = {metric: i for i, metric in enumerate(self.metrics)}
+
+        # Running sums and counts of the non-missing values: over the last
+        # months of each window, and by calendar month
+        filled = np.nan_to_num(values)
+        present = ~np.isnan(values)
+        self._window_sums = {}
+        self._window_counts = {}
+        for window in self.windows:
+            self._window_sums[window] = filled[:, -window:].sum(axis=1)
+            self._window_counts[window] = present[:, -window:].sum(axis=1)
+        # (every 12th month, from the first one of each calendar month)
+        self._calendar_sums = np.stack(
+            [filled[:, (month - start) % 12::12].sum(axis=1)
+             for month in range(12)], axis=1)
+        self._calendar_counts = np.stack(
+            [present[:, (month - start) % 12::12].sum(axis=1)
+             for month in range(12)], axis=1).astype(float)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, metrics: list = None,
+                   windows: tuple = WINDOWS):
+        """
+        Method to build the series from monthly NICS rows, before the month
+        is dropped (e.g. the 'renamed' stage of the pipeline).
+        Args:
+         -df (pd.DataFrame): The rows, with 'month', 'state' and metric
+           columns.
+         -metrics (list): The metric columns. Defaults to every numeric
+           column.
+         -windows (tuple): The rolling windows, in months, kept up to date
+           by append.
+        Returns:
+         -series (MonthlySeries): The series, from the first to the last
+           month of the rows. Months without a row are missing.
+        """
+
+        if metrics is None:
+            metrics = [column for column in df.columns
+                       if column not in ('year', 'state', 'month')
+                       and pd.api.types.is_numeric_dtype(df[column])]
+
+        numbers = _month_numbers(df['month'])
+        start = int(numbers.min())
+        state_codes, states = pd.factorize(df['state'], sort=True)
+
+        values = np.full((len(states), int(numbers.max()) - start + 1,
+                          len(metrics)), np.nan)
+        values[state_codes, numbers - start] = \
+            df[metrics].to_numpy(dtype=float, na_value=np.nan)
+
+        return cls(values, list(states), start, metrics, windows)
+
+    @property
+    def values(self) -> np.ndarray:
+        """
+        Method to return the counts.
+        Returns:
+         -values (np.ndarray): A view of the counts, indexed by state, month
+           and metric.
+        """
+
+        return self._values[:, :self.length]
+
+    @property
+    def months(self) -> list:
+        """
+        Method to return the labels of the month axis.
+        Returns:
+         -months (list): The months, as 'YYYY-MM' strings.
+        """
+
+        numbers = self.start + np.arange(self.length)
+        return [f'{year:04d}-{month + 1:02d}'
+                for year, month in zip(numbers // 12, numbers % 12)]
+
+    def rolling(self, window: int) -> np.ndarray:
+        """
+        Method to compute the rolling mean of every state and metric over
+        the whole history, from cumulative sums along the month axis.
+        Args:
+         -window (int): The window, in months.
+        Returns:
+         -means (np.ndarray): The mean of the non-missing counts of the last
+           `window` months, indexed by state, month and metric. NaN for the
+           first window - 1 months and for windows without any count.
+        """
+
+        values = self.values
+        pad = np.zeros((values.shape[0], 1, values.shape[2]))
+        sums = np.cumsum(np.concatenate([pad, np.nan_to_num(values)], axis=1),
+                         axis=1)
+        counts = np.cumsum(np.concatenate([pad, ~np.isnan(values)], axis=1),
+                           axis=1)
+
+        window_sums = sums[:, window:] - sums[:, :-window]
+        window_counts = counts[:, window:] - counts[:, :-window]
+        means = np.full(values.shape, np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[:, window - 1:] = window_sums / window_counts
+
+        return means
+
+    def yoy(self, relative: bool = False) -> np.ndarray:
+        """
+        Method to compute the year-over-year change of every state and metric
+        over the whole history.
+        Args:
+         -relative (bool): If True, the change is relative to the count of
+           the same month of the previous year.
+        Returns:
+         -changes (np.ndarray): The changes, indexed by state, month and
+           metric. NaN for the first 12 months and missing counts.
+        """
+
+        values = self.values
+        changes = np.full(values.shape, np.nan)
+        changes[:, 12:] = values[:, 12:] - values[:, :-12]
+        if relative:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                changes[:, 12:] /= values[:, :-12]
+
+        return changes
+
+    def seasonal_index(self) -> np.ndarray:
+        """
+        Method to compute the seasonal index of every calendar month, state
+        and metric: the mean count of the calendar month over the mean count
+        of all months.
+        Returns:
+         -indices (np.ndarray): The indices, indexed by state, calendar month
+           (0 for January) and metric.
+        """
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            calendar_means = self._calendar_sums / self._calendar_counts
+            means = self._calendar_sums.sum(axis=1) \
+                / self._calendar_counts.sum(axis=1)
+
+            return calendar_means / means[:, None, :]
+
+    def latest(self) -> dict:
+        """
+        Method to return the statistics of the latest month, from the
+        running sums.
+        Returns:
+         -latest (dict): The 'month' label, and arrays indexed by state and
+           metric: the 'value', the 'rolling_N' mean of each window and the
+           'yoy' change.
+        """
+
+        values = self.values
+        latest = {'month': self.months[-1], 'value': values[:, -1]}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for window in self.windows:
+                latest[f'rolling_{window}'] = np.where(
+                    self.length >= window,
+                    self._window_sums[window] / self._window_counts[window],
+                    np.nan)
+        latest['yoy'] = values[:, -1] - values[:, -13] \
+            if self.length > 12 else np.full(values.shape[::2], np.nan)
+
+        return latest
+
+    def append(self, month: str, df: pd.DataFrame) -> None:
+        """
+        Method to append the counts of the month following the last one and
+        update the running statistics, in O(states x metrics).
+        Args:
+         -month (str): The month, as 'YYYY-MM'.
+         -df (pd.DataFrame): The rows of the month, with 'state' and metric
+           columns. States without a row are missing.
+        Returns:
+         -None
+        Raises:
+         -ValueError: If the month does not follow the last one, or a state
+           is unknown.
+        """
+
+        number = int(_month_numbers(pd.Series([month]))[0])
+        if number != self.start + self.length:
+            raise ValueError(f"{month} does not follow {self.months[-1]}")
+        unknown = set(df['state']) - set(self.states)
+        if unknown:
+            raise ValueError(f"Unknown states: {sorted(unknown)}")
+
+        row = np.full((len(self.states), len(self.metrics)), np.nan)
+        row[[self.state_index[state] for state in df['state']]] = \
+            df[self.metrics].to_numpy(dtype=float, na_value=np.nan)
+
+        # Double the capacity when full, so appends are amortized O(1)
+        if self.length == self._values.shape[1]:
+            self._values = np.concatenate(
+                [self._values, np.full(self._values.shape, np.nan)], axis=1)
+        self._values[:, self.length] = row
+        self.length += 1
+
+        # Each window gains the new month and loses the one leaving it
+        filled, present = np.nan_to_num(row), ~np.isnan(row)
+        for window in self.windows:
+            self._window_sums[window] += filled
+            self._window_counts[window] += present
+            if self.length > window:
+                leaving = self._values[:, self.length - 1 - window]
+                self._window_sums[window] -= np.nan_to_num(leaving)
+                self._window_counts[window] -= ~np.isnan(leaving)
+        self._calendar_sums[:, number % 12] += filled
+        self._calendar_counts[:, number % 12] += present
+
+    def to_frame(self, values: np.ndarray = None) -> pd.DataFrame:
+        """
+        Method to convert the counts, or a statistic indexed like them (e.g.
+        rolling or yoy), to one row per month and state.
+        Args:
+         -values (np.ndarray): The statistic. Defaults to the counts.
+        Returns:
+         -df (pd.DataFrame): The 'month', 'state' and metric columns, sorted
+           by month and state.
+        """
+
+        values = self.values if values is None else values
+        df = pd.DataFrame(values.transpose(1, 0, 2).reshape(
+            -1, len(self.metrics)), columns=self.metrics)
+        df.insert(0, 'state', self.states * self.length)
+        df.insert(0, 'month', np.repeat(self.months, len(self.states)))
+
+        return df
@@ -11,15 +11,21 @@ setup(
     url="https://github.com/mlavinv117/gunstats",
     packages=find_packages(),
     install_requires=[
-        "pandas",
+        "pandas>=3.0",
         "matplotlib",
         "folium",
         "selenium"
     ],
+    extras_require={
+        "cache": ["pyarrow"],
+    },
+    entry_points={
+        "console_scripts": ["gunstats=gunstats.main:main"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.11',
 )
@@ -1,10 +1,45 @@
+import asyncio
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
+import unittest.mock
+import numpy as np
 import pandas as pd
 from gunstats.etl import read_csv, clean_csv, rename_col, breakdown_date, \
     erase_month, groupby_state_and_year, groupby_state, clean_states, \
-    merge_datasets, calculate_relative_values
+    merge_datasets, calculate_relative_values, stream_groupby_state_and_year, \
+    parse_year_month, population_table, compact_counts, state_keys, \
+    validate_rows
 from gunstats.calcs import print_biggest_handguns, print_biggest_longguns, \
-    analyze_state_data
+    analyze_state_data, choropleth_bins, save_choropleth_png, \
+    create_choropleth_map, create_layered_choropleth_map
+from gunstats.pipeline import Pipeline
+from gunstats.engine import set_engine
+from gunstats.cache import ArtifactCache, cached_read, prune_cache
+from gunstats.instrument import recording, set_quiet, stage
+from gunstats.render import BrowserPool
+from gunstats.geometry import load_geojson, simplify_geojson, simplify_ring
+from gunstats.store import AggregateStore
+from gunstats.cube import StateYearCube
+from gunstats.timeseries import MonthlySeries
+from gunstats.metrics import MetricRegistry, NICS_FAMILIES
+from gunstats.scheduler import Task, run_tasks
+from gunstats.service import StatsService
+from gunstats.main import main, run_batch
+from gunstats.synthetic import generate_nics, write_nics
+import threading
+import time
+from contextlib import redirect_stdout
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 
 class TestETL(unittest.TestCase):
@@ -23,6 +58,90 @@ class TestETL(unittest.TestCase):
         """
         self.assertIsInstance(self._df, pd.DataFrame)
 
+    def test_read_csv_compact(self):
+        """
+        Test the compact mode of read_csv to ensure it only loads the
+        pipeline columns, with compact dtypes and the same values.
+        """
+        compact_df = read_csv("./data/nics-firearm-background-checks.csv",
+                              compact=True)
+        self.assertEqual(list(compact_df.columns),
+                         ['month', 'state', 'permit', 'handgun', 'long_gun'])
+        self.assertEqual(compact_df['state'].dtype, 'category')
+        self.assertEqual(compact_df['handgun'].dtype, 'Int32')
+        self.assertIsInstance(compact_df['month'].dtype, pd.PeriodDtype)
+        self.assertEqual(compact_df['handgun'].sum(), self._df['handgun'].sum())
+
+        # The grouped values match the ones of the default mode
+        compact_grouped = groupby_state_and_year(
+            erase_month(breakdown_date(clean_csv(compact_df))))
+        grouped = groupby_state_and_year(
+            erase_month(breakdown_date(clean_csv(self._df))))
+        self.assertEqual(print_biggest_handguns(compact_grouped),
+                         print_biggest_handguns(grouped))
+        self.assertEqual(compact_grouped['long_gun'].sum(),
+                         grouped['long_gun'].sum())
+
+    def test_validate_rows(self):
+        """
+        Test that the rows with an unknown or missing state, a malformed
+        month or an invalid count are quarantined with their reasons, in
+        both the default and the compact mode.
+        """
+        states = state_keys(read_csv("./data/us-state-populations.csv"),
+                            "./data/us-states.json")
+        self.assertIn('District of Columbia', states)
+        self.assertIn('Guam', states)
+        _, quarantine = validate_rows(self._df, states)
+        self.assertTrue(quarantine.empty)
+
+        _dir = tempfile.mkdtemp()
+        path = os.path.join(_dir, 'nics.csv')
+        with open("./data/nics-firearm-background-checks.csv") as f:
+            lines = f.read().splitlines()
+        lines[1] = lines[1].replace('Alabama', 'Alabamma')
+        lines[3] = lines[3].replace('2020-03', '2020-13')
+        lines[4] = lines[4].replace(',Arkansas,', ',,')
+        fields = lines[5].split(',')
+        fields[4], fields[5] = '-5', '3.5'
+        lines[5] = ','.join(fields)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        for compact in [False, True]:
+            df, quarantine = validate_rows(read_csv(path, compact=compact),
+                                           states)
+            self.assertEqual(quarantine['reason'].to_dict(), {
+                0: 'unknown state', 2: 'invalid month', 3: 'missing state',
+                4: 'negative count; non-integer count'})
+            self.assertEqual(len(df), len(self._df) - 4)
+            self.assertNotIn(4, df.index)
+        shutil.rmtree(_dir)
+
+        # Blank count columns, as in the early months, are valid
+        df = compact_counts(pd.DataFrame({
+            'month': ['1998-11', '1998-11'], 'state': ['Ohio', 'Utah'],
+            'permit': [np.nan, np.nan], 'handgun': [1.0, -2.0]}))
+        self.assertEqual(str(df['permit'].dtype), 'Int32')
+        df, quarantine = validate_rows(df, states)
+        self.assertEqual(quarantine['reason'].to_dict(),
+                         {1: 'negative count'})
+        self.assertEqual(list(df.index), [0])
+
+    def test_compact_counts(self):
+        """
+        Test that whole counts are stored as nullable integers, widened to
+        Int64 when needed, and fractional ones are left as floats.
+        """
+        df = compact_counts(pd.DataFrame({
+            'state': ['Ohio', 'Utah'], 'permit': [1.0, np.nan],
+            'handgun': [2, 3], 'admin': [3e10, 1.0], 'other': [0.5, 1.0]}))
+        self.assertEqual(df.dtypes.astype(str).to_dict(), {
+            'state': 'str', 'permit': 'Int32', 'handgun': 'Int32',
+            'admin': 'Int64', 'other': 'float64'})
+        self.assertTrue(pd.isna(df['permit'][1]))
+        self.assertEqual(df['admin'][0], 30000000000)
+
     def test_clean_csv(self):
         """
         Test the clean_csv function to ensure it retains only the specified
@@ -52,6 +171,35 @@ class TestETL(unittest.TestCase):
         self.assertIn('year', df_with_dates.columns)
         self.assertIn('month', df_with_dates.columns)
 
+    def test_parse_year_month(self):
+        """
+        Test the parse_year_month function to ensure it parses valid values
+        into compact arrays and rejects malformed ones in bulk.
+        """
+        for dtype in ['str', object]:
+            months = pd.Series(['1998-11', '2020-03'], dtype=dtype)
+            year, month = parse_year_month(months)
+            self.assertEqual(year.tolist(), [1998, 2020])
+            self.assertEqual(month.tolist(), [11, 3])
+            self.assertEqual(year.dtype, 'int16')
+            self.assertEqual(month.dtype, 'int8')
+
+            malformed = pd.Series(['2020-01', None, '2020-13', '20x0-01',
+                                   '2020-011', '2020-1'], dtype=dtype)
+            with self.assertRaisesRegex(ValueError, r'\(5 rows\)'):
+                parse_year_month(malformed)
+
+    def test_breakdown_date_drop_month(self):
+        """
+        Test the drop_month option of breakdown_date to ensure it gives the
+        same result as erase_month.
+        """
+        cleaned_df = clean_csv(self._df)
+        df_without_month = erase_month(breakdown_date(cleaned_df))
+        pd.testing.assert_frame_equal(
+            breakdown_date(cleaned_df, drop_month=True), df_without_month)
+        self.assertEqual(df_without_month['year'].min(), 1998)
+
     def test_erase_month(self):
         """
         Test the erase_month function to ensure it removes the 'month' column.
@@ -73,6 +221,40 @@ class TestETL(unittest.TestCase):
         self.assertIn('year', grouped_df.columns)
         self.assertIn('state', grouped_df.columns)
 
+    def test_stream_groupby_state_and_year(self):
+        """
+        Test the stream_groupby_state_and_year function to ensure it returns
+        the same dataframe as the in-memory functions.
+        """
+        cleaned_df = clean_csv(self._df)
+        df_with_dates = breakdown_date(cleaned_df)
+        df_without_month = erase_month(df_with_dates)
+        grouped_df = groupby_state_and_year(df_without_month)
+        streamed_df = stream_groupby_state_and_year(
+            "./data/nics-firearm-background-checks.csv", chunksize=1000)
+        pd.testing.assert_frame_equal(streamed_df, grouped_df)
+
+    def test_stream_groupby_state_and_year_empty(self):
+        """
+        Test that stream_groupby_state_and_year returns an empty dataframe
+        with the output columns for an empty or a header-only file.
+        """
+        _dir = tempfile.mkdtemp()
+        empty_path = os.path.join(_dir, 'empty.csv')
+        header_path = os.path.join(_dir, 'header.csv')
+        with open(empty_path, 'w') as f:
+            f.write('')
+        with open(header_path, 'w') as f:
+            f.write('month,state,permit,handgun,long_gun\n')
+
+        for path in (empty_path, header_path):
+            streamed_df = stream_groupby_state_and_year(path)
+            self.assertTrue(streamed_df.empty)
+            self.assertEqual(list(streamed_df.columns),
+                             ['year', 'state', 'permit', 'handgun',
+                              'long_gun'])
+        shutil.rmtree(_dir)
+
     def test_groupby_state(self):
         """
         Test the groupby_state function to ensure it groups the data correctly.
@@ -193,6 +375,1137 @@ class TestCalcs(unittest.TestCase):
         # Ensure the mean changed
         self.assertNotEqual(old_mean_permit_perc, new_mean_permit_perc)
 
+    def test_save_choropleth_png(self):
+        """
+        Test the save_choropleth_png function to ensure it rasterizes a map
+        without a browser, binned like folium.
+        """
+        relative_values_df = Pipeline().get('relative')
+        bin_edges, colors = choropleth_bins(relative_values_df['permit_perc'])
+        self.assertEqual(len(bin_edges), 7)
+        self.assertEqual(len(colors), 6)
+        self.assertAlmostEqual(bin_edges[-1],
+                               relative_values_df['permit_perc'].max())
+
+        _dir = tempfile.mkdtemp()
+        png_file_path = save_choropleth_png(
+            relative_values_df, 'permit_perc', "./data/us-states.json",
+            'Permit Percentage', os.path.join(_dir, 'permit_perc_map.png'))
+        with open(png_file_path, 'rb') as f:
+            self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+        shutil.rmtree(_dir)
+
+    def test_layered_choropleth_map(self):
+        """
+        Test that the layered map embeds the geometry once, with one layer
+        per column, and draws every layer in a single image.
+        """
+        relative_values_df = Pipeline().get('relative')
+        maps = [('permit_perc', 'Permit Percentage'),
+                ('handgun_perc', 'Handgun Percentage'),
+                ('longgun_perc', 'Long Gun Percentage')]
+
+        _dir = tempfile.mkdtemp()
+        create_layered_choropleth_map(relative_values_df, maps,
+                                      "./data/us-states.json", 'perc_maps',
+                                      backend='matplotlib', output_dir=_dir)
+        with open(os.path.join(_dir, 'perc_maps.html')) as f:
+            html = f.read()
+        with open(os.path.join(_dir, 'perc_maps.png'), 'rb') as f:
+            self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+        shutil.rmtree(_dir)
+
+        self.assertEqual(html.count('"FeatureCollection"'), 1)
+        for _, map_title in maps:
+            self.assertIn(f'_layers["{map_title}"] = L.geoJson', html)
+
+    def test_layered_map_escapes_titles(self):
+        """
+        Test that the titles of a layered map are escaped in its legends and
+        layer names.
+        """
+        relative_values_df = Pipeline().get('relative')
+        maps = [('permit_perc', 'Permits <per 100> & more')]
+
+        _dir = tempfile.mkdtemp()
+        create_layered_choropleth_map(relative_values_df, maps,
+                                      "./data/us-states.json", 'perc_maps',
+                                      backend='matplotlib', output_dir=_dir,
+                                      image_formats=())
+        with open(os.path.join(_dir, 'perc_maps.html')) as f:
+            html = f.read()
+        shutil.rmtree(_dir)
+
+        # jinja's tojson writes <, > and & as unicode escapes
+        escaped = 'Permits \\u0026lt;per 100\\u0026gt; \\u0026amp; more'
+        self.assertIn(f'_layers["{escaped}"] = L.geoJson', html)
+        self.assertIn(f'\\u003cb\\u003e{escaped}\\u003c/b\\u003e', html)
+        self.assertNotIn('\\u003cper 100\\u003e', html)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Copy the bundled data into a temporary directory, so the source files
+        can be modified without touching the repository.
+        """
+        self._dir = tempfile.mkdtemp()
+        for name in ['nics-firearm-background-checks.csv',
+                     'us-state-populations.csv']:
+            shutil.copy(os.path.join('data', name), self._dir)
+        self.pipeline = Pipeline(self._dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_stages_are_memoized(self):
+        """
+        Test that a stage is computed once and reused by downstream stages.
+        """
+        calls = []
+        self.pipeline.add_stage('counted', lambda df: calls.append(1) or df,
+                                deps=['renamed'])
+        grouped_df = self.pipeline.get('grouped')
+        self.pipeline.get('counted')
+        self.pipeline.get('counted')
+        self.assertEqual(len(calls), 1)
+        self.assertIs(self.pipeline.get('grouped'), grouped_df)
+
+    def test_stages_invalidated_on_source_change(self):
+        """
+        Test that only the stages reading a modified source are recomputed.
+        """
+        grouped_df = self.pipeline.get('grouped')
+        population_df = self.pipeline.get('population')
+
+        # Drop the last row of the NICS file and move its mtime forward
+        path = self.pipeline.nics_path
+        with open(path) as f:
+            lines = f.readlines()
+        with open(path, 'w') as f:
+            f.writelines(lines[:-1])
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        self.assertIsNot(self.pipeline.get('grouped'), grouped_df)
+        self.assertEqual(len(self.pipeline.get('raw')), len(lines) - 2)
+        self.assertIs(self.pipeline.get('population'), population_df)
+
+    def test_relative_matches_functions(self):
+        """
+        Test that the pipeline returns the same per-capita values as chaining
+        the ETL functions by hand.
+        """
+        relative_values_df = self.pipeline.get('relative')
+        self.assertIn('permit_perc', relative_values_df.columns)
+        self.assertNotIn('permit_perc', self.pipeline.get('merged').columns)
+        self.assertAlmostEqual(relative_values_df['permit_perc'].mean(),
+                               34.878732819341515, places=2)
+
+    def test_stages_do_not_modify_inputs(self):
+        """
+        Test that the per-capita and analysis stages leave their inputs
+        untouched.
+        """
+        merged_df = self.pipeline.get('merged')
+        merged_before = merged_df.copy()
+        relative_values_df = calculate_relative_values(merged_df)
+        pd.testing.assert_frame_equal(merged_df, merged_before)
+
+        relative_before = relative_values_df.copy()
+        with redirect_stdout(io.StringIO()):
+            analyze_state_data(relative_values_df)
+        pd.testing.assert_frame_equal(relative_values_df, relative_before)
+
+    def test_rates_follow_population(self):
+        """
+        Test that a new population file recomputes the yearly rates but not
+        the aggregates.
+        """
+        cube = self.pipeline.get('cube')
+        rates = self.pipeline.get('rates')
+
+        path = self.pipeline.population_path
+        pop_df = pd.read_csv(path)
+        pop_df['pop_2014'] *= 2
+        pop_df.to_csv(path, index=False)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        self.assertIs(self.pipeline.get('cube'), cube)
+        self.assertAlmostEqual(self.pipeline.get('rates')
+                               .value('Ohio', 2015, 'permit') * 2,
+                               rates.value('Ohio', 2015, 'permit'))
+
+    def test_quarantine(self):
+        """
+        Test that the invalid NICS rows are set aside by the pipeline, and
+        that a new population file with the same states does not re-read
+        the NICS file.
+        """
+        self.assertTrue(self.pipeline.get('quarantine').empty)
+
+        path = self.pipeline.nics_path
+        with open(path) as f:
+            lines = f.readlines()
+        lines[1] = lines[1].replace('Alabama', 'Alabamma')
+        with open(path, 'w') as f:
+            f.writelines(lines)
+
+        raw_df = self.pipeline.get('raw')
+        self.assertEqual(len(raw_df), len(lines) - 2)
+        self.assertEqual(self.pipeline.get('quarantine')['reason'].tolist(),
+                         ['unknown state'])
+
+        path = self.pipeline.population_path
+        pop_df = pd.read_csv(path)
+        pop_df['pop_2014'] *= 2
+        pop_df.to_csv(path, index=False)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIs(self.pipeline.get('raw'), raw_df)
+
+    def test_lean_mode(self):
+        """
+        Test that the lean mode returns the same results while releasing the
+        intermediate stages.
+        """
+        lean = Pipeline(self._dir, lean=True)
+        pd.testing.assert_frame_equal(lean.get('relative'),
+                                      self.pipeline.get('relative'))
+        pd.testing.assert_frame_equal(lean.get('undated'),
+                                      self.pipeline.get('undated'))
+        self.assertNotIn('cleaned', lean._results)
+        self.assertNotIn('merged', lean._results)
+
+        # The stages with several consumers are kept, so the file is not
+        # read again for the others
+        with unittest.mock.patch('gunstats.pipeline.read_csv') as read:
+            self.assertTrue(lean.get('quarantine').empty)
+            self.assertEqual(len(lean.get('raw').columns), 5)
+        read.assert_not_called()
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class TestEngine(unittest.TestCase):
+
+    def test_parity(self):
+        """
+        Test that the pandas and Arrow engines compute identical stages, in
+        both the default and the compact mode.
+        """
+        for compact in [False, True]:
+            pandas_pipeline = Pipeline(compact=compact, engine='pandas')
+            arrow_pipeline = Pipeline(compact=compact, engine='arrow')
+            for name in ['raw', 'grouped', 'state_grouped', 'population',
+                         'merged', 'relative']:
+                pd.testing.assert_frame_equal(
+                    pandas_pipeline.get(name).reset_index(drop=True),
+                    arrow_pipeline.get(name).reset_index(drop=True))
+
+    def test_unknown_engine(self):
+        """
+        Test that an unknown engine is rejected.
+        """
+        with self.assertRaises(ValueError):
+            set_engine('polars')
+        with self.assertRaises(ValueError):
+            groupby_state(pd.DataFrame({'state': ['Texas'], 'permit': [1]}),
+                          engine='polars')
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Copy the NICS file into a temporary directory holding the cache too.
+        """
+        self._dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self._dir, 'cache')
+        self.path = shutil.copy('./data/nics-firearm-background-checks.csv',
+                                self._dir)
+        self.reads = []
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _read(self, path, compact=False):
+        self.reads.append(path)
+        return read_csv(path, compact=compact)
+
+    def test_warm_read_skips_parsing(self):
+        """
+        Test that a second read of an unchanged file is served from the cache
+        with identical contents.
+        """
+        for compact in [False, True]:
+            cold_df = cached_read(self.path, self._read, self.cache_dir,
+                                  compact=compact)
+            warm_df = cached_read(self.path, self._read, self.cache_dir,
+                                  compact=compact)
+            pd.testing.assert_frame_equal(cold_df, warm_df)
+        self.assertEqual(len(self.reads), 2)
+
+    def test_stale_entries_are_replaced(self):
+        """
+        Test that modifying the source invalidates and replaces its entry.
+        """
+        cached_read(self.path, self._read, self.cache_dir)
+        with open(self.path, 'a') as f:
+            f.write('2020-04,Alabama' + ',0' * 25 + '\n')
+        df = cached_read(self.path, self._read, self.cache_dir)
+        self.assertEqual(len(self.reads), 2)
+        self.assertEqual(df['month'].iloc[-1], '2020-04')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_concurrent_writers(self):
+        """
+        Test that concurrent cold reads of the same file each write through
+        their own temporary file and leave a single entry.
+        """
+        errors = []
+
+        def read():
+            try:
+                cached_read(self.path, self._read, self.cache_dir)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_prune_cache(self):
+        """
+        Test that pruning bounds the size of the cache directory.
+        """
+        cached_read(self.path, self._read, self.cache_dir)
+        cached_read(self.path, self._read, self.cache_dir, compact=True)
+        self.assertEqual(prune_cache(self.cache_dir, 10 ** 9), 0)
+        self.assertEqual(prune_cache(self.cache_dir, 0), 2)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+class TestArtifactCache(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.cache = ArtifactCache(os.path.join(self._dir, 'cache'))
+        self.df = Pipeline().get('relative')[['state', 'permit_perc']]
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _create_map(self, df, output_dir):
+        create_choropleth_map(df, 'permit_perc', "./data/us-states.json",
+                              'Permit Percentage', 'permit_perc_map',
+                              backend='matplotlib', html=False,
+                              output_dir=output_dir, cache=self.cache)
+        return os.path.join(output_dir, 'permit_perc_map.png')
+
+    def test_unchanged_maps_are_not_rendered(self):
+        """
+        Test that a map of unchanged values is copied from the cache, and a
+        changed value renders it again.
+        """
+        with unittest.mock.patch('gunstats.calcs.save_choropleth_png',
+                                 wraps=save_choropleth_png) as render:
+            cold_png = self._create_map(self.df, os.path.join(self._dir, 'a'))
+            warm_png = self._create_map(self.df, os.path.join(self._dir, 'b'))
+            with open(cold_png, 'rb') as cold, open(warm_png, 'rb') as warm:
+                self.assertEqual(cold.read(), warm.read())
+            self.assertEqual(render.call_count, 1)
+
+            changed_df = self.df.assign(permit_perc=self.df['permit_perc']
+                                        .where(self.df['state'] != 'Texas',
+                                               0))
+            self._create_map(changed_df, os.path.join(self._dir, 'a'))
+            self.assertEqual(render.call_count, 2)
+
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_concurrent_puts(self):
+        """
+        Test that writers storing the same key at the same time all succeed,
+        and that storing an existing key adds its files to the entry.
+        """
+        paths = []
+        for extension in ['html', 'png']:
+            paths.append(os.path.join(self._dir, f'map.{extension}'))
+            with open(paths[-1], 'w') as f:
+                f.write(extension)
+
+        errors = []
+
+        def put():
+            try:
+                self.cache.put('key', paths[:1])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=put) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        self.cache.put('key', paths[1:])
+        self.assertEqual(os.listdir(self.cache.cache_dir), ['key'])
+        self.assertTrue(self.cache.get('key', paths))
+
+    def test_eviction(self):
+        """
+        Test that the cache is bounded to its size, keeping the most
+        recently used entries.
+        """
+        self.cache.max_bytes = 0
+        self._create_map(self.df, self._dir)
+        self.assertEqual(os.listdir(self.cache.cache_dir), [])
+
+        self.cache.max_bytes = 10 ** 9
+        self._create_map(self.df, self._dir)
+        self._create_map(self.df.assign(permit_perc=0.0), self._dir)
+        self.assertEqual(len(os.listdir(self.cache.cache_dir)), 2)
+        self.assertEqual(self.cache.prune(1), 2)
+
+
+class TestInstrument(unittest.TestCase):
+
+    def tearDown(self):
+        set_quiet(False)
+
+    def test_quiet_mode(self):
+        """
+        Test that quiet mode turns off the validation prints.
+        """
+        df = read_csv("./data/us-state-populations.csv")
+        for quiet in [False, True]:
+            set_quiet(quiet)
+            output = io.StringIO()
+            with redirect_stdout(output):
+                clean_states(df)
+            self.assertEqual(output.getvalue() == '', quiet)
+
+    def test_recording_report(self):
+        """
+        Test that a recording measures every stage and saves a JSON report
+        and cProfile statistics.
+        """
+        _dir = tempfile.mkdtemp()
+        report_path = os.path.join(_dir, 'report.json')
+        profile_path = os.path.join(_dir, 'profile.prof')
+        set_quiet()
+        with recording(report_path, profile_path):
+            df = read_csv("./data/nics-firearm-background-checks.csv")
+            clean_csv(df)
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertTrue(os.path.exists(profile_path))
+        shutil.rmtree(_dir)
+
+        self.assertEqual([s['stage'] for s in report['stages']],
+                         ['read_csv', 'clean_csv'])
+        read_stage, clean_stage = report['stages']
+        self.assertIsNone(read_stage['rows_in'])
+        self.assertEqual(read_stage['rows_out'], len(df))
+        self.assertEqual(clean_stage['rows_in'], len(df))
+        self.assertGreater(read_stage['peak_memory_delta'], 0)
+        self.assertGreaterEqual(read_stage['wall_time'], 0)
+
+
+    def test_nested_stage_peaks(self):
+        """
+        Test that a stage running another stage keeps its own memory peak,
+        reached before the inner stage started.
+        """
+        @stage
+        def inner():
+            return np.ones(1000)
+
+        @stage
+        def outer():
+            np.ones(10 ** 6).sum()
+            return inner()
+
+        with recording() as recorder:
+            outer()
+
+        peaks = {s['stage']: s['peak_memory_delta'] for s in recorder.stages}
+        self.assertGreater(peaks['outer'], 8 * 10 ** 6)
+        self.assertLess(peaks['inner'], 10 ** 6)
+
+
+class _StaticDriver:
+    """
+    Stand-in for a webdriver that renders instantly, used to test the pool
+    logic without a browser.
+    """
+    started = 0
+
+    def __init__(self):
+        _StaticDriver.started += 1
+        self.quit_called = False
+
+    def get(self, url):
+        self.url = url
+
+    def execute_script(self, script):
+        return True
+
+    def save_screenshot(self, path):
+        with open(path, 'w') as f:
+            f.write(self.url)
+
+    def quit(self):
+        self.quit_called = True
+
+
+class TestBrowserPool(unittest.TestCase):
+
+    def test_drivers_are_reused(self):
+        """
+        Test that the pool starts at most `size` browsers and reuses them
+        across renders.
+        """
+        _dir = tempfile.mkdtemp()
+        jobs = [(os.path.join(_dir, f'{i}.html'), os.path.join(_dir, f'{i}.png'))
+                for i in range(5)]
+        _StaticDriver.started = 0
+        set_quiet()
+        with BrowserPool(size=2, driver_factory=_StaticDriver) as pool:
+            pngs = pool.render_many(jobs)
+            pool.render_many(jobs)
+            drivers = list(pool._drivers)
+        set_quiet(False)
+
+        self.assertEqual(pngs, [png for _, png in jobs])
+        self.assertTrue(all(os.path.exists(png) for png in pngs))
+        self.assertLessEqual(_StaticDriver.started, 2)
+        self.assertTrue(all(driver.quit_called for driver in drivers))
+        shutil.rmtree(_dir)
+
+
+class TestGeometry(unittest.TestCase):
+
+    def test_geometry_is_cached(self):
+        """
+        Test that the parsed and simplified geometries are built only once.
+        """
+        geo_json_path = "./data/us-states.json"
+        self.assertIs(load_geojson(geo_json_path), load_geojson(geo_json_path))
+        self.assertIs(simplify_geojson(geo_json_path, zoom=4),
+                      simplify_geojson(geo_json_path, 0.02))
+        self.assertIs(simplify_geojson(geo_json_path),
+                      load_geojson(geo_json_path))
+
+    def test_simplify_ring(self):
+        """
+        Test that simplifying a ring drops the points closer than the
+        tolerance and keeps it closed.
+        """
+        ring = [[0, 0], [1, 0.001], [2, 0], [2, 2], [1, 2.5], [0, 2], [0, 0]]
+        simplified = simplify_ring(ring, 0.1)
+        self.assertEqual(simplified, [[0, 0], [2, 0], [2, 2], [1, 2.5],
+                                      [0, 2], [0, 0]])
+        self.assertEqual(simplify_ring(ring[:4] + [[0, 0]], 10),
+                         ring[:4] + [[0, 0]])
+
+        full = load_geojson("./data/us-states.json")
+        simplified = simplify_geojson("./data/us-states.json", 0.05)
+        self.assertEqual(len(full['features']), len(simplified['features']))
+        for feature in simplified['features']:
+            if feature['geometry']['type'] == 'Polygon':
+                exterior = feature['geometry']['coordinates'][0]
+                self.assertEqual(exterior[0], exterior[-1])
+
+
+class TestAggregateStore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Compute the aggregates with the in-memory pipeline once.
+        """
+        cls.pipeline = Pipeline()
+        cls._df = cls.pipeline.get('raw')
+
+    def test_incremental_ingest(self):
+        """
+        Test that ingesting the history in two batches gives the same totals
+        and per-capita values as the in-memory pipeline.
+        """
+        store = AggregateStore()
+        store.set_population(self.pipeline.get('population'))
+        store.ingest(self._df[self._df['month'] < '2015-01'])
+        summary = store.ingest(self._df[self._df['month'] >= '2015-01'])
+        self.assertEqual(summary['new'],
+                         (self._df['month'] >= '2015-01').sum())
+        pd.testing.assert_frame_equal(store.grouped(),
+                                      self.pipeline.get('grouped'),
+                                      check_index_type=False)
+
+        relative_values_df = self.pipeline.get('relative').set_index('state')
+        store_df = store.relative().set_index('state')
+        self.assertEqual(len(store_df), len(relative_values_df))
+        for column in ['permit_perc', 'handgun_perc', 'longgun_perc']:
+            pd.testing.assert_series_equal(
+                store_df[column],
+                relative_values_df.loc[store_df.index, column])
+
+        # The yearly rates, updated per batch, match the cube's
+        rates = self.pipeline.get('rates')
+        yearly_df = store.relative_by_year()
+        grouped_df = self.pipeline.get('grouped')
+        self.assertEqual(len(yearly_df), grouped_df['state'].isin(
+            self.pipeline.get('population')['state']).sum())
+        for row in yearly_df.sample(20, random_state=0).itertuples():
+            self.assertAlmostEqual(row.handgun_perc,
+                                   rates.value(row.state, row.year,
+                                               'handgun'))
+
+    def test_revised_months(self):
+        """
+        Test that duplicate months are skipped and revised months are
+        applied as deltas, and that the store can be saved and reopened.
+        """
+        _dir = tempfile.mkdtemp()
+        store = AggregateStore(os.path.join(_dir, 'store'))
+        store.ingest(self._df)
+        last_month = self._df[self._df['month'] == '2020-03']
+        self.assertEqual(store.ingest(last_month)['unchanged'],
+                         len(last_month))
+
+        revised = last_month.copy()
+        revised.loc[revised['state'] == 'Texas', 'handgun'] += 100
+        summary = store.ingest(revised)
+        self.assertEqual((summary['revised'], summary['unchanged']),
+                         (1, len(last_month) - 1))
+        store.save()
+
+        reopened = AggregateStore(os.path.join(_dir, 'store'))
+        grouped_df = self.pipeline.get('grouped').set_index(['year', 'state'])
+        self.assertEqual(reopened.by_year.loc[(2020, 'Texas'), 'handgun'],
+                         grouped_df.loc[(2020, 'Texas'), 'handgun'] + 100)
+        self.assertEqual(reopened.by_state.loc['Texas', 'handgun'],
+                         self._df.loc[self._df['state'] == 'Texas',
+                                      'handgun'].sum() + 100)
+        shutil.rmtree(_dir)
+
+
+class TestCube(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Build the cube from the (year, state) totals once.
+        """
+        cls.grouped_df = Pipeline().get('grouped')
+        cls.cube = StateYearCube.from_grouped(cls.grouped_df)
+
+    def test_lookups(self):
+        """
+        Test that the cube answers the same extremes and totals as the
+        grouped dataframe.
+        """
+        self.assertEqual(self.cube.metrics, ['permit', 'handgun', 'long_gun'])
+        self.assertEqual(print_biggest_handguns(self.cube),
+                         ('Florida', 2016, 662308))
+        self.assertEqual(print_biggest_longguns(self.cube),
+                         ('Pennsylvania', 2012, 873543))
+        self.assertEqual(self.cube.value('Florida', 2016, 'handgun'), 662308)
+
+    def test_reductions(self):
+        """
+        Test that the axis reductions match the pandas groupbys.
+        """
+        yearly_df = self.grouped_df.groupby('year')['handgun'].sum()
+        self.assertEqual(self.cube.by_year()['handgun'].tolist(),
+                         yearly_df.astype(int).tolist())
+
+        state_df = groupby_state(self.cube).set_index('state')
+        expected_df = groupby_state(self.grouped_df).set_index('state')
+        self.assertEqual(state_df['long_gun'].tolist(),
+                         expected_df['long_gun'].astype(int).tolist())
+
+        frame = self.cube.to_frame()
+        self.assertEqual(len(frame), len(self.grouped_df))
+        self.assertEqual(frame['permit'].tolist(),
+                         self.grouped_df['permit'].astype(int).tolist())
+
+    def test_top_k(self):
+        """
+        Test that top_k ranks every NICS count column in one call, with the
+        same cells as sorting each column, overall and per year.
+        """
+        df = read_csv("./data/nics-firearm-background-checks.csv")
+        grouped_df = groupby_state_and_year(breakdown_date(df, drop_month=True))
+        cube = StateYearCube.from_grouped(grouped_df)
+        self.assertEqual(len(cube.metrics), 25)
+
+        top_df = cube.top_k(3)
+        for metric in cube.metrics:
+            expected_df = grouped_df.sort_values(
+                [metric, 'year', 'state'], ascending=[False, True, True],
+                kind='stable').head(3)
+            metric_df = top_df[top_df['metric'] == metric]
+            self.assertEqual(metric_df['rank'].tolist(), [1, 2, 3])
+            self.assertEqual(metric_df['state'].tolist(),
+                             expected_df['state'].tolist())
+            self.assertEqual(metric_df['value'].tolist(),
+                             expected_df[metric].astype(int).tolist())
+
+        yearly_df = cube.top_k(1, by='year', metrics=['handgun'])
+        expected_df = grouped_df.loc[grouped_df.groupby('year')['handgun']
+                                     .idxmax()]
+        self.assertEqual(yearly_df['state'].tolist(),
+                         expected_df['state'].tolist())
+        self.assertEqual(len(cube.top_k(2, by='state')),
+                         25 * 2 * len(cube.states))
+
+        with self.assertRaises(ValueError):
+            cube.top_k(0)
+        with self.assertRaises(ValueError):
+            cube.top_k(-2)
+        with self.assertRaises(ValueError):
+            cube.top_k(1, by='month')
+
+    def test_top_k_missing_cells(self):
+        """
+        Test that top_k never ranks the cells without data: the (state,
+        year) cells absent from the totals, and the rates without a
+        population.
+        """
+        cube = StateYearCube.from_grouped(pd.DataFrame({
+            'year': [2000, 2000, 2001], 'state': ['Ohio', 'Utah', 'Utah'],
+            'permit': [0, 5, 7]}))
+        top_df = cube.top_k(5)
+        self.assertEqual(list(zip(top_df['state'], top_df['year'])),
+                         [('Utah', 2001), ('Utah', 2000), ('Ohio', 2000)])
+        self.assertEqual(top_df['rank'].tolist(), [1, 2, 3])
+        ohio_df = cube.top_k(2, by='state')
+        self.assertEqual(ohio_df[ohio_df['state'] == 'Ohio']['year'].tolist(),
+                         [2000])
+
+        population = pd.DataFrame({2000: [1e3]}, index=['Utah'])
+        rates_df = cube.per_capita(population).top_k(5)
+        self.assertEqual(rates_df['state'].tolist(), ['Utah', 'Utah'])
+        self.assertFalse(rates_df['value'].isna().any())
+
+    def test_per_capita(self):
+        """
+        Test that the yearly per-capita rates divide every metric by the
+        population of the state in the closest year of the table.
+        """
+        pop_df = read_csv("./data/us-state-populations.csv")
+        rates = self.cube.per_capita(population_table(pop_df))
+        texas = self.grouped_df[(self.grouped_df['state'] == 'Texas')
+                                & (self.grouped_df['year'] == 2010)]
+        pop_texas = pop_df.loc[pop_df['state'] == 'Texas', 'pop_2014'].item()
+        self.assertAlmostEqual(rates.value('Texas', 2010, 'handgun'),
+                               texas['handgun'].item() * 100 / pop_texas)
+        self.assertTrue(np.isnan(rates.value('Guam', 2010, 'handgun')))
+
+        # Long table with two years: each cube year uses the closest one
+        long_df = pd.DataFrame({'state': ['Texas', 'Texas'],
+                                'year': [2000, 2010],
+                                'population': [2e7, 2.5e7]})
+        rates = self.cube.per_capita(population_table(long_df), per=1)
+        for year, population in [(1999, 2e7), (2005, 2e7), (2006, 2.5e7),
+                                 (2016, 2.5e7)]:
+            self.assertAlmostEqual(
+                rates.value('Texas', year, 'permit'),
+                self.cube.value('Texas', year, 'permit') / population)
+
+
+class TestTimeSeries(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Build the series from the whole NICS file once.
+        """
+        cls._df = read_csv("./data/nics-firearm-background-checks.csv")
+        cls.series = MonthlySeries.from_frame(cls._df)
+
+    def test_statistics(self):
+        """
+        Test that the rolling means and year-over-year changes match pandas
+        on a single state and metric.
+        """
+        self.assertEqual(self.series.values.shape, (55, 257, 25))
+        self.assertEqual(self.series.months[-1], '2020-03')
+
+        texas_df = self._df[self._df['state'] == 'Texas'] \
+            .sort_values('month')
+        state = self.series.state_index['Texas']
+        metric = self.series.metric_index['handgun']
+
+        expected = texas_df['handgun'].rolling(12, min_periods=1).mean() \
+            .to_numpy().copy()
+        expected[:11] = np.nan
+        np.testing.assert_allclose(self.series.rolling(12)[state, :, metric],
+                                   expected)
+        np.testing.assert_allclose(self.series.yoy()[state, :, metric],
+                                   texas_df['handgun'].diff(12).to_numpy())
+
+        seasonal = self.series.seasonal_index()[state, :, metric]
+        calendar = texas_df['month'].str[5:].astype(int)
+        expected = texas_df.groupby(calendar)['handgun'].mean() \
+            / texas_df['handgun'].mean()
+        np.testing.assert_allclose(seasonal, expected.to_numpy())
+
+    def test_append(self):
+        """
+        Test that appending months one by one keeps the same statistics as
+        building the series from the whole history.
+        """
+        months = sorted(self._df['month'].unique())
+        series = MonthlySeries.from_frame(
+            self._df[self._df['month'] < months[-14]])
+        for month in months[-14:]:
+            series.append(month, self._df[self._df['month'] == month])
+
+        latest = series.latest()
+        expected = self.series.latest()
+        self.assertEqual(latest['month'], '2020-03')
+        for key in ['value', 'rolling_3', 'rolling_12', 'yoy']:
+            np.testing.assert_allclose(latest[key], expected[key])
+        np.testing.assert_allclose(latest['rolling_12'],
+                                   self.series.rolling(12)[:, -1])
+        np.testing.assert_allclose(series.seasonal_index(),
+                                   self.series.seasonal_index())
+
+        with self.assertRaises(ValueError):
+            series.append('2020-06', self._df[self._df['month'] == months[-1]])
+
+
+class TestMetrics(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Register the metrics of the whole NICS file once.
+        """
+        cls._df = read_csv("./data/nics-firearm-background-checks.csv")
+        cls.registry = MetricRegistry.from_frame(cls._df)
+
+    def test_aggregate(self):
+        """
+        Test that the single-pass aggregation of every category matches a
+        pandas groupby by year and state.
+        """
+        self.assertEqual(self.registry.metrics,
+                         sum(NICS_FAMILIES.values(), []))
+
+        grouped_df = self.registry.aggregate(self._df)
+        year, _ = parse_year_month(self._df['month'])
+        expected = self._df.drop(columns=['month']).assign(year=year) \
+            .groupby(['year', 'state']).sum().reset_index()
+
+        columns = ['year', 'state'] + self.registry.metrics + ['totals']
+        np.testing.assert_array_equal(grouped_df[columns].to_numpy(),
+                                      expected[columns].to_numpy())
+        self.assertEqual(grouped_df['unreconciled'].sum(), 0)
+
+        # Families add up their metrics
+        family_df = self.registry.by_family(grouped_df)
+        np.testing.assert_array_equal(
+            family_df['sale'],
+            grouped_df[NICS_FAMILIES['sale']].sum(axis=1))
+        np.testing.assert_array_equal(
+            family_df[list(NICS_FAMILIES)].sum(axis=1), family_df['totals'])
+
+    def test_reconcile(self):
+        """
+        Test that the rows whose categories do not add up to their totals
+        are flagged, in the reconciliation and in the aggregates.
+        """
+        self.assertTrue(self.registry.reconcile(self._df).empty)
+
+        df = self._df.copy()
+        df.loc[5, 'handgun'] += 1
+        df.loc[7, 'long_gun'] = np.nan
+        counts = self.registry.counts(df)
+
+        unreconciled = self.registry.reconcile(counts)
+        self.assertEqual(list(unreconciled.index), [5, 7])
+        self.assertEqual(unreconciled.loc[5, 'difference'], -1)
+        self.assertEqual(unreconciled.loc[7, 'difference'],
+                         self._df.loc[7, 'long_gun'])
+
+        grouped_df = self.registry.aggregate(counts)
+        self.assertEqual(grouped_df['unreconciled'].sum(), 2)
+
+        # Rows without a state are left out of the aggregates
+        df.loc[[9, 11], 'state'] = np.nan
+        grouped_df = self.registry.aggregate(df)
+        self.assertFalse(grouped_df['state'].isna().any())
+        self.assertEqual(grouped_df['totals'].sum(),
+                         df['totals'].sum()
+                         - df.loc[[9, 11], 'totals'].sum())
+
+        with self.assertRaises(ValueError):
+            self.registry.reconcile(df.drop(columns=['totals']))
+        with self.assertRaises(ValueError):
+            self.registry.aggregate(df.drop(columns=['admin']))
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_dependencies_and_parallelism(self):
+        """
+        Test that tasks start after their dependencies, that independent
+        tasks overlap, and that main-thread tasks run in the calling thread.
+        """
+        threads = {}
+
+        def sleep(name):
+            def func():
+                threads[name] = threading.current_thread()
+                time.sleep(0.2)
+            return func
+
+        tasks = {
+            'shared': Task(sleep('shared')),
+            'a': Task(sleep('a'), ['shared']),
+            'b': Task(sleep('b'), ['shared']),
+            'c': Task(sleep('c'), ['shared'], main_thread=True),
+            'last': Task(sleep('last'), ['a', 'b']),
+        }
+        timeline = {entry['task']: entry
+                    for entry in run_tasks(tasks, jobs=3)}
+
+        for name in ['a', 'b', 'c']:
+            self.assertGreaterEqual(timeline[name]['start'],
+                                    timeline['shared']['end'])
+        self.assertGreaterEqual(timeline['last']['start'],
+                                max(timeline['a']['end'], timeline['b']['end']))
+        self.assertLess(timeline['b']['start'], timeline['a']['end'])
+        self.assertLess(timeline['c']['start'], timeline['a']['end'])
+        self.assertIs(threads['c'], threading.current_thread())
+
+        sequential = run_tasks(tasks, jobs=1)
+        self.assertEqual([entry['task'] for entry in sequential],
+                         ['shared', 'a', 'b', 'c', 'last'])
+
+    def test_errors(self):
+        """
+        Test that invalid graphs are rejected and task errors are raised.
+        """
+        with self.assertRaises(ValueError):
+            run_tasks({'a': Task(lambda: None, ['b']),
+                       'b': Task(lambda: None, ['a'])})
+        with self.assertRaises(ValueError):
+            run_tasks({'a': Task(lambda: None, ['missing'])})
+
+        ran = []
+        tasks = {
+            'fails': Task(lambda: 1 / 0),
+            'skipped': Task(lambda: ran.append(1), ['fails']),
+        }
+        with self.assertRaises(ZeroDivisionError):
+            run_tasks(tasks, jobs=2)
+        self.assertEqual(ran, [])
+
+
+class TestService(unittest.TestCase):
+
+    def test_queries(self):
+        """
+        Test that the service answers totals, per-capita and top-k queries
+        over HTTP, caching repeated responses.
+        """
+        service = StatsService(Pipeline())
+
+        async def get(port, paths):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            responses = []
+            for path in paths:
+                writer.write(f"GET {path} HTTP/1.1\r\n\r\n".encode())
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                line = await reader.readline()
+                while line != b'\r\n':
+                    if line.lower().startswith(b'content-length:'):
+                        length = int(line.split(b':')[1])
+                    line = await reader.readline()
+                responses.append((status,
+                                  json.loads(await reader.readexactly(length))))
+            writer.close()
+            return responses
+
+        async def run(paths):
+            server = await service.start('127.0.0.1', 0)
+            async with server:
+                return await get(server.sockets[0].getsockname()[1], paths)
+
+        responses = asyncio.run(run([
+            '/totals?state=Florida&year=2016&metric=handgun',
+            '/totals?metric=handgun&year=2016&state=Florida',
+            '/per_capita?state=Texas&year=2016',
+            '/top?metric=long_gun&k=1',
+            '/totals?state=Atlantis',
+            '/unknown',
+            '/top?k=-2',
+            '/top?k=two',
+            '/top?by=month',
+        ]))
+
+        self.assertEqual(responses[0], (200, [{'state': 'Florida',
+                                               'year': 2016,
+                                               'metric': 'handgun',
+                                               'value': 662308}]))
+        self.assertEqual(responses[1], responses[0])
+        self.assertEqual(len(responses[2][1]), 3)
+        self.assertAlmostEqual(
+            responses[2][1][1]['value'],
+            service.rates.value('Texas', 2016, 'handgun'))
+        self.assertEqual(responses[3][1][0]['state'], 'Pennsylvania')
+        self.assertEqual([status for status, _ in responses[4:]],
+                         [400, 404, 400, 400, 400])
+        self.assertEqual(responses[6][1],
+                         {'error': 'Invalid k -2, it must be at least 1'})
+        self.assertEqual(responses[8][1], {'error': 'Unknown breakdown month'})
+        self.assertEqual(service.respond.cache_info().hits, 1)
+
+        # A request line longer than the reader limit is answered and the
+        # connection closed
+        async def too_long():
+            server = await service.start('127.0.0.1', 0)
+            async with server:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', server.sockets[0].getsockname()[1])
+                writer.write(b'GET /' + b'a' * 2 ** 17 + b' HTTP/1.1\r\n\r\n')
+                writer.write_eof()
+                response = await reader.read()
+                writer.close()
+                return response
+
+        response = asyncio.run(too_long())
+        self.assertTrue(response.startswith(b'HTTP/1.1 413 '))
+        self.assertIn(b'Connection: close', response)
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def test_generated_data(self):
+        """
+        Test that the synthetic data repeats the states, months and blank
+        counts of the bundled file, with totals adding up.
+        """
+        base = pd.read_csv("./data/nics-firearm-background-checks.csv")
+        df = generate_nics(3)
+
+        self.assertEqual(list(df.columns), list(base.columns))
+        self.assertEqual(len(df), 3 * len(base))
+        self.assertEqual(df['state'].value_counts().to_dict(),
+                         (base['state'].value_counts() * 3).to_dict())
+        self.assertEqual(df['month'].nunique(), base['month'].nunique())
+        self.assertEqual(df.isna().sum().to_dict(),
+                         (base.isna().sum() * 3).to_dict())
+        components = df.columns.drop(['month', 'state', 'totals'])
+        self.assertTrue((df[components].sum(axis=1) == df['totals']).all())
+
+        # Written in chunks, the file holds the same data
+        _dir = tempfile.mkdtemp()
+        path = write_nics(os.path.join(_dir, 'nics.csv'), 3,
+                          chunk_rows=len(base))
+        written = pd.read_csv(path)
+        shutil.rmtree(_dir)
+        self.assertEqual(len(written), len(df))
+        self.assertEqual(written['totals'].sum(), df['totals'].sum())
+
+
+class TestCLI(unittest.TestCase):
+
+    def test_batch_run(self):
+        """
+        Test that the batch mode saves the selected outputs without any
+        interaction and exits with status 0.
+        """
+        _dir = tempfile.mkdtemp()
+        with redirect_stdout(io.StringIO()):
+            status = main(['--exercises', '3', '4', '--quiet',
+                           '--output-dir', _dir, '--formats', 'csv', 'png'])
+        outputs = sorted(os.listdir(_dir))
+        shutil.rmtree(_dir)
+
+        self.assertEqual(status, 0)
+        self.assertEqual(outputs, ['grouped.csv', 'time_evolution.png'])
+
+    def test_batch_dependencies(self):
+        """
+        Test that the batch mode only computes the stages of the selected
+        exercises.
+        """
+        _dir = tempfile.mkdtemp()
+        pipeline = Pipeline()
+        with redirect_stdout(io.StringIO()):
+            run_batch([1], pipeline, _dir, ('csv',))
+        outputs = os.listdir(_dir)
+        shutil.rmtree(_dir)
+
+        self.assertEqual(outputs, ['cleaned.csv'])
+        self.assertIn('renamed', pipeline._results)
+        self.assertNotIn('grouped', pipeline._results)
+        self.assertNotIn('cube', pipeline._results)
+
+    def test_menu_options(self):
+        """
+        Test that the menu runs on the pipeline and map options given on the
+        command line.
+        """
+        _dir = tempfile.mkdtemp()
+        with unittest.mock.patch('gunstats.main.main_menu') as main_menu:
+            status = main(['--data-dir', _dir, '--output-dir', _dir,
+                           '--lean', '--no-map-cache', '--layered-maps'])
+        shutil.rmtree(_dir)
+
+        self.assertEqual(status, 0)
+        jobs, pipeline, maps_dir, formats, backend, cache, layered = \
+            main_menu.call_args.args
+        self.assertEqual((pipeline.data_dir, pipeline.lean), (_dir, True))
+        self.assertEqual((maps_dir, backend, cache, layered),
+                         (_dir, 'browser', None, True))
+
+    def test_failed_run(self):
+        """
+        Test that a failing batch run exits with status 1.
+        """
+        _dir = tempfile.mkdtemp()
+        with redirect_stdout(io.StringIO()), \
+                unittest.mock.patch('sys.stderr', io.StringIO()):
+            status = main(['--exercises', '1', '--quiet',
+                           '--data-dir', os.path.join(_dir, 'missing'),
+                           '--output-dir', _dir])
+        shutil.rmtree(_dir)
+
+        self.assertEqual(status, 1)
+
+    def test_import_time(self):
+        """
+        Test that importing the command line does not import the plotting
+        and browser libraries.
+        """
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                                 'import gunstats.main'],
+                                capture_output=True, text=True, check=True)
+        # Lines are 'import time: self [us] | cumulative | module'
+        modules = [line.split('|')[2].strip()
+                   for line in result.stderr.splitlines()[1:]]
+
+        heavy = [module for module in modules
+                 if module.split('.')[0] in ('matplotlib', 'folium',
+                                             'branca', 'selenium')]
+        self.assertEqual(heavy, [])
+
 
 if __name__ == '__main__':
     unittest.main()